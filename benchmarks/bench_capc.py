@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Startup latency benchmark for the capc CLI.
+
+Runs capc as a fresh process many times per scenario, the way scripts and
+operators call it, and reports wall-clock p50/p95 per scenario along with
+the median of capc's own --timing phases (import, resolve, request).
+Direct-mode scenarios run against a simulated Pi with a warm topology
+cache, so they measure capc rather than the network. Results are written
+as JSON; pass --compare with an earlier result file to track startup
+latency across releases.
+
+    python benchmarks/bench_capc.py --runs 30
+    python benchmarks/bench_capc.py --output new.json --compare baseline.json
+
+Scenarios:
+    help           capc --help (imports and argument parsing only)
+    status_direct  capc -n <switch> -d (topology lookup + one GET to the Pi)
+    on_direct      capc -n <switch> --on -d (topology lookup + one POST to the Pi)
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from simulation import SimulatorFarm, generate_fleet_config  # noqa: E402
+
+CAPC = REPO_ROOT / 'capc'
+
+SCENARIOS = {
+    'help': ['--help'],
+    'status_direct': ['-n', '<name>', '-d'],
+    'on_direct': ['-n', '<name>', '--on', '-d'],
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def write_topology_cache(cache_home, farm):
+    """Write a fresh capc topology cache for the farm, as capc would after a fetch"""
+    topology = {'pis': {}, 'switches': {}}
+    for pi_id, pi in farm.pis.items():
+        host, port = pi.url.split('//', 1)[1].split(':')
+        topology['pis'][pi_id] = {'ip_address': host, 'port': int(port),
+                                  'chassis': pi.pi_config.get('chassis', [])}
+        for name, position in pi.pi_config['switch_mapping'].items():
+            topology['switches'][name] = {'pi_id': pi_id, 'hat': position['hat'], 'relay': position['relay']}
+
+    # Matches capc's MAIN_SERVER_HOST/MAIN_SERVER_PORT
+    cache_dir = Path(cache_home) / 'capc'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(cache_dir / 'topology-localhost_5000.json', 'w') as f:
+        json.dump({'fetched_at': time.time(), 'etag': None, 'topology': topology}, f)
+
+
+def run_scenario(argv, runs, env):
+    """
+    Run capc runs times.
+
+    Returns:
+        dict: Wall-clock percentiles in ms, median --timing phases, and failures
+    """
+    wall = []
+    phases = {}
+    failures = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, str(CAPC), *argv, '--timing'],
+                                capture_output=True, text=True, env=env)
+        wall.append(round((time.perf_counter() - started) * 1000, 3))
+        if result.returncode != 0:
+            failures += 1
+        for line in reversed(result.stderr.splitlines()):
+            if line.startswith('{"timing_ms"'):
+                for phase, ms in json.loads(line)['timing_ms'].items():
+                    phases.setdefault(phase, []).append(ms)
+                break
+
+    wall.sort()
+    return {
+        'runs': runs,
+        'failures': failures,
+        'wall_ms': {
+            'p50': percentile(wall, 50),
+            'p95': percentile(wall, 95),
+            'max': wall[-1],
+        },
+        'phases_ms': {phase: round(statistics.median(values), 3) for phase, values in phases.items()},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the p50 change per scenario against an earlier result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('git_commit')}):")
+    for name, result in results.items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        old_p50, new_p50 = old['wall_ms']['p50'], result['wall_ms']['p50']
+        print(f"  {name:<14} p50 {old_p50:>8} -> {new_p50:<8} ms ({(new_p50 / old_p50 - 1):+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark capc startup latency')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--runs', type=int, default=20, help='capc runs per scenario')
+    parser.add_argument('--base-port', type=int, default=5401, help='Port of the simulated Pi')
+    parser.add_argument('--output', default='bench_capc.json', help='JSON results file')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No access log from the simulated Pi
+    farm = SimulatorFarm(generate_fleet_config(1), base_port=args.base_port, i2c_latency=0)
+    switch = next(iter(farm.pis.values())).switches[0]
+    cache_home = tempfile.TemporaryDirectory(prefix='casm-bench-capc-')
+    write_topology_cache(cache_home.name, farm)
+    env = dict(os.environ, XDG_CACHE_HOME=cache_home.name, CAPC_TOPOLOGY_TTL='3600')
+
+    results = {}
+    try:
+        farm.start()
+        for name in args.scenario or list(SCENARIOS):
+            argv = [switch if arg == '<name>' else arg for arg in SCENARIOS[name]]
+            results[name] = run_scenario(argv, args.runs, env)
+            wall, phases = results[name]['wall_ms'], results[name]['phases_ms']
+            print(f"{name:<14} p50 {wall['p50']:>8} ms   p95 {wall['p95']:>8} ms   "
+                  f"phases {phases}   failures {results[name]['failures']}/{args.runs}")
+    finally:
+        farm.stop()
+        cache_home.cleanup()
+
+    output = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': vars(args),
+        },
+        'scenarios': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+I2C call budget and per-endpoint microbenchmark for the Pi (hardware) app.
+
+Runs every route of the hardware app through Flask's test client against an
+instrumented relay backend that counts bus calls instead of touching I2C.
+For each route it reports bus reads/writes per request, the bus time those
+calls would take on hardware (from per-call costs), and the Python time
+spent per request. Exits non-zero if any route makes more bus calls than
+its budget, or if a route has no budget.
+
+    python benchmarks/bench_hardware.py
+    python benchmarks/bench_hardware.py --pi pi_2 --iterations 500 --output hw.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+# Approximate cost of each lib8relind call on the Pi's I2C bus (seconds)
+DEFAULT_CALL_COST = {
+    'get': 0.0005,
+    'set': 0.0008,
+    'get_all': 0.0005,
+    'set_all': 0.0008,
+}
+
+READ_OPS = ('get', 'get_all')
+WRITE_OPS = ('set', 'set_all')
+
+
+class InstrumentedRelay:
+    """lib8relind stand-in that keeps relay state in memory and counts calls"""
+
+    def __init__(self, num_hats, call_cost):
+        self.bitmaps = [0] * num_hats
+        self.call_cost = call_cost
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.calls = {op: 0 for op in self.call_cost}
+
+    def bus_time(self):
+        return sum(self.call_cost[op] * count for op, count in self.calls.items())
+
+    def get(self, hat, relay_num):
+        self.calls['get'] += 1
+        return (self.bitmaps[hat] >> (relay_num - 1)) & 1
+
+    def set(self, hat, relay_num, state):
+        self.calls['set'] += 1
+        mask = 1 << (relay_num - 1)
+        self.bitmaps[hat] = (self.bitmaps[hat] | mask) if state else (self.bitmaps[hat] & ~mask)
+
+    def get_all(self, hat):
+        self.calls['get_all'] += 1
+        return self.bitmaps[hat]
+
+    def set_all(self, hat, bitmap):
+        self.calls['set_all'] += 1
+        self.bitmaps[hat] = bitmap
+
+
+def build_cases(hardware):
+    """
+    One request per route with its bus call budget.
+
+    Returns:
+        list: (rule, method, path, json body or None, max reads, max writes)
+    """
+    num_hats = hardware.NUM_HATS
+    relays = hardware.RELAYS_PER_HAT
+    switch = hardware.switch_mapper.get_all_switches()[0]
+    chassis = hardware.switch_mapper.get_all_chassis()[0]
+    # Writes are budgeted for a cold bitmap cache: one get_all, then the write
+    return [
+        ('/', 'GET', '/', None, 0, 0),
+        # Reads only HATs whose bitmap is not known yet
+        ('/api/status', 'GET', '/api/status', None, num_hats, 0),
+        ('/metrics', 'GET', '/metrics', None, 0, 0),
+        ('/api/trace/slow', 'GET', '/api/trace/slow', None, 0, 0),
+        ('/api/relay/control', 'POST', '/api/relay/control',
+         {'switch_name': switch, 'hat': 0, 'relay': 1, 'state': 'toggle'}, 1, 1),
+        ('/api/relay/<int:hat>/<int:relay_num>', 'GET', f'/api/relay/0/{relays}', None, 1, 0),
+        ('/api/relay/<int:hat>/<int:relay_num>', 'POST', f'/api/relay/0/{relays}', {'state': 'toggle'}, 1, 1),
+        ('/api/relay/all', 'GET', '/api/relay/all', None, num_hats, 0),
+        ('/api/relay/hat/<int:hat>', 'GET', '/api/relay/hat/0', None, 1, 0),
+        ('/api/relay/hat/<int:hat>/all-on', 'POST', '/api/relay/hat/0/all-on', None, 1, 1),
+        ('/api/relay/hat/<int:hat>/all-off', 'POST', '/api/relay/hat/0/all-off', None, 1, 1),
+        ('/api/relay/all-on', 'POST', '/api/relay/all-on', None, num_hats, num_hats),
+        ('/api/relay/all-off', 'POST', '/api/relay/all-off', None, num_hats, num_hats),
+        # Never elided: one write and one readback per HAT
+        ('/api/emergency/all-off', 'POST', '/api/emergency/all-off', None, num_hats, num_hats),
+        ('/api/switch/<switch_name>', 'GET', f'/api/switch/{switch}', None, 1, 0),
+        ('/api/switch/<switch_name>', 'POST', f'/api/switch/{switch}', {'state': 'toggle'}, 1, 1),
+        ('/api/switch/list', 'GET', '/api/switch/list', None, num_hats, 0),
+        ('/api/switch/chassis/<int:chassis_num>', 'GET', f'/api/switch/chassis/{chassis}', None, num_hats, 0),
+    ]
+
+
+def run_case(client, backend, hardware, method, path, body, iterations):
+    """
+    Send one request iterations times, starting each from a cold bitmap cache.
+
+    Returns:
+        dict: Worst-case reads/writes, mean bus calls and timings per request
+    """
+    worst_reads = worst_writes = 0
+    total_calls = {op: 0 for op in backend.calls}
+    bus_time = python_time = 0.0
+    status_codes = set()
+
+    for i in range(iterations):
+        hardware.hat_bitmaps.clear()
+        backend.reset_counts()
+        payload = body
+        if body is not None and body.get('state') == 'toggle':
+            payload = dict(body, state=i % 2)
+
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=payload)
+        python_time += time.perf_counter() - started
+        status_codes.add(response.status_code)
+
+        reads = sum(backend.calls[op] for op in READ_OPS)
+        writes = sum(backend.calls[op] for op in WRITE_OPS)
+        worst_reads, worst_writes = max(worst_reads, reads), max(worst_writes, writes)
+        bus_time += backend.bus_time()
+        for op, count in backend.calls.items():
+            total_calls[op] += count
+
+    return {
+        'status_codes': sorted(status_codes),
+        'max_reads': worst_reads,
+        'max_writes': worst_writes,
+        'calls_per_request': {op: count / iterations for op, count in total_calls.items()},
+        'bus_time_ms': round(bus_time / iterations * 1000, 3),
+        'python_time_ms': round(python_time / iterations * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='I2C call budget benchmark for the hardware app')
+    parser.add_argument('--config', default=str(REPO_ROOT / 'main_config.yaml'), help='Config file')
+    parser.add_argument('--pi', default=None, help='Pi section to load (default: first Pi in config)')
+    parser.add_argument('--iterations', type=int, default=200, help='Requests per route')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    import yaml
+    with open(args.config) as f:
+        pi_id = args.pi or next(iter(yaml.safe_load(f)['raspberry_pis']))
+    os.environ['CASM_CONFIG'] = args.config
+    os.environ['CASM_PI_ID'] = pi_id
+
+    import hardware
+    backend = InstrumentedRelay(hardware.NUM_HATS, DEFAULT_CALL_COST)
+    hardware.set_relay_backend(backend)
+    app = hardware.create_app()
+    client = app.test_client()
+
+    cases = build_cases(hardware)
+    covered = {rule for rule, *_ in cases}
+    unbudgeted = sorted(rule.rule for rule in app.url_map.iter_rules()
+                        if rule.endpoint != 'static' and rule.rule not in covered)
+
+    results = []
+    failures = []
+    print(f"{pi_id}: {hardware.NUM_HATS} HATs, {len(hardware.switch_mapper.get_all_switches())} switches, "
+          f"{args.iterations} requests per route\n")
+    print(f"{'route':<46} {'reads':>9} {'writes':>9} {'bus ms':>8} {'python ms':>10}")
+    for rule, method, path, body, max_reads, max_writes in cases:
+        result = run_case(client, backend, hardware, method, path, body, args.iterations)
+        result.update({'route': f'{method} {rule}', 'path': path,
+                       'budget': {'reads': max_reads, 'writes': max_writes}})
+        over = result['max_reads'] > max_reads or result['max_writes'] > max_writes
+        errors = [code for code in result['status_codes'] if code >= 400]
+        if over or errors:
+            failures.append(result['route'])
+        results.append(result)
+        print(f"{result['route']:<46} {result['max_reads']:>4}/{max_reads:<4} "
+              f"{result['max_writes']:>4}/{max_writes:<4} {result['bus_time_ms']:>8} "
+              f"{result['python_time_ms']:>10}"
+              f"{'  OVER BUDGET' if over else ''}{f'  HTTP {errors}' if errors else ''}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'pi_id': pi_id, 'num_hats': hardware.NUM_HATS, 'iterations': args.iterations,
+                       'call_cost_s': DEFAULT_CALL_COST, 'routes': results,
+                       'unbudgeted_routes': unbudgeted}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if unbudgeted:
+        print(f"\nRoutes without a call budget: {unbudgeted}")
+    if failures:
+        print(f"\nFAILED: {failures}")
+    if failures or unbudgeted:
+        sys.exit(1)
+    print("\nAll routes within their I2C call budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Load test for the main server against a farm of simulated Pis.
+
+Starts a simulator farm and a main server pointed at it, drives each
+workload with concurrent clients for a fixed time, and reports req/s and
+p50/p95/p99 latency overall and per endpoint. Results are written as JSON;
+pass --compare with an earlier result file to see the change per workload.
+
+    python benchmarks/bench_main_server.py --pis 4 --clients 16 --duration 10
+    python benchmarks/bench_main_server.py --output new.json --compare baseline.json
+    python benchmarks/bench_main_server.py --workload commands --channel   # commands over control channels
+
+Workloads:
+    dashboard   Browser/capc polling: switch list, status, single-switch reads
+    commands    Bursts of switch POSTs to random switches
+    pi_offline  The dashboard mix with one Pi crashed
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from simulation import SimulatorFarm, generate_fleet_config  # noqa: E402
+
+# (operation, weight); <name> is replaced by a random switch
+WORKLOADS = {
+    'dashboard': [
+        ('GET /api/switch/list', 4),
+        ('GET /api/status', 1),
+        ('GET /api/switch/<name>', 5),
+    ],
+    'commands': [
+        ('POST /api/switch/<name>', 1),
+    ],
+    'pi_offline': [
+        ('GET /api/switch/list', 4),
+        ('GET /api/status', 1),
+        ('GET /api/switch/<name>', 5),
+    ],
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, duration):
+    """
+    Summarize (latency_ms, ok) samples.
+
+    Returns:
+        dict: requests, errors, rps and latency percentiles in ms
+    """
+    latencies = sorted(latency for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'rps': round(len(samples) / duration, 1) if duration else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        }
+    }
+
+
+def wait_for_server(url, timeout=30):
+    """Wait until the main server answers /api/status"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{url}/api/status', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Main server at {url} did not start within {timeout}s')
+
+
+def run_workload(url, mix, switches, clients, duration, request_timeout, seed=1):
+    """
+    Drive one workload with closed-loop clients for duration seconds.
+
+    Returns:
+        tuple: (samples by operation {op: [(latency_ms, ok), ...]}, elapsed seconds)
+    """
+    ops = [op for op, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    def client(client_index):
+        rng = random.Random(seed * 1000 + client_index)
+        session = requests.Session()
+        samples = {op: [] for op in ops}
+        stop_at = time.monotonic() + duration
+        while time.monotonic() < stop_at:
+            op = rng.choices(ops, weights)[0]
+            method, path = op.split(' ', 1)
+            path = path.replace('<name>', rng.choice(switches))
+            body = {'state': rng.randint(0, 1)} if method == 'POST' else None
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url + path, json=body, timeout=request_timeout)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            samples[op].append((round((time.perf_counter() - started) * 1000, 3), ok))
+        return samples
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        per_client = list(pool.map(client, range(clients)))
+    elapsed = time.monotonic() - started
+
+    merged = {op: [] for op in ops}
+    for samples in per_client:
+        for op, values in samples.items():
+            merged[op].extend(values)
+    return merged, elapsed
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print req/s and p99 change per workload against an earlier result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('git_commit')}):")
+    for name, result in results.items():
+        old = baseline['workloads'].get(name)
+        if old is None:
+            continue
+        old_rps, new_rps = old['rps'], result['rps']
+        old_p99, new_p99 = old['latency_ms']['p99'], result['latency_ms']['p99']
+        print(f"  {name:<12} req/s {old_rps:>8} -> {new_rps:<8} ({(new_rps / old_rps - 1):+.1%})   "
+              f"p99 {old_p99:>8} -> {new_p99:<8} ms ({(new_p99 / old_p99 - 1):+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the main server against simulated Pis')
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS),
+                        help='Workload to run (repeatable, default: all)')
+    parser.add_argument('--pis', type=int, default=4, help='Simulated Pis (2 chassis each)')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per workload')
+    parser.add_argument('--i2c-ms', type=float, default=2.0, help='Simulated I2C call latency (ms)')
+    parser.add_argument('--delay-ms', type=float, default=1.0, help='Simulated network delay (ms)')
+    parser.add_argument('--port', type=int, default=5099, help='Main server port')
+    parser.add_argument('--base-port', type=int, default=5201, help='Port of the first simulated Pi')
+    parser.add_argument('--channel', action='store_true',
+                        help='Give each simulated Pi a control channel (ports from --base-port + 1000)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Client request timeout (s)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the request mix')
+    parser.add_argument('--output', default='bench_main_server.json', help='JSON results file')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    workloads = args.workload or list(WORKLOADS)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No access log from the simulated Pis
+    config = generate_fleet_config(args.pis)
+    farm = SimulatorFarm(config, base_port=args.base_port,
+                         i2c_latency=args.i2c_ms / 1000, network_delay=args.delay_ms / 1000,
+                         control_base_port=args.base_port + 1000 if args.channel else None)
+    switches = [name for pi in farm.pis.values() for name in pi.switches]
+    url = f'http://127.0.0.1:{args.port}'
+
+    workdir = tempfile.TemporaryDirectory(prefix='casm-bench-')
+    config_path = farm.write_config(Path(workdir.name) / 'config.yaml')
+    env = dict(os.environ, CASM_CONFIG=str(config_path),
+               CASM_DB=str(Path(workdir.name) / 'status_history.db'))
+    server_log = open(Path(workdir.name) / 'main_server.log', 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys; from main_server import create_app; '
+         'create_app().run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)',
+         str(args.port)],
+        cwd=REPO_ROOT, env=env, stdout=server_log, stderr=subprocess.STDOUT
+    )
+
+    results = {}
+    try:
+        farm.start()
+        wait_for_server(url)
+        for name in workloads:
+            offline = None
+            if name == 'pi_offline':
+                offline = farm.pis[next(iter(farm.pis))]
+                offline.crash()
+            try:
+                samples, elapsed = run_workload(url, WORKLOADS[name], switches,
+                                                args.clients, args.duration, args.timeout, args.seed)
+            finally:
+                if offline is not None:
+                    offline.recover()
+
+            all_samples = [sample for values in samples.values() for sample in values]
+            results[name] = summarize(all_samples, elapsed)
+            results[name]['by_operation'] = {op: summarize(values, elapsed) for op, values in samples.items()}
+            if offline is not None:
+                results[name]['offline_pi'] = offline.pi_id
+
+            latency = results[name]['latency_ms']
+            print(f"{name:<12} {results[name]['rps']:>8} req/s   p50 {latency['p50']} ms   "
+                  f"p95 {latency['p95']} ms   p99 {latency['p99']} ms   "
+                  f"errors {results[name]['errors']}/{results[name]['requests']}")
+    finally:
+        server.terminate()
+        server.wait()
+        server_log.close()
+        farm.stop()
+        workdir.cleanup()
+
+    output = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': vars(args),
+        },
+        'workloads': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,541 @@
+"""
+Persistent control channel between the main server and a Pi.
+
+One framed TCP connection per Pi carries relay commands, their acks and
+state events, instead of one HTTP request per command. Every frame is a
+7-byte header followed by a small binary payload:
+
+    payload length (u16) | type (u8) | id (u32) | payload
+
+    SET    hat (u8), relay (u8), state (u8), deadline ms (u32, 0 = none)
+    ACK    state (u8), changed (u8)
+    ERROR  HTTP-style status (u16), UTF-8 message
+    STATE  boot id (8 bytes), state version (u32), relays per HAT (u8),
+           bitmap per HAT (u16, 0xFFFF = unknown)
+
+A command's ack or error carries the command's id, so any number of
+commands can be in flight on one connection and complete in any order.
+The Pi sends a STATE event (id 0) as soon as a client connects and again
+whenever its state version changes, so a client that reconnects is resynced
+without asking. Each STATE is read and sent under the connection's send
+lock, so it is never older than an ack sent before it. Clients reconnect on
+their own with exponential backoff.
+
+The channel is enabled by giving a Pi a control_port in main_config.yaml.
+HTTP stays available for everything, and the main server falls back to it
+whenever a Pi's channel is down or a command gets no answer in time.
+"""
+
+import itertools
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event
+
+HEADER = struct.Struct('>HBI')
+SET_PAYLOAD = struct.Struct('>BBBI')
+ACK_PAYLOAD = struct.Struct('>BB')
+ERROR_STATUS = struct.Struct('>H')
+STATE_HEADER = struct.Struct('>8sIB')
+
+SET, ACK, ERROR, STATE = 1, 2, 3, 4
+UNKNOWN_BITMAP = 0xFFFF
+
+
+class ChannelError(Exception):
+    """The command could not be delivered or got no answer; HTTP may still work"""
+
+
+class ChannelCommandError(ChannelError):
+    """The Pi received the command and rejected it"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def encode_frame(frame_type, frame_id, payload=b''):
+    return HEADER.pack(len(payload), frame_type, frame_id) + payload
+
+
+def encode_state(bitmaps, version, relays_per_hat, boot_id=None):
+    """
+    STATE payload for a list of bitmaps (None for HATs that are not known).
+
+    boot_id is the Pi server's run id as 16 hex digits (None sends zeros).
+    """
+    boot = bytes.fromhex(boot_id) if boot_id else b''
+    return STATE_HEADER.pack(boot, version & 0xFFFFFFFF, relays_per_hat) + struct.pack(
+        f'>{len(bitmaps)}H', *(UNKNOWN_BITMAP if bitmap is None else bitmap for bitmap in bitmaps))
+
+
+def decode_state(payload):
+    """
+    Returns:
+        tuple: ([bitmap or None per HAT], state version, relays per HAT, boot id as hex digits)
+    """
+    boot, version, relays_per_hat = STATE_HEADER.unpack_from(payload)
+    count = (len(payload) - STATE_HEADER.size) // 2
+    bitmaps = struct.unpack_from(f'>{count}H', payload, STATE_HEADER.size)
+    return [None if bitmap == UNKNOWN_BITMAP else bitmap for bitmap in bitmaps], version, relays_per_hat, boot.hex()
+
+
+def read_frame(sock):
+    """
+    Read one frame.
+
+    Returns:
+        tuple: (type, id, payload), or None if the peer closed the connection
+    """
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, frame_type, frame_id = HEADER.unpack(header)
+    payload = _recv_exact(sock, length) if length else b''
+    if payload is None:
+        return None
+    return frame_type, frame_id, payload
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _tune_socket(sock):
+    """Send small frames at once, and notice a silently dead peer"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', 5), ('TCP_KEEPINTVL', 2), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class ChannelServer:
+    """
+    Pi side of the control channel: accepts connections and runs their commands.
+
+    Commands from all connections run on a small shared pool, so commands in
+    flight on one connection are handled concurrently, as HTTP requests are.
+    """
+
+    def __init__(self, port, set_relay, snapshot, relays_per_hat, host='0.0.0.0',
+                 workers=4, state_interval=1.0, boot_id=None):
+        """
+        Args:
+            port: TCP port to listen on
+            set_relay: Called as set_relay(hat, relay, state); returns whether the
+                       relay changed, and raises ValueError for invalid arguments
+            snapshot: Returns ([bitmap or None per HAT], state version) without bus calls
+            relays_per_hat: Sent with every STATE event (at most 15, so that no
+                            bitmap is UNKNOWN_BITMAP)
+            host: Address to listen on
+            workers: Commands run at the same time
+            state_interval: Seconds between checks for state changes nobody
+                            reported through notify()
+            boot_id: This run of the Pi server (16 hex digits), sent with every
+                     STATE event so clients can tell a restart from an old version
+        """
+        if not 0 < relays_per_hat < 16:
+            raise ValueError(f'relays_per_hat must be 1-15 for the control channel, not {relays_per_hat}')
+        self.host = host
+        self.port = port
+        self.set_relay = set_relay
+        self.snapshot = snapshot
+        self.relays_per_hat = relays_per_hat
+        self.boot_id = boot_id
+        self.workers = workers
+        self.state_interval = state_interval
+        self.commands = 0
+        self.connections_total = 0
+        self._connections = {}  # socket -> send lock
+        self._lock = Lock()
+        self._changed = Event()
+        self._stop = Event()
+        self._listener = None
+        self._pool = None
+        self._threads = []
+
+    @property
+    def connections(self):
+        """Clients currently connected"""
+        return len(self._connections)
+
+    def start(self):
+        """Listen and start the accept and state threads"""
+        if self._listener is not None:
+            return
+        self._stop.clear()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen()
+        self._listener = listener
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='channel-command')
+        self._threads = [Thread(target=self._accept_loop, daemon=True, name='channel-accept'),
+                         Thread(target=self._push_states, daemon=True, name='channel-state')]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Close the listener and every connection"""
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        self._stop.set()
+        self._changed.set()
+        try:
+            listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        listener.close()
+        with self._lock:
+            connections = list(self._connections)
+        for sock in connections:
+            self._drop(sock)
+        for thread in self._threads:
+            thread.join()
+        self._pool.shutdown(wait=False)
+
+    def notify(self):
+        """Tell connected clients about a state change soon (cheap, safe under the bus lock)"""
+        self._changed.set()
+
+    def _accept_loop(self):
+        listener = self._listener
+        while not self._stop.is_set():
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return  # Listener closed by stop()
+            _tune_socket(sock)
+            with self._lock:
+                self._connections[sock] = Lock()
+                self.connections_total += 1
+            Thread(target=self._serve, args=(sock,), daemon=True, name='channel-connection').start()
+
+    def _serve(self, sock):
+        """Resync a new client, then read its commands until it disconnects"""
+        self._send_state(sock)
+        try:
+            while True:
+                frame = read_frame(sock)
+                if frame is None:
+                    break
+                frame_type, frame_id, payload = frame
+                if frame_type == SET and len(payload) == SET_PAYLOAD.size:
+                    self._pool.submit(self._run_set, sock, frame_id, payload, time.monotonic())
+                else:
+                    self._send(sock, self._error(frame_id, 400, f'Unsupported frame type {frame_type}'))
+        except (OSError, RuntimeError):
+            pass  # Connection reset, or the pool was shut down by stop()
+        finally:
+            self._drop(sock)
+
+    def _run_set(self, sock, frame_id, payload, received):
+        hat, relay, state, deadline_ms = SET_PAYLOAD.unpack(payload)
+        with self._lock:  # Commands run on several pool threads at once
+            self.commands += 1
+        if deadline_ms and (time.monotonic() - received) * 1000 >= deadline_ms:
+            frame = self._error(frame_id, 504, 'Deadline exceeded before the command ran')
+        else:
+            try:
+                changed = self.set_relay(hat, relay, state)
+                frame = encode_frame(ACK, frame_id, ACK_PAYLOAD.pack(state, 1 if changed else 0))
+            except ValueError as e:
+                frame = self._error(frame_id, 400, str(e))
+            except Exception as e:
+                frame = self._error(frame_id, 500, f'Failed to set relay state: {e}')
+        self._send(sock, frame)
+
+    @staticmethod
+    def _error(frame_id, status_code, message):
+        return encode_frame(ERROR, frame_id, ERROR_STATUS.pack(status_code) + message.encode()[:1024])
+
+    def _send(self, sock, frame):
+        send_lock = self._connections.get(sock)
+        if send_lock is None:
+            return  # Already dropped
+        try:
+            with send_lock:
+                sock.sendall(frame)
+        except OSError:
+            self._drop(sock)
+
+    def _send_state(self, sock):
+        """
+        Send a STATE event read while holding the connection's send lock.
+
+        A command's ack is sent only after its write is in the snapshot, so
+        reading the snapshot under the lock keeps every STATE at least as new
+        as the acks sent before it.
+        """
+        send_lock = self._connections.get(sock)
+        if send_lock is None:
+            return  # Already dropped
+        try:
+            with send_lock:
+                bitmaps, version = self.snapshot()
+                sock.sendall(encode_frame(STATE, 0, encode_state(bitmaps, version, self.relays_per_hat, self.boot_id)))
+        except OSError:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        with self._lock:
+            if self._connections.pop(sock, None) is None:
+                return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _push_states(self):
+        """Send a STATE event to every client whenever the state version moves"""
+        _, last_version = self.snapshot()
+        while not self._stop.is_set():
+            self._changed.wait(self.state_interval)
+            self._changed.clear()
+            _, version = self.snapshot()
+            if version == last_version:
+                continue
+            last_version = version
+            with self._lock:
+                connections = list(self._connections)
+            for sock in connections:
+                self._send_state(sock)
+
+
+class ChannelClient:
+    """
+    Main server side of the control channel to one Pi.
+
+    A background thread keeps the connection up, reconnecting with
+    exponential backoff, and reads acks and state events. Commands can be
+    sent from any thread; each waits only for its own ack. A STATE event
+    whose version is not newer than the last one on the same connection is
+    ignored.
+    """
+
+    def __init__(self, host, port, on_state=None, connect_timeout=1.0, max_backoff=10.0):
+        """
+        Args:
+            host: Pi address
+            port: The Pi's control_port
+            on_state: Called as on_state(bitmaps, version, relays_per_hat, boot_id)
+                      for every STATE event taken, from the reader thread
+            connect_timeout: Seconds to wait for each connection attempt
+            max_backoff: Longest wait between connection attempts
+        """
+        self.host = host
+        self.port = port
+        self.on_state = on_state
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.state_version = None
+        self.connects = 0
+        self._sock = None
+        self._send_lock = Lock()
+        self._pending = {}  # frame id -> [Event, (type, payload, received_at) or None]
+        self._pending_lock = Lock()
+        self._ids = itertools.count(1)
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def start(self):
+        """Start connecting in the background (idempotent)"""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True, name=f'channel-{self.host}:{self.port}')
+            self._thread.start()
+
+    def close(self):
+        """Disconnect and stop reconnecting"""
+        self._stop.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def set_relay(self, hat, relay, state, timeout):
+        """
+        Set one relay over the channel.
+
+        Args:
+            hat: HAT number (0-based)
+            relay: Relay number (1-based)
+            state: 0 or 1
+            timeout: Seconds to wait for the ack; also sent as the command's deadline
+
+        Returns:
+            tuple: (whether the relay changed, time.monotonic() when the ack
+            was read, which orders it against STATE events)
+
+        Raises:
+            ChannelCommandError: If the Pi rejected the command
+            ChannelError: If the channel is down or the ack did not arrive in time
+        """
+        payload = SET_PAYLOAD.pack(hat, relay, state, max(1, int(timeout * 1000)))
+        frame_type, reply, received_at = self._request(SET, payload, timeout)
+        if frame_type == ERROR:
+            (status_code,) = ERROR_STATUS.unpack_from(reply)
+            raise ChannelCommandError(status_code, reply[ERROR_STATUS.size:].decode(errors='replace'))
+        return bool(ACK_PAYLOAD.unpack(reply)[1]), received_at
+
+    def _request(self, frame_type, payload, timeout):
+        sock = self._sock
+        if sock is None:
+            raise ChannelError(f'Control channel to {self.host}:{self.port} is not connected')
+        frame_id = next(self._ids) % 0xFFFFFFFF + 1  # Never 0, which STATE events use
+        slot = [Event(), None]
+        with self._pending_lock:
+            self._pending[frame_id] = slot
+        try:
+            with self._send_lock:
+                sock.sendall(encode_frame(frame_type, frame_id, payload))
+        except OSError as e:
+            with self._pending_lock:
+                self._pending.pop(frame_id, None)
+            raise ChannelError(f'Could not send to {self.host}:{self.port}: {e}')
+
+        if not slot[0].wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(frame_id, None)
+            raise ChannelError(f'No answer from {self.host}:{self.port} within {timeout:.3g}s')
+        if slot[1] is None:
+            raise ChannelError(f'Control channel to {self.host}:{self.port} was lost')
+        return slot[1]
+
+    def _run(self):
+        backoff = 0.1
+        while not self._stop.is_set():
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+            except OSError:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = 0.1
+            sock.settimeout(None)
+            _tune_socket(sock)
+            self._sock = sock
+            self.connects += 1
+            try:
+                self._read_loop(sock)
+            except OSError:
+                pass
+            finally:
+                self._sock = None
+                sock.close()
+                self._fail_pending()
+
+    def _read_loop(self, sock):
+        last_version = None  # The first STATE on a connection is always taken
+        while True:
+            frame = read_frame(sock)
+            if frame is None:
+                return
+            received_at = time.monotonic()
+            frame_type, frame_id, payload = frame
+            if frame_type == STATE:
+                bitmaps, version, relays_per_hat, boot_id = decode_state(payload)
+                if last_version is not None and version <= last_version:
+                    continue
+                last_version = self.state_version = version
+                if self.on_state is not None:
+                    try:
+                        self.on_state(bitmaps, version, relays_per_hat, boot_id)
+                    except Exception as e:
+                        print(f"Error handling state from {self.host}:{self.port}: {e}")
+                continue
+            with self._pending_lock:
+                slot = self._pending.pop(frame_id, None)
+            if slot is not None:
+                slot[1] = (frame_type, payload, received_at)
+                slot[0].set()
+
+    def _fail_pending(self):
+        """Wake every command still waiting; they see the connection as lost"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for event, _ in pending.values():
+            event.set()
+
+
+class ChannelPool:
+    """
+    Control channels to every Pi with a control_port, keyed by Pi URL.
+
+    Nothing connects until enable() is called, so building the pool has no
+    side effects; sync() then follows config reloads.
+    """
+
+    def __init__(self, on_state=None, connect_timeout=1.0):
+        """
+        Args:
+            on_state: Called as on_state(pi_url, bitmaps, version, relays_per_hat, boot_id)
+            connect_timeout: Passed to every ChannelClient
+        """
+        self.on_state = on_state
+        self.connect_timeout = connect_timeout
+        self.enabled = False
+        self._clients = {}  # pi_url -> ChannelClient
+        self._lock = Lock()
+
+    def enable(self, endpoints):
+        """Start connecting to endpoints, and follow later sync() calls"""
+        self.enabled = True
+        self.sync(endpoints)
+
+    def sync(self, endpoints):
+        """
+        Connect to new endpoints and close channels to ones no longer listed.
+
+        Args:
+            endpoints: {pi_url: (host, control_port)}
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            for pi_url, client in list(self._clients.items()):
+                if endpoints.get(pi_url) != (client.host, client.port):
+                    client.close()
+                    del self._clients[pi_url]
+            for pi_url, (host, port) in endpoints.items():
+                if pi_url not in self._clients:
+                    on_state = None
+                    if self.on_state is not None:
+                        on_state = lambda *state, pi_url=pi_url: self.on_state(pi_url, *state)
+                    client = ChannelClient(host, port, on_state, self.connect_timeout)
+                    client.start()
+                    self._clients[pi_url] = client
+
+    def get(self, pi_url):
+        """The connected channel to a Pi, or None if it has none or it is down"""
+        client = self._clients.get(pi_url)
+        if client is None or not client.connected:
+            return None
+        return client
+
+    def clients(self):
+        """{pi_url: ChannelClient} for every configured channel"""
+        return dict(self._clients)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
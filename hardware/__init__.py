@@ -1,11 +1,27 @@
-from flask import Flask, jsonify, request, render_template
-import lib8relind as relay
+from flask import Flask, jsonify, request, render_template, Response
 import yaml
 import os
+import queue
+import re
+import struct
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
+from threading import Lock, Event, Thread
+from channel import ChannelServer
+from telemetry import (
+    install_tracing, SlowRequestLog, current_trace,
+    MetricsRegistry, install_metrics, PROMETHEUS_CONTENT_TYPE,
+    install_deadlines, time_remaining, deadline_exceeded
+)
 
 # Configuration for RPi with HATs with 8 relays per HAT.
 
+# Set CASM_CONFIG to load another config file, and CASM_PI_ID to pick this
+# Pi's section by name instead of by IP address (e.g. for benchmarks)
+CONFIG_PATH = Path(os.environ.get('CASM_CONFIG', Path(__file__).parent.parent / 'main_config.yaml'))
+
 # Load configuration from YAML file
 def get_ip_address():
     """Get this Pi's IP address"""
@@ -31,13 +47,60 @@ def get_ip_address():
             pass
     return None
 
-def load_config():
+def find_config_by_ip(raspberry_pis):
+    """
+    Find this Pi's section of raspberry_pis by matching its IP address.
+    
+    Returns:
+        tuple: (pi_config copy, pi_id)
+    """
+    # Get this Pi's IP address
+    my_ip = get_ip_address()
+    if not my_ip:
+        raise RuntimeError(
+            "\nERROR: Could not detect this Pi's IP address\n\n"
+            "Make sure the Pi has a network connection.\n"
+            "You can manually check with: hostname -I"
+        )
+    
+    print(f"Detected this Pi's IP address: {my_ip}")
+    
+    # Find this Pi's configuration by matching IP address
+    my_config = None
+    my_pi_id = None
+    
+    for pi_id, pi_config in raspberry_pis.items():
+        if pi_config.get('ip_address') == my_ip:
+            my_config = pi_config.copy()
+            my_pi_id = pi_id
+            break
+    
+    if not my_config:
+        # Show available IPs to help with debugging
+        available_ips = [cfg.get('ip_address') for cfg in raspberry_pis.values()]
+        raise RuntimeError(
+            f"\nERROR: This Pi's IP ({my_ip}) not found in main_config.yaml\n\n"
+            f"Available Pi IPs in config: {available_ips}\n\n"
+            f"Either:\n"
+            f"  1. Update main_config.yaml to include this Pi's IP\n"
+            f"  2. Set this Pi's static IP to match one in main_config.yaml\n\n"
+            f"See README.md for setup instructions."
+        )
+    
+    return my_config, my_pi_id
+
+def load_config(config_path=CONFIG_PATH, pi_id=None):
     """
     Load configuration from main_config.yaml and auto detect this Pi's section.
     
     This Pi identifies itself by IP address, finds its entry in main_config.yaml,
     and extracts its specific configuration (hardware specs, switch mappings, etc.)
     
+    Args:
+        config_path: Path to main_config.yaml
+        pi_id: Use this Pi's section instead of detecting it by IP address
+               (default: the CASM_PI_ID environment variable, if set)
+    
     Returns:
         dict: This Pi's configuration section with keys:
             - pi_id: str
@@ -53,8 +116,7 @@ def load_config():
         ValueError: If required fields are missing
         RuntimeError: If Pi's IP not found in config
     """
-    repo_root = Path(__file__).parent.parent
-    main_config_path = repo_root / 'main_config.yaml'
+    main_config_path = Path(config_path)
     
     # Check if main_config.yaml exists
     if not main_config_path.exists():
@@ -76,43 +138,27 @@ def load_config():
             f"Check that the file is valid YAML format."
         )
     
-    # Get this Pi's IP address
-    my_ip = get_ip_address()
-    if not my_ip:
-        raise RuntimeError(
-            "\nERROR: Could not detect this Pi's IP address\n\n"
-            "Make sure the Pi has a network connection.\n"
-            "You can manually check with: hostname -I"
-        )
-    
-    print(f"Detected this Pi's IP address: {my_ip}")
-    
-    # Find this Pi's configuration by matching IP address
     raspberry_pis = main_config.get('raspberry_pis', {})
-    my_config = None
-    my_pi_id = None
+    pi_id = pi_id or os.environ.get('CASM_PI_ID')
     
-    for pi_id, pi_config in raspberry_pis.items():
-        if pi_config.get('ip_address') == my_ip:
-            my_config = pi_config.copy()
-            my_pi_id = pi_id
-            break
-    
-    if not my_config:
-        # Show available IPs to help with debugging
-        available_ips = [cfg.get('ip_address') for cfg in raspberry_pis.values()]
-        raise RuntimeError(
-            f"\nERROR: This Pi's IP ({my_ip}) not found in main_config.yaml\n\n"
-            f"Available Pi IPs in config: {available_ips}\n\n"
-            f"Either:\n"
-            f"  1. Update main_config.yaml to include this Pi's IP\n"
-            f"  2. Set this Pi's static IP to match one in main_config.yaml\n\n"
-            f"See README.md for setup instructions."
-        )
+    if pi_id:
+        # Section chosen explicitly, no IP detection
+        if pi_id not in raspberry_pis:
+            raise RuntimeError(
+                f"\nERROR: Pi '{pi_id}' not found in {main_config_path}\n\n"
+                f"Available Pis in config: {list(raspberry_pis)}"
+            )
+        my_config = raspberry_pis[pi_id].copy()
+        my_pi_id = pi_id
+    else:
+        my_config, my_pi_id = find_config_by_ip(raspberry_pis)
     
     # Add pi_id to the config
     my_config['pi_id'] = my_pi_id
     
+    # Serving settings: the shared server.pi section unless this Pi has its own
+    my_config.setdefault('server', (main_config.get('server') or {}).get('pi', {}))
+    
     # Validate required fields
     required_fields = ['num_relay_hats', 'relays_per_hat', 'switch_mapping']
     missing_fields = [field for field in required_fields if field not in my_config]
@@ -138,10 +184,39 @@ def load_config():
 CONFIG = load_config()
 NUM_HATS = CONFIG['num_relay_hats']
 RELAYS_PER_HAT = CONFIG['relays_per_hat']
+ALL_RELAYS_ON = (1 << RELAYS_PER_HAT) - 1  # HAT bitmap with every relay on
 PI_ID = CONFIG['pi_id']
 
 
 
+SWITCH_NAME_PATTERN = re.compile(r'^CH(\d+)([A-Z]*)$')
+
+
+def parse_switch_name(switch_name):
+    """
+    Split a switch name into its chassis number and SNAP suffix.
+    
+    Args:
+        switch_name: e.g. 'CH1' (chassis power), 'CH2F', 'CH12AB'
+    
+    Returns:
+        tuple: (chassis_num, suffix) e.g. (2, 'F'), or None if not a CH<n> name
+    """
+    match = SWITCH_NAME_PATTERN.match(switch_name.upper())
+    if match is None:
+        return None
+    return int(match.group(1)), match.group(2)
+
+
+def switch_sort_key(switch_name):
+    """Sort key ordering switches by chassis number, then CH<n>, CH<n>A..Z, CH<n>AA.."""
+    parsed = parse_switch_name(switch_name)
+    if parsed is None:
+        return (float('inf'), 0, switch_name)
+    chassis_num, suffix = parsed
+    return (chassis_num, len(suffix), suffix)
+
+
 class SwitchMapper:
     """
     Maps switch names to relay HAT positions using YAML configuration.
@@ -168,6 +243,7 @@ class SwitchMapper:
         self._switch_to_relay = {}
         self._relay_to_switch = {}
         self._build_mapping_from_yaml(switch_mapping_config)
+        self._build_indexes()
     
     def _build_mapping_from_yaml(self, switch_mapping_config):
         """
@@ -214,6 +290,16 @@ class SwitchMapper:
         
         print(f"Loaded {len(self._switch_to_relay)} switch mappings from YAML config")
     
+    def _build_indexes(self):
+        """Precompute the sorted switch list and per-chassis switch lists"""
+        self._all_switches = tuple(sorted(self._switch_to_relay, key=switch_sort_key))
+        chassis_to_switches = {}
+        for switch_name in self._all_switches:
+            parsed = parse_switch_name(switch_name)
+            if parsed is not None:
+                chassis_to_switches.setdefault(parsed[0], []).append(switch_name)
+        self._chassis_to_switches = {num: tuple(names) for num, names in chassis_to_switches.items()}
+    
     def get_relay_position(self, switch_name):
         """
         Convert switch name to (hat, relay) position.
@@ -244,8 +330,16 @@ class SwitchMapper:
         return self._relay_to_switch.get((hat, relay))
     
     def get_all_switches(self):
-        """Get sorted list of all valid switch names"""
-        return sorted(self._switch_to_relay.keys())
+        """Get all valid switch names, sorted by chassis"""
+        return self._all_switches
+    
+    def get_chassis_switches(self, chassis_num):
+        """Get the switch names of a chassis (CH<n> first, then its SNAPs), or () if none"""
+        return self._chassis_to_switches.get(chassis_num, ())
+    
+    def get_all_chassis(self):
+        """Get the chassis numbers that have switches mapped on this Pi"""
+        return sorted(self._chassis_to_switches)
     
     def is_valid_switch(self, switch_name):
         """Check if a switch name is valid"""
@@ -256,33 +350,884 @@ class SwitchMapper:
 # Pi auto-detects its section based on IP address
 switch_mapper = SwitchMapper(switch_mapping_config=CONFIG.get('switch_mapping', {}))
 
+# Relay library, imported on first use so this module loads without the
+# hardware attached; set_relay_backend() substitutes another implementation
+relay = None
+
+
+def relay_backend():
+    """Get the relay library (lib8relind unless set_relay_backend() was called)"""
+    global relay
+    if relay is None:
+        import lib8relind
+        relay = lib8relind
+    return relay
+
+
+def set_relay_backend(backend):
+    """
+    Route relay calls to backend instead of lib8relind.
+    
+    Args:
+        backend: Object with lib8relind's get, set, get_all and set_all functions
+    """
+    global relay
+    relay = backend
+    hat_bitmaps.clear()
+    hat_bitmaps_read_at.clear()
+
+
+# The I2C bus is shared by all HATs; serialize access from request threads
+bus_lock = Lock()
+
+# Last known relay bitmap per HAT (bit N-1 = relay N), kept in step with
+# every bus read and write. Used to skip writes whose target state already holds.
+hat_bitmaps = {}
+
+# When each HAT's whole bitmap was last read or written (time.monotonic()).
+# A HAT that resets or is switched by another process changes without a bus
+# call from us, so a bitmap older than bitmap_ttl seconds is read again
+# before it is used.
+hat_bitmaps_read_at = {}
+BITMAP_TTL = CONFIG.get('bitmap_ttl', 5)
+
+# Bumped whenever a known bitmap changes; sent with /api/status so the main
+# server can tell whether the states it holds are current. The version starts
+# from 0 in every run of the server, which BOOT_ID tells apart.
+state_version = 0
+BOOT_ID = uuid.uuid4().hex[:16]
+WRITE_ELISION = CONFIG.get('write_elision', True)
+
+# Times an emergency all-off writes a HAT that does not read back as all-off
+EMERGENCY_ATTEMPTS = CONFIG.get('emergency_attempts', 3)
+
+# Seconds an emergency all-off waits for a bus call already in progress;
+# HATs it could not reach in that time are reported as unconfirmed
+EMERGENCY_BUS_WAIT = CONFIG.get('emergency_bus_wait', 0.5)
+
+# Single-relay writes to the same HAT arriving within this many ms of the
+# first are merged into one bitmap write (0 disables, see WriteCoalescer)
+WRITE_COALESCE_MS = CONFIG.get('write_coalesce_ms', 0)
+
+# On-disk journal of the desired relay states (CASM_STATE_JOURNAL overrides
+# the path, unset disables it); with restore_relay_state the journaled states
+# are written back to the HATs when the app starts
+STATE_JOURNAL_PATH = os.environ.get('CASM_STATE_JOURNAL', CONFIG.get('state_journal'))
+RESTORE_RELAY_STATE = CONFIG.get('restore_relay_state', False)
+
+# Port for the main server's persistent control channel (unset disables it)
+CONTROL_PORT = CONFIG.get('control_port')
+
+# Commands slower than this (ms) are kept in a ring buffer at /api/trace/slow
+slow_request_log = SlowRequestLog(
+    threshold_ms=CONFIG.get('slow_request_ms', 250),
+    size=CONFIG.get('slow_request_log_size', 200)
+)
+
+# Prometheus metrics served at /metrics
+metrics = MetricsRegistry()
+i2c_duration = metrics.histogram(
+    'casm_pi_i2c_call_duration_seconds',
+    'Latency of relay library calls on the I2C bus', ('hat', 'op'),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+)
+i2c_errors = metrics.counter(
+    'casm_pi_i2c_errors_total',
+    'Failed relay library calls by error class', ('hat', 'op', 'error_class')
+)
+bus_wait_duration = metrics.histogram(
+    'casm_pi_bus_wait_seconds',
+    'Time spent waiting for the I2C bus lock'
+)
+coalesced_batches = metrics.counter(
+    'casm_pi_coalesced_write_batches_total',
+    'Batches of merged single-relay writes applied to a HAT', ('hat',)
+)
+coalesced_writes = metrics.counter(
+    'casm_pi_coalesced_writes_total',
+    'Single-relay writes applied as part of a merged batch', ('hat',)
+)
+metrics.register_collector(lambda: [
+    ('casm_pi_slow_requests', 'gauge', 'Entries in the slow request ring buffer',
+     [({}, len(slow_request_log))])
+])
+
+
+class RelayStateJournal:
+    """
+    On-disk journal of the desired relay bitmap of each HAT.
+    
+    Every relay write that succeeds on the bus is appended as a fixed-size
+    record: the HAT, a mask of the relays written and their new states.
+    record() only queues the record, so the bus is never held for disk I/O.
+    A background thread appends what is queued and fsyncs once per batch.
+    When the file holds more than compact_records records it is rewritten
+    with one record per HAT. A torn record at the end of the file (power
+    lost mid-append) is ignored when loading.
+    """
+    
+    RECORD = struct.Struct('<BHHB')  # hat, mask, bits, checksum
+    
+    def __init__(self, path, sync_interval=0.05, compact_records=4096):
+        """
+        Args:
+            path: Journal file, created if missing
+            sync_interval: Seconds to wait for more records before each fsync
+            compact_records: Records in the file that trigger a compaction
+        """
+        self.path = Path(path)
+        self.sync_interval = sync_interval
+        self.compact_records = compact_records
+        self._desired = {}  # hat -> (mask, bits), including queued records
+        self._desired_lock = Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = Lock()
+        self._file = None
+        self._records = 0
+        self.written = 0
+        self.compactions = 0
+    
+    @staticmethod
+    def _checksum(hat, mask, bits):
+        return (hat + mask + (mask >> 8) + bits + (bits >> 8)) & 0xFF ^ 0x5A
+    
+    def start(self):
+        """Load and compact the journal, then start the writer thread (idempotent)"""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._load()
+            self._compact()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+    
+    def _load(self):
+        """Rebuild the desired bitmaps from the records in the file"""
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return
+        
+        valid = 0
+        for hat, mask, bits, checksum in self.RECORD.iter_unpack(data[:len(data) - len(data) % self.RECORD.size]):
+            if checksum != self._checksum(hat, mask, bits):
+                break
+            self._apply(hat, mask, bits)
+            valid += 1
+        if valid * self.RECORD.size != len(data):
+            print(f"Relay state journal {self.path}: ignoring {len(data) - valid * self.RECORD.size} bytes after record {valid}")
+    
+    def _apply(self, hat, mask, bits):
+        with self._desired_lock:
+            known, current = self._desired.get(hat, (0, 0))
+            self._desired[hat] = (known | mask, (current & ~mask) | (bits & mask))
+    
+    def record(self, hat, mask, bits):
+        """
+        Queue a relay write for the journal without blocking.
+        
+        Args:
+            hat: HAT number (0-based)
+            mask: Relays written (bit N-1 = relay N)
+            bits: Their new states
+        """
+        self._apply(hat, mask, bits)
+        self._queue.put((hat, mask, bits & mask))
+    
+    def desired(self):
+        """
+        Get the desired state of every journaled HAT.
+        
+        Returns:
+            dict: {hat: (mask of relays with a known state, their states)}
+        """
+        with self._desired_lock:
+            return dict(self._desired)
+    
+    def flush(self, timeout=5):
+        """Block until everything queued so far is on disk (or timeout)"""
+        if self._thread is None:
+            return True
+        done = Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+    
+    def pending(self):
+        """Number of records waiting to be written"""
+        return self._queue.qsize()
+    
+    def _pack(self, hat, mask, bits):
+        return self.RECORD.pack(hat, mask, bits, self._checksum(hat, mask, bits))
+    
+    def _compact(self):
+        """Rewrite the file as one record per HAT, replacing it atomically"""
+        if self._file is not None:
+            self._file.close()
+        desired = self.desired()
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(self._pack(hat, mask, bits) for hat, (mask, bits) in sorted(desired.items())))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            dir_fd = os.open(self.path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self._records = len(desired)
+            self.compactions += 1
+        finally:
+            # Keep appending to whichever file is in place
+            self._file = open(self.path, 'ab')
+    
+    def _run(self):
+        while True:
+            batch, markers = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.sync_interval
+            while True:
+                if isinstance(item, Event):
+                    markers.append(item)
+                    break  # Flush requested: write what we have now
+                batch.append(item)
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            
+            if batch:
+                try:
+                    self._file.write(b''.join(self._pack(*record) for record in batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self.written += len(batch)
+                    self._records += len(batch)
+                    if self._records > self.compact_records:
+                        self._compact()
+                except Exception as e:
+                    print(f"Error writing relay state journal {self.path} ({len(batch)} records): {e}")
+            for marker in markers:
+                marker.set()
+
+
+state_journal = RelayStateJournal(STATE_JOURNAL_PATH) if STATE_JOURNAL_PATH else None
+if state_journal is not None:
+    metrics.register_collector(lambda: [
+        ('casm_pi_state_journal_written_total', 'counter', 'Records appended to the relay state journal',
+         [({}, state_journal.written)]),
+        ('casm_pi_state_journal_compactions_total', 'counter', 'Rewrites of the relay state journal',
+         [({}, state_journal.compactions)]),
+        ('casm_pi_state_journal_pending', 'gauge', 'Records waiting to be written to the relay state journal',
+         [({}, state_journal.pending())]),
+    ])
+
+
+# Emergency all-offs running right now, and started since the server did
+# (see check_emergency)
+emergencies_running = 0
+emergencies_started = 0
+emergency_lock = Lock()
+
+
+class EmergencyInProgress(RuntimeError):
+    """A relay write was dropped because an emergency all-off overtook it"""
+
+
+def check_emergency(started_before=None):
+    """
+    Refuse a relay write while an emergency all-off runs, or once one has overtaken it.
+    
+    Args:
+        started_before: emergencies_started when the write arrived; a write
+                        still queued when an all-off starts must not undo it
+    
+    Raises:
+        EmergencyInProgress: If the write must not go ahead
+    """
+    if emergencies_running or (started_before is not None and started_before != emergencies_started):
+        raise EmergencyInProgress('Emergency all-off in progress')
+
+
+@contextmanager
+def bus_access(timeout=None):
+    """
+    Hold the I2C bus for the enclosed block.
+    
+    Time spent waiting for the bus is recorded as the 'bus_wait' phase of
+    the current request. If the caller sent a deadline, the wait gives up
+    when it passes instead of queueing work nobody is waiting for.
+    
+    Args:
+        timeout: Most seconds to wait for the bus (default: until the deadline)
+    
+    Raises:
+        DeadlineExceeded: If the request's deadline passed before the bus was free
+        TimeoutError: If the bus was not free within timeout
+    """
+    queued = time.perf_counter()
+    remaining = time_remaining()
+    if remaining is not None and (timeout is None or remaining <= timeout):
+        if remaining <= 0 or not bus_lock.acquire(timeout=remaining):
+            raise deadline_exceeded('Deadline exceeded while waiting for the I2C bus')
+    elif not bus_lock.acquire(timeout=-1 if timeout is None else timeout):
+        raise TimeoutError('I2C bus busy')
+    
+    try:
+        waited = time.perf_counter() - queued
+        bus_wait_duration.observe(waited)
+        trace = current_trace()
+        if trace is not None:
+            trace.add('bus_wait', waited * 1000)
+        yield
+    finally:
+        bus_lock.release()
+
+
+def _relay_io(op, hat, *args):
+    """
+    Run one relay library call. The caller must hold the bus (see bus_access).
+    
+    The call is recorded as the 'i2c' phase of the current request, and the
+    known bitmap of the HAT is kept in step with what was read or written.
+    """
+    global state_version
+    started = time.perf_counter()
+    try:
+        result = getattr(relay_backend(), op)(hat, *args)
+    except Exception as e:
+        i2c_errors.inc(hat, op, type(e).__name__)
+        if op in ('set', 'set_all') and hat_bitmaps.pop(hat, None) is not None:
+            hat_bitmaps_read_at.pop(hat, None)
+            state_version += 1  # Outcome unknown, re-read before eliding
+        raise
+    finally:
+        finished = time.perf_counter()
+        i2c_duration.observe(finished - started, hat, op)
+        trace = current_trace()
+        if trace is not None:
+            trace.add('i2c', (finished - started) * 1000)
+    
+    if state_journal is not None:
+        if op == 'set_all':
+            state_journal.record(hat, ALL_RELAYS_ON, args[0])
+        elif op == 'set':
+            mask = 1 << (args[0] - 1)
+            state_journal.record(hat, mask, mask if args[1] else 0)
+    
+    before = hat_bitmaps.get(hat)
+    if op == 'get_all':
+        hat_bitmaps[hat] = result
+        hat_bitmaps_read_at[hat] = time.monotonic()
+    elif op == 'set_all':
+        hat_bitmaps[hat] = args[0]
+        hat_bitmaps_read_at[hat] = time.monotonic()
+    elif hat in hat_bitmaps:
+        relay_num, state = args[0], (result if op == 'get' else args[1])
+        mask = 1 << (relay_num - 1)
+        hat_bitmaps[hat] = (hat_bitmaps[hat] | mask) if state else (hat_bitmaps[hat] & ~mask)
+    if hat_bitmaps.get(hat) != before:
+        state_version += 1
+        if control_server is not None:
+            control_server.notify()
+    return result
+
+
+def fresh_bitmap(hat):
+    """
+    Get the known bitmap of a HAT if it was read or written within bitmap_ttl.
+    
+    Returns:
+        int: Relay bitmap, or None if unknown or too old to trust
+    """
+    bitmap = hat_bitmaps.get(hat)
+    if bitmap is None or time.monotonic() - hat_bitmaps_read_at.get(hat, 0) > BITMAP_TTL:
+        return None
+    return bitmap
+
+
+def bus_call(op, hat, *args):
+    """
+    Run one relay library call on the I2C bus.
+    
+    Args:
+        op: lib8relind function name ('get', 'set', 'get_all', 'set_all')
+        hat: HAT number (0-based)
+        *args: Remaining arguments for the library call
+    
+    Returns:
+        Whatever the library call returns
+    """
+    with bus_access():
+        return _relay_io(op, hat, *args)
+
+
+def write_relay(hat, relay_num, state):
+    """
+    Set one relay, skipping the bus write if the relay already holds the state.
+    
+    With write_coalesce_ms set, the write may be merged with concurrent
+    writes to the same HAT (see WriteCoalescer).
+    
+    Args:
+        hat: HAT number (0-based)
+        relay_num: Relay number (1-based)
+        state: 0 (OFF) or 1 (ON)
+    
+    Returns:
+        bool: True if the relay was written, False if the write was elided
+    
+    Raises:
+        EmergencyInProgress: If an emergency all-off is running or started
+                             while the write was queued
+    """
+    started_before = emergencies_started
+    check_emergency()
+    if write_coalescer is not None:
+        return write_coalescer.write(hat, relay_num, state, started_before)
+    return write_relay_now(hat, relay_num, state, started_before)
+
+
+def write_relay_now(hat, relay_num, state, started_before=None):
+    """Set one relay right away (write_relay without coalescing)"""
+    with bus_access():
+        check_emergency(started_before)
+        return _set_relay(hat, relay_num, state)
+
+
+def _set_relay(hat, relay_num, state):
+    """Set one relay unless elision finds it already holds the state. The caller must hold the bus."""
+    if WRITE_ELISION:
+        bitmap = fresh_bitmap(hat)
+        if bitmap is None:
+            bitmap = _relay_io('get_all', hat)
+        if (bitmap >> (relay_num - 1)) & 1 == state:
+            return False
+    _relay_io('set', hat, relay_num, state)
+    return True
+
+
+class WriteCoalescer:
+    """
+    Merges single-relay writes to the same HAT that arrive close together.
+    
+    The first write for a HAT opens a window; writes for that HAT arriving
+    before it closes join its batch. The thread that opened the window then
+    applies the batch with one get_all and at most one set_all (in arrival
+    order, so the last write to a relay wins), and every caller gets its own
+    result. A batch of one is written as a plain single-relay write.
+    
+    No caller waits past its deadline: the window closes early for an opener
+    with less than two windows left, and a joiner whose deadline passes
+    before the batch reaches the bus leaves it.
+    """
+    
+    def __init__(self, window):
+        """
+        Args:
+            window: Seconds a batch stays open after its first write
+        """
+        self.window = window
+        self._lock = Lock()
+        self._open = {}  # hat -> writes in the batch being collected
+    
+    def write(self, hat, relay_num, state, started_before=None):
+        """
+        Set one relay as part of the HAT's current batch.
+        
+        Args:
+            started_before: emergencies_started when the write arrived (see check_emergency)
+        
+        Returns:
+            bool: True if this write changed the relay, as for write_relay_now()
+        
+        Raises:
+            DeadlineExceeded: If the request's deadline passed before the write reached the bus
+            Whatever applying the batch raised, in every caller of the batch
+        """
+        queued = time.perf_counter()
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise deadline_exceeded('Deadline exceeded before the relay write was queued')
+        entry = {'relay': relay_num, 'state': state, 'started_before': started_before,
+                 'done': Event(), 'changed': None, 'error': None, 'taken': False, 'abandoned': False}
+        with self._lock:
+            batch = self._open.get(hat)
+            opened = batch is None
+            if opened:
+                batch = self._open[hat] = []
+            batch.append(entry)
+        
+        if opened:
+            # Close early for a caller in a hurry, leaving half its time for the bus
+            time.sleep(self.window if remaining is None else min(self.window, remaining / 2))
+            with self._lock:
+                batch = self._open.pop(hat)
+            self._apply(hat, batch)
+        elif not entry['done'].wait(remaining):
+            with self._lock:
+                entry['abandoned'] = not entry['taken']
+            if entry['abandoned']:
+                raise deadline_exceeded('Deadline exceeded while waiting for a coalesced relay write')
+            entry['done'].wait()  # Already on the bus: one I2C transaction away
+        
+        trace = current_trace()
+        if trace is not None:
+            trace.add('coalesce', (time.perf_counter() - queued) * 1000)
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['changed']
+    
+    def _apply(self, hat, batch):
+        """Write a closed batch to the HAT and hand each caller its result"""
+        try:
+            with bus_access():
+                with self._lock:
+                    batch = [entry for entry in batch if not entry['abandoned']]
+                    for entry in batch:
+                        entry['taken'] = True
+                # The first write arrived first; an all-off since then overtakes the whole batch
+                check_emergency(batch[0]['started_before'])
+                if len(batch) == 1:
+                    batch[0]['changed'] = _set_relay(hat, batch[0]['relay'], batch[0]['state'])
+                    return
+                
+                # set_all also rewrites the relays nobody asked to change, so
+                # read them from the bus rather than trust the known bitmap:
+                # a HAT reset within bitmap_ttl would otherwise be undone
+                before = _relay_io('get_all', hat)
+                bitmap = before
+                for entry in batch:
+                    mask = 1 << (entry['relay'] - 1)
+                    entry['changed'] = not WRITE_ELISION or bool(bitmap & mask) != bool(entry['state'])
+                    bitmap = (bitmap | mask) if entry['state'] else (bitmap & ~mask)
+                if bitmap != before or not WRITE_ELISION:
+                    _relay_io('set_all', hat, bitmap)
+            coalesced_batches.inc(hat)
+            coalesced_writes.inc(hat, amount=len(batch))
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = e
+        finally:
+            for entry in batch:
+                entry['done'].set()
+
+
+write_coalescer = WriteCoalescer(WRITE_COALESCE_MS / 1000) if WRITE_COALESCE_MS > 0 else None
+
+
+def write_hat(hat, bitmap):
+    """
+    Set all relays of a HAT, skipping the bus write if the HAT already holds the bitmap.
+    
+    Args:
+        hat: HAT number (0-based)
+        bitmap: Relay bitmap (bit 0 is relay 1)
+    
+    Returns:
+        bool: True if the HAT was written, False if the write was elided
+    
+    Raises:
+        EmergencyInProgress: As for write_relay()
+    """
+    started_before = emergencies_started
+    check_emergency()
+    with bus_access():
+        check_emergency(started_before)
+        if WRITE_ELISION:
+            current = fresh_bitmap(hat)
+            if current is None:
+                current = _relay_io('get_all', hat)
+            if current == bitmap:
+                return False
+        _relay_io('set_all', hat, bitmap)
+        return True
+
+
+def emergency_all_off(attempts=EMERGENCY_ATTEMPTS, bus_wait=None):
+    """
+    Turn every relay on every HAT off and confirm it by reading each HAT back.
+    
+    Unlike write_hat(), nothing is skipped on the strength of the known
+    bitmaps: every HAT is written and then read back from the bus, and HATs
+    that do not read back as all-off are written again. The bus is held for
+    the whole sequence, so no queued request can interleave with it.
+    
+    Relay writes queued for the bus (or in a coalescing window) are dropped
+    with EmergencyInProgress rather than served first, so the wait for the
+    bus is at most one call already in progress, bounded by bus_wait.
+    
+    Args:
+        attempts: Maximum write + readback rounds
+        bus_wait: Seconds to wait for the bus (default: emergency_bus_wait)
+    
+    Returns:
+        tuple: (HATs confirmed off, {hat: reason} for HATs that are not, rounds made)
+    """
+    global emergencies_running, emergencies_started
+    with emergency_lock:
+        emergencies_running += 1
+        emergencies_started += 1
+    
+    pending = list(range(NUM_HATS))
+    reasons = {}
+    rounds = 0
+    try:
+        with bus_access(timeout=EMERGENCY_BUS_WAIT if bus_wait is None else bus_wait):
+            while pending and rounds < attempts:
+                rounds += 1
+                for hat in pending:
+                    try:
+                        _relay_io('set_all', hat, 0)
+                    except Exception as e:
+                        reasons[hat] = f'write failed: {e}'
+                
+                unconfirmed = []
+                for hat in pending:
+                    try:
+                        bitmap = _relay_io('get_all', hat)
+                    except Exception as e:
+                        reasons[hat] = f'readback failed: {e}'
+                        unconfirmed.append(hat)
+                        continue
+                    if bitmap == 0:
+                        reasons.pop(hat, None)
+                    else:
+                        reasons[hat] = f'read back {bitmap:#04x}'
+                        unconfirmed.append(hat)
+                pending = unconfirmed
+    except Exception as e:
+        # Bus busy or deadline passed: the HATs not yet confirmed were not reached
+        for hat in pending:
+            reasons.setdefault(hat, f'not reached: {e}')
+    finally:
+        with emergency_lock:
+            emergencies_running -= 1
+    
+    confirmed = [hat for hat in range(NUM_HATS) if hat not in pending]
+    return confirmed, {hat: reasons.get(hat) or 'not reached' for hat in pending}, rounds
+
+
+def read_hat_bitmaps(switch_names):
+    """
+    Read the relay bitmap of every HAT the given switches are on, one bus call per HAT.
+    
+    Args:
+        switch_names: Mapped switch names
+    
+    Returns:
+        dict: {hat: bitmap}, or {hat: Exception} for a HAT that could not be read
+    """
+    hats = sorted({switch_mapper.get_relay_position(name)[0] for name in switch_names})
+    bitmaps = {}
+    with bus_access():
+        for hat in hats:
+            try:
+                bitmaps[hat] = _relay_io('get_all', hat)
+            except Exception as e:
+                bitmaps[hat] = e
+    return bitmaps
+
+
+def status_static():
+    """
+    The parts of /api/status that only change with the config.
+    
+    Returns:
+        dict: pi_id, HAT and relay counts, and the sorted switch names
+    """
+    # Don't fail the heartbeat if the switch mapping is unusable
+    try:
+        switches = switch_mapper.get_all_switches()
+    except Exception:
+        switches = []
+    
+    return {
+        'status': 'online',
+        'pi_id': PI_ID,
+        'boot_id': BOOT_ID,
+        'num_relay_hats': NUM_HATS,
+        'relays_per_hat': RELAYS_PER_HAT,
+        'total_switches': len(switches),
+        'switches': switches
+    }
+
+
+def current_hat_bitmaps():
+    """
+    Get the bitmap of every HAT, reading only HATs whose bitmap is unknown or
+    older than bitmap_ttl. Each heartbeat thereby also notices HATs that
+    changed behind our back (e.g., a HAT reset).
+    
+    Returns:
+        tuple: ([bitmap or None per HAT], state version)
+    """
+    unknown = [hat for hat in range(NUM_HATS) if fresh_bitmap(hat) is None]
+    if unknown:
+        try:
+            with bus_access():
+                for hat in unknown:
+                    try:
+                        _relay_io('get_all', hat)
+                    except Exception:
+                        pass  # Reported as None, and counted in casm_pi_i2c_errors_total
+        except Exception:
+            pass  # Bus busy past the caller's deadline: report what is known
+    
+    return known_hat_bitmaps()
+
+
+def known_hat_bitmaps():
+    """
+    Get the known bitmap of every HAT, without touching the bus.
+    
+    Returns:
+        tuple: ([bitmap, or None if unknown or older than bitmap_ttl, per HAT], state version)
+    """
+    # Version first: the bitmaps are then at least as new as the version
+    version = state_version
+    return [fresh_bitmap(hat) for hat in range(NUM_HATS)], version
+
+
+def channel_set_relay(hat, relay_num, state):
+    """
+    Set one relay for a command received on the control channel.
+    
+    Returns:
+        bool: True if the relay was written, False if the write was elided
+    
+    Raises:
+        ValueError: If the HAT, relay or state is out of range
+    """
+    if hat >= NUM_HATS:
+        raise ValueError(f'Invalid HAT number. Must be 0-{NUM_HATS-1}')
+    if relay_num < 1 or relay_num > RELAYS_PER_HAT:
+        raise ValueError(f'Invalid relay number. Must be 1-{RELAYS_PER_HAT}')
+    if state not in (0, 1):
+        raise ValueError('State must be 0 or 1')
+    return write_relay(hat, relay_num, state)
+
+
+# Started by create_app() when control_port is set
+control_server = None
+
+
+def restore_relay_state():
+    """
+    Write the relay states in the relay state journal back to the HATs.
+    
+    Each journaled HAT gets one set_all. A HAT with relays the journal has
+    no state for (never written since the journal was started) is read
+    first, and those relays keep their current state.
+    
+    Returns:
+        dict: {hat: bitmap written}, or {hat: Exception} for a HAT that failed
+    """
+    restored = {}
+    with bus_access():
+        for hat, (mask, bits) in sorted(state_journal.desired().items()):
+            if hat >= NUM_HATS:
+                continue
+            try:
+                bitmap = bits
+                if mask & ALL_RELAYS_ON != ALL_RELAYS_ON:
+                    bitmap = (_relay_io('get_all', hat) & ~mask) | bits
+                _relay_io('set_all', hat, bitmap)
+                restored[hat] = bitmap
+            except Exception as e:
+                restored[hat] = e
+    return restored
+
+
+def shutdown(timeout=5):
+    """
+    Stop background work before the process exits.
+    
+    Closes the control channel and waits for queued records to be written
+    to the relay state journal.
+    
+    Args:
+        timeout: Seconds to wait for the relay state journal to be written
+    """
+    if control_server is not None:
+        control_server.stop()
+    if state_journal is not None and not state_journal.flush(timeout):
+        print(f"Relay state journal not written within {timeout}s, {state_journal.pending()} records lost")
+
 
 def create_app():
     app = Flask(__name__)
+    install_tracing(app, slow_request_log)
+    install_metrics(app, metrics, 'casm_pi')
+    install_deadlines(app)
+    
+    if state_journal is not None:
+        state_journal.start()
+        if RESTORE_RELAY_STATE:
+            started = time.perf_counter()
+            restored = restore_relay_state()
+            failed = {hat: error for hat, error in restored.items() if isinstance(error, Exception)}
+            print(f"Restored {len(restored) - len(failed)} HATs from {state_journal.path} "
+                  f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+            for hat, error in failed.items():
+                print(f"Could not restore HAT {hat}: {error}")
+    
+    global control_server
+    if CONTROL_PORT and control_server is None:
+        control_server = ChannelServer(
+            CONTROL_PORT, channel_set_relay, known_hat_bitmaps, RELAYS_PER_HAT,
+            workers=CONFIG['server'].get('threads', 4), boot_id=BOOT_ID
+        )
+        control_server.start()
+        metrics.register_collector(lambda: [
+            ('casm_pi_channel_connections', 'gauge', 'Clients connected to the control channel',
+             [({}, control_server.connections)]),
+            ('casm_pi_channel_commands_total', 'counter', 'Commands received on the control channel',
+             [({}, control_server.commands)]),
+        ])
+        print(f"Control channel listening on port {CONTROL_PORT}")
 
     @app.route('/')
     def index():
         """Render the web UI showing all relay states"""
         return render_template('index.html')
     
+    static_status = status_static()
+    
     @app.route('/api/status', methods=['GET'])
     def status_check():
-        """Status check endpoint for main server to monitor this Pi"""
-        # Try to get switch count from mapper, but don't fail if no mappings
-        try:
-            switch_count = len(switch_mapper.get_all_switches())
-            switches = switch_mapper.get_all_switches()
-        except:
-            switch_count = 0
-            switches = []
+        """
+        Status check endpoint for main server to monitor this Pi.
+        
+        Besides the static details, reports the bitmap of every HAT (bit N-1 =
+        relay N, null if it could not be read) and the state version, so each
+        heartbeat is also a full state sync.
+        """
+        bitmaps, version = current_hat_bitmaps()
+        return jsonify(dict(static_status, hat_bitmaps=bitmaps, state_version=version))
+    
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Prometheus metrics for this Pi"""
+        return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+    
+    @app.route('/api/trace/slow', methods=['GET'])
+    def slow_requests():
+        """
+        Get recently recorded slow commands, newest first.
         
+        Query params:
+            limit: Maximum number of entries to return (default: all kept)
+        """
+        limit = request.args.get('limit', type=int)
+        entries = slow_request_log.snapshot(limit)
         return jsonify({
-            'status': 'online',
-            'pi_id': PI_ID,
-            'num_relay_hats': NUM_HATS,
-            'relays_per_hat': RELAYS_PER_HAT,
-            'total_switches': switch_count,
-            'switches': switches
+            'threshold_ms': slow_request_log.threshold_ms,
+            'slow_requests': entries,
+            'count': len(entries)
         })
     
     @app.route('/api/relay/control', methods=['POST'])
@@ -310,15 +1255,15 @@ def create_app():
         if hat < 0 or hat >= NUM_HATS:
             return jsonify({'error': f'Invalid HAT number. Must be 0-{NUM_HATS-1}'}), 400
         
-        if relay_num < 1 or relay_num > 8:
-            return jsonify({'error': 'Invalid relay number. Must be 1-8'}), 400
+        if relay_num < 1 or relay_num > RELAYS_PER_HAT:
+            return jsonify({'error': f'Invalid relay number. Must be 1-{RELAYS_PER_HAT}'}), 400
         
         if state not in [0, 1]:
             return jsonify({'error': 'State must be 0 or 1'}), 400
         
         try:
             # Set relay state on hardware (relay_num is already 1-based, no conversion needed!)
-            relay.set(hat, relay_num, state)
+            changed = write_relay(hat, relay_num, state)
             
             return jsonify({
                 'success': True,
@@ -327,7 +1272,9 @@ def create_app():
                 'relay': relay_num,
                 'state': state,
                 'status': 'ON' if state == 1 else 'OFF',
-                'message': f'{switch_name} (HAT {hat}, Relay {relay_num}) turned {"ON" if state == 1 else "OFF"}'
+                'changed': changed,
+                'message': f'{switch_name} (HAT {hat}, Relay {relay_num}) '
+                           f'{"turned" if changed else "already"} {"ON" if state == 1 else "OFF"}'
             })
         except Exception as e:
             return jsonify({'error': f'Failed to set relay state: {str(e)}'}), 500
@@ -350,7 +1297,7 @@ def create_app():
         
         try:
             # Get relay state from hardware (returns 0 or 1)
-            state = relay.get(hat, relay_num)
+            state = bus_call('get', hat, relay_num)
             return jsonify({
                 'hat': hat,
                 'relay': relay_num,
@@ -389,14 +1336,15 @@ def create_app():
         
         try:
             # Set relay state on hardware
-            relay.set(hat, relay_num, new_state)
+            changed = write_relay(hat, relay_num, new_state)
             
             return jsonify({
                 'hat': hat,
                 'relay': relay_num,
                 'state': new_state,
                 'status': 'ON' if new_state == 1 else 'OFF',
-                'message': f'HAT {hat}, Relay {relay_num} turned {"ON" if new_state == 1 else "OFF"}'
+                'changed': changed,
+                'message': f'HAT {hat}, Relay {relay_num} {"turned" if changed else "already"} {"ON" if new_state == 1 else "OFF"}'
             })
         except Exception as e:
             return jsonify({'error': f'Failed to set relay state: {str(e)}'}), 500
@@ -409,7 +1357,7 @@ def create_app():
         for hat in range(NUM_HATS):
             try:
                 # Get all 8 relays as bitmap, then convert to list
-                bitmap = relay.get_all(hat)
+                bitmap = bus_call('get_all', hat)
                 relays = []
                 for relay_num in range(RELAYS_PER_HAT):
                     # Extract bit for each relay (LSB is relay 1)
@@ -432,7 +1380,7 @@ def create_app():
         
         try:
             # Get all 8 relays as bitmap, then convert to list
-            bitmap = relay.get_all(hat)
+            bitmap = bus_call('get_all', hat)
             relays = []
             for relay_num in range(RELAYS_PER_HAT):
                 # Extract bit for each relay (LSB is relay 1)
@@ -452,10 +1400,11 @@ def create_app():
             return jsonify({'error': f'Invalid HAT number. Must be 0-{NUM_HATS-1}'}), 400
         
         try:
-            relay.set_all(hat, 255)
+            changed = write_hat(hat, ALL_RELAYS_ON)
             return jsonify({
                 'hat': hat,
-                'message': f'All relays ON for HAT {hat}'
+                'changed': changed,
+                'message': f'All relays {"" if changed else "already "}ON for HAT {hat}'
             })
         except Exception as e:
             return jsonify({'error': f'Failed to turn on HAT {hat}: {str(e)}'}), 500
@@ -467,10 +1416,11 @@ def create_app():
             return jsonify({'error': f'Invalid HAT number. Must be 0-{NUM_HATS-1}'}), 400
         
         try:
-            relay.set_all(hat, 0)
+            changed = write_hat(hat, 0)
             return jsonify({
                 'hat': hat,
-                'message': f'All relays OFF for HAT {hat}'
+                'changed': changed,
+                'message': f'All relays {"" if changed else "already "}OFF for HAT {hat}'
             })
         except Exception as e:
             return jsonify({'error': f'Failed to turn off HAT {hat}: {str(e)}'}), 500
@@ -479,36 +1429,67 @@ def create_app():
     def turn_on_all_hats():
         """Turn on all relays across ALL HATs"""
         results = {}
+        changed_hats = []
         
         for hat in range(NUM_HATS):
             try:
-                relay.set_all(hat, 255)
-                results[f'hat_{hat}'] = 'All relays ON'
+                if write_hat(hat, ALL_RELAYS_ON):
+                    changed_hats.append(hat)
+                    results[f'hat_{hat}'] = 'All relays ON'
+                else:
+                    results[f'hat_{hat}'] = 'All relays already ON'
             except Exception as e:
                 results[f'hat_{hat}'] = f'Error: {str(e)}'
         
         return jsonify({
             'message': 'All ON command sent to all HATs',
-            'results': results
+            'results': results,
+            'changed': bool(changed_hats),
+            'changed_hats': changed_hats
         })
 
     @app.route('/api/relay/all-off', methods=['POST'])
     def turn_off_all_hats():
         """Turn off all relays across ALL HATs"""
         results = {}
+        changed_hats = []
         
         for hat in range(NUM_HATS):
             try:
-                relay.set_all(hat, 0)
-                results[f'hat_{hat}'] = 'All relays OFF'
+                if write_hat(hat, 0):
+                    changed_hats.append(hat)
+                    results[f'hat_{hat}'] = 'All relays OFF'
+                else:
+                    results[f'hat_{hat}'] = 'All relays already OFF'
             except Exception as e:
                 results[f'hat_{hat}'] = f'Error: {str(e)}'
         
         return jsonify({
             'message': 'All OFF command sent to all HATs',
-            'results': results
+            'results': results,
+            'changed': bool(changed_hats),
+            'changed_hats': changed_hats
         })
 
+    @app.route('/api/emergency/all-off', methods=['POST'])
+    def emergency_off():
+        """
+        Turn off every relay and confirm each HAT by reading it back.
+        
+        Returns 200 only if every HAT read back as all-off; otherwise 500 with
+        the HATs that did not and why.
+        """
+        started = time.perf_counter()
+        confirmed, unconfirmed, rounds = emergency_all_off()
+        return jsonify({
+            'pi_id': PI_ID,
+            'all_off': not unconfirmed,
+            'confirmed_off_hats': confirmed,
+            'unconfirmed_hats': [{'hat': hat, 'reason': reason} for hat, reason in unconfirmed.items()],
+            'rounds': rounds,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+        }), 200 if not unconfirmed else 500
+
     # ========== Switch Name Based API Endpoints ==========
     
     @app.route('/api/switch/<switch_name>', methods=['GET'])
@@ -531,7 +1512,7 @@ def create_app():
         hat, relay_num = position
         
         try:
-            state = relay.get(hat, relay_num)
+            state = bus_call('get', hat, relay_num)
             return jsonify({
                 'switch_name': switch_name.upper(),
                 'hat': hat,
@@ -573,7 +1554,7 @@ def create_app():
             return jsonify({'error': 'State must be 0 (OFF) or 1 (ON)'}), 400
         
         try:
-            relay.set(hat, relay_num, new_state)
+            changed = write_relay(hat, relay_num, new_state)
             
             return jsonify({
                 'switch_name': switch_name.upper(),
@@ -581,7 +1562,8 @@ def create_app():
                 'relay': relay_num,
                 'state': new_state,
                 'status': 'ON' if new_state == 1 else 'OFF',
-                'message': f'{switch_name.upper()} turned {"ON" if new_state == 1 else "OFF"}'
+                'changed': changed,
+                'message': f'{switch_name.upper()} {"turned" if changed else "already"} {"ON" if new_state == 1 else "OFF"}'
             })
         except Exception as e:
             return jsonify({'error': f'Failed to set switch state: {str(e)}'}), 500
@@ -589,65 +1571,52 @@ def create_app():
     @app.route('/api/switch/list', methods=['GET'])
     def list_all_switches():
         """Get a list of all valid switch names and their current states"""
+        switch_names = switch_mapper.get_all_switches()
+        bitmaps = read_hat_bitmaps(switch_names)
         switches = {}
         
-        for switch_name in switch_mapper.get_all_switches():
-            position = switch_mapper.get_relay_position(switch_name)
-            if position:
-                hat, relay_num = position
-                try:
-                    state = relay.get(hat, relay_num)
-                    switches[switch_name] = state  # Just return the state (0 or 1)
-                except Exception as e:
-                    switches[switch_name] = 0  # Default to OFF on error
+        for switch_name in switch_names:
+            hat, relay_num = switch_mapper.get_relay_position(switch_name)
+            bitmap = bitmaps[hat]
+            # Just return the state (0 or 1), default to OFF if the HAT could not be read
+            switches[switch_name] = 0 if isinstance(bitmap, Exception) else (bitmap >> (relay_num - 1)) & 1
         
-        return jsonify({"switches": switches})
+        # ETag of the content, so pollers get a bodyless 304 while nothing changed
+        response = jsonify({"switches": switches})
+        response.add_etag()
+        return response.make_conditional(request)
     
     @app.route('/api/switch/chassis/<int:chassis_num>', methods=['GET'])
     def get_chassis_switches(chassis_num):
         """Get all switches for a specific chassis (e.g., chassis 1 returns CH1 + CH1A-K)
         
         Args:
-            chassis_num: Chassis number (1-4)
+            chassis_num: Chassis number (any chassis mapped on this Pi in main_config.yaml)
         """
-        if chassis_num < 1 or chassis_num > 4:
-            return jsonify({'error': 'Chassis number must be 1-4'}), 400
+        chassis_switches = switch_mapper.get_chassis_switches(chassis_num)
+        if not chassis_switches:
+            return jsonify({
+                'error': f'No switches mapped for chassis {chassis_num} on this Pi',
+                'available_chassis': switch_mapper.get_all_chassis()
+            }), 404
         
         chassis_name = f'CH{chassis_num}'
+        bitmaps = read_hat_bitmaps(chassis_switches)
         switches = {}
         
-        # Get chassis switch
-        position = switch_mapper.get_relay_position(chassis_name)
-        if position:
-            hat, relay_num = position
-            try:
-                state = relay.get(hat, relay_num)
-                switches[chassis_name] = {
-                    'state': state,
-                    'status': 'ON' if state == 1 else 'OFF',
-                    'type': 'chassis'
-                }
-            except Exception as e:
-                switches[chassis_name] = {'error': str(e)}
-        
-        # Get BACboard switches
-        max_letter = 'J' if chassis_num == 4 else 'K'
-        for letter in 'ABCDEFGHIJK':
-            if letter > max_letter:
-                break
-            switch_name = f'CH{chassis_num}{letter}'
-            position = switch_mapper.get_relay_position(switch_name)
-            if position:
-                hat, relay_num = position
-                try:
-                    state = relay.get(hat, relay_num)
-                    switches[switch_name] = {
-                        'state': state,
-                        'status': 'ON' if state == 1 else 'OFF',
-                        'type': 'BACboard'
-                    }
-                except Exception as e:
-                    switches[switch_name] = {'error': str(e)}
+        # Chassis power switch first, then its BACboard switches in order
+        for switch_name in chassis_switches:
+            hat, relay_num = switch_mapper.get_relay_position(switch_name)
+            bitmap = bitmaps[hat]
+            if isinstance(bitmap, Exception):
+                switches[switch_name] = {'error': str(bitmap)}
+                continue
+            state = (bitmap >> (relay_num - 1)) & 1
+            switches[switch_name] = {
+                'state': state,
+                'status': 'ON' if state == 1 else 'OFF',
+                'type': 'chassis' if switch_name == chassis_name else 'BACboard'
+            }
         
         return jsonify({
             'chassis': chassis_num,
@@ -1,17 +1,37 @@
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, Response
 import yaml
 import requests
 from pathlib import Path
+import os
 import time
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+import signal
 import sqlite3
 from datetime import datetime
 import json
+import hashlib
+import queue
+import random
+import re
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; there the poller always runs
+    fcntl = None
+from channel import ChannelPool, ChannelError, ChannelCommandError
+from telemetry import (
+    install_tracing, SlowRequestLog, current_trace, trace_phase,
+    parse_server_timing, REQUEST_ID_HEADER, SERVER_TIMING_HEADER,
+    MetricsRegistry, install_metrics, PROMETHEUS_CONTENT_TYPE,
+    install_deadlines, time_remaining, current_deadline, DEADLINE_HEADER
+)
+
+# Set CASM_CONFIG to run against another config (e.g. one written by the simulator farm)
+CONFIG_PATH = Path(os.environ.get('CASM_CONFIG', Path(__file__).parent.parent / 'main_config.yaml'))
 
 # Load main server configuration
-def load_config():
+def load_config(config_path=CONFIG_PATH):
     """Load configuration from main_config.yaml"""
-    config_path = Path(__file__).parent.parent / 'main_config.yaml'
     
     if not config_path.exists():
             raise FileNotFoundError(
@@ -27,20 +47,91 @@ def load_config():
     except Exception as e:
         raise Exception(f"Error loading config: {e}")
 
-# Load configuration
-CONFIG = load_config()
-RASPBERRY_PIS = CONFIG.get('raspberry_pis', {})
-STATUS_CHECK_INTERVAL = CONFIG.get('status_check_interval', 30)
-REQUEST_TIMEOUT = CONFIG.get('request_timeout', 5)
 
-# Status cache
-pi_status_cache = {}
-pi_status_lock = Lock()
+def validate_config(config):
+    """
+    Validate a loaded main_config.yaml before it is put into service.
+    
+    Args:
+        config: Parsed YAML configuration
+    
+    Raises:
+        ValueError: Describing every problem found in the configuration
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Config must be a mapping at the top level")
+    
+    pis = config.get('raspberry_pis')
+    if not isinstance(pis, dict) or not pis:
+        raise ValueError("Config must define at least one entry under 'raspberry_pis'")
+    
+    problems = []
+    switch_owner = {}
+    chassis_owner = {}
+    
+    for pi_id, pi_data in pis.items():
+        if not isinstance(pi_data, dict):
+            problems.append(f"{pi_id}: entry must be a mapping")
+            continue
+        if not pi_data.get('ip_address'):
+            problems.append(f"{pi_id}: missing ip_address")
+        control_port = pi_data.get('control_port')
+        if control_port is not None and (not isinstance(control_port, int) or not 0 < control_port < 65536
+                                         or control_port == pi_data.get('port', 5001)):
+            problems.append(f"{pi_id}: invalid control_port {control_port!r} (must be a free TCP port other than port)")
+        
+        num_hats = pi_data.get('num_relay_hats', 3)
+        relays_per_hat = pi_data.get('relays_per_hat', 8)
+        # HAT bitmaps travel as u16 with 0xFFFF for unknown, so a 16th relay cannot be told apart
+        if not isinstance(relays_per_hat, int) or not 0 < relays_per_hat <= 15:
+            problems.append(f"{pi_id}: invalid relays_per_hat {relays_per_hat!r} (must be 1-15)")
+        
+        for chassis_num in pi_data.get('chassis', []):
+            if chassis_num in chassis_owner:
+                problems.append(f"{pi_id}: chassis {chassis_num} already assigned to {chassis_owner[chassis_num]}")
+            chassis_owner[chassis_num] = pi_id
+        
+        used_positions = {}
+        for switch_name, relay_pos in (pi_data.get('switch_mapping') or {}).items():
+            name = str(switch_name).upper()
+            if name in switch_owner:
+                problems.append(f"{pi_id}: switch {name} already mapped on {switch_owner[name]}")
+            switch_owner[name] = pi_id
+            
+            if not isinstance(relay_pos, dict):
+                problems.append(f"{pi_id}: {name} must be {{hat: X, relay: Y}}")
+                continue
+            hat = relay_pos.get('hat')
+            relay = relay_pos.get('relay')
+            if not isinstance(hat, int) or hat < 0 or hat >= num_hats:
+                problems.append(f"{pi_id}: {name} has invalid hat {hat!r} (must be 0-{num_hats-1})")
+            if not isinstance(relay, int) or relay < 1 or relay > relays_per_hat:
+                problems.append(f"{pi_id}: {name} has invalid relay {relay!r} (must be 1-{relays_per_hat})")
+            if (hat, relay) in used_positions:
+                problems.append(f"{pi_id}: {name} and {used_positions[(hat, relay)]} share HAT {hat} relay {relay}")
+            used_positions[(hat, relay)] = name
+    
+    if problems:
+        raise ValueError("Invalid config:\n  " + "\n  ".join(problems))
+
+# Importing this module has no side effects. The config-derived globals below
+# are created by load_settings() on first access (see __getattr__ at the end
+# of the module) and replaced on every reload; the database, background
+# threads and worker pools are set up by init_app(), called from create_app().
+CONFIG_GLOBALS = (
+    'CONFIG', 'RASPBERRY_PIS', 'STATUS_CHECK_INTERVAL', 'REQUEST_TIMEOUT', 'CONFIG_WATCH_INTERVAL',
+    'STATE_CACHE_TTL', 'REQUEST_RETRIES', 'RETRY_BACKOFF', 'CONNECT_TIMEOUT', 'EMERGENCY_TIMEOUT',
+    'EMERGENCY_ATTEMPT_TIMEOUT', 'CHANNEL_TIMEOUT', 'router'
+)
+RESOURCE_GLOBALS = ('slow_request_log', 'fanout_pool')
+
+# Status history and command journal database (CASM_DB overrides the location)
+DB_PATH = Path(os.environ.get('CASM_DB', Path(__file__).parent.parent / 'status_history.db'))
 
 # Initialize status logging database
-def init_status_db():
-    """Create SQLite database for status check history"""
-    db_path = Path(__file__).parent.parent / 'status_history.db'
+def init_status_db(db_path=None):
+    """Create SQLite database for status check history (at DB_PATH unless db_path is given)"""
+    db_path = db_path or DB_PATH
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
@@ -65,17 +156,82 @@ def init_status_db():
     except sqlite3.OperationalError:
         pass  # Column already exists
     
+    # Append-only journal of switch commands, queried by switch and time
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS switch_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp REAL NOT NULL,
+            switch_name TEXT NOT NULL,
+            pi_id TEXT,
+            hat INTEGER,
+            relay INTEGER,
+            requested_state INTEGER,
+            status_code INTEGER,
+            result TEXT,
+            changed INTEGER,
+            error_msg TEXT,
+            latency_ms REAL,
+            client TEXT,
+            user_agent TEXT,
+            request_id TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_switch_commands_switch_time ON switch_commands (switch_name, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_switch_commands_time ON switch_commands (timestamp)')
+    
+    # Latest status of each Pi, shared by all worker processes, with the
+    # relay states of its newest heartbeat or control channel push:
+    # hat_bitmaps (JSON list), state_version and boot_id as the Pi sent them,
+    # and states_at, the time.monotonic() when they were known to hold
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pi_status (
+            pi_id TEXT PRIMARY KEY,
+            entry TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            hat_bitmaps TEXT,
+            relays_per_hat INTEGER,
+            state_version INTEGER,
+            boot_id TEXT,
+            states_at REAL
+        )
+    ''')
+    
+    # Add the state columns if they don't exist (migration for existing databases)
+    for column in ('hat_bitmaps TEXT', 'relays_per_hat INTEGER', 'state_version INTEGER',
+                   'boot_id TEXT', 'states_at REAL'):
+        try:
+            cursor.execute(f'ALTER TABLE pi_status ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    
+    # Last observed state of each relay, shared by all worker processes.
+    # observed_at is time.monotonic(), one clock for every process on the host;
+    # rows from before a reboot are ahead of it and would never be replaced,
+    # so they are dropped below.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS relay_states (
+            pi_url TEXT NOT NULL,
+            hat INTEGER NOT NULL,
+            relay INTEGER NOT NULL,
+            state INTEGER,
+            observed_at REAL NOT NULL,
+            PRIMARY KEY (pi_url, hat, relay)
+        )
+    ''')
+    
+    # WAL lets the journal writer append while API requests read
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('DELETE FROM relay_states WHERE observed_at > ?', (time.monotonic(),))
+    cursor.execute('UPDATE pi_status SET hat_bitmaps = NULL, state_version = NULL, boot_id = NULL, states_at = NULL '
+                   'WHERE states_at > ?', (time.monotonic(),))
+    
     conn.commit()
     conn.close()
     print(f"Status logging database initialized: {db_path}")
 
-# Initialize database on module load
-init_status_db()
-
 def log_status_check(pi_id, status, chassis_list=None, error_msg=None, response_time_ms=None, pi_response=None):
     """Log a status check result to the database"""
-    db_path = Path(__file__).parent.parent / 'status_history.db'
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     timestamp = time.time()
@@ -103,8 +259,351 @@ def log_status_check(pi_id, status, chassis_list=None, error_msg=None, response_
     conn.close()
 
 
+class SharedStatusStore:
+    """
+    Latest status of each Pi and the observed relay states, kept in SQLite
+    so every worker process sees what the poller and the other workers wrote.
+    
+    Pi status reads are served from memory and only reloaded when another
+    connection has committed since the last read (PRAGMA data_version), so
+    request handlers don't query the table on every call. Relay states and
+    each Pi's last state snapshot are looked up by primary key.
+    """
+    
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path: SQLite database holding the pi_status table
+        """
+        self.db_path = db_path
+        self._lock = Lock()
+        self._conn = None
+        self._pid = None
+        self._version = None
+        self._statuses = {}
+    
+    def _connection(self):
+        # A connection must not cross a fork into worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            # Commands write relay states; with WAL this syncs at checkpoints, not on every commit
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+            self._version = None
+        return self._conn
+    
+    def snapshot(self):
+        """Get {pi_id: status entry} for all Pis"""
+        with self._lock:
+            conn = self._connection()
+            version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if version != self._version:
+                rows = conn.execute('SELECT pi_id, entry FROM pi_status').fetchall()
+                self._statuses = {pi_id: json.loads(entry) for pi_id, entry in rows}
+                self._version = version
+            return dict(self._statuses)
+    
+    def put(self, pi_id, entry):
+        """Store the latest status entry of a Pi (its state snapshot is kept)"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('''
+                INSERT INTO pi_status (pi_id, entry, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (pi_id) DO UPDATE SET entry = excluded.entry, updated_at = excluded.updated_at
+            ''', (pi_id, json.dumps(entry), time.time()))
+            conn.commit()
+            # Our own commits don't change data_version, so update the copy in memory
+            self._statuses[pi_id] = entry
+    
+    def retain(self, pi_ids):
+        """Drop the status of every Pi not in pi_ids"""
+        pi_ids = list(pi_ids)
+        with self._lock:
+            conn = self._connection()
+            placeholders = ', '.join('?' * len(pi_ids))
+            conn.execute(f'DELETE FROM pi_status WHERE pi_id NOT IN ({placeholders})', pi_ids)
+            conn.commit()
+            self._statuses = {pi_id: entry for pi_id, entry in self._statuses.items() if pi_id in pi_ids}
+    
+    def put_states(self, pi_id, hat_bitmaps, relays_per_hat, state_version, boot_id, observed_at):
+        """
+        Store a Pi's state snapshot unless a newer one is already stored.
+        
+        Versions count up from 0 in every run of the Pi server, so a snapshot
+        from a run with another boot_id is always taken. One with the stored
+        version only moves states_at forward.
+        
+        Args:
+            pi_id: Pi the snapshot came from
+            hat_bitmaps: [bitmap or None per HAT]
+            relays_per_hat: Relays per HAT bitmap
+            state_version: The Pi's state_version, or None if it sends none
+            boot_id: The Pi server run the version belongs to
+            observed_at: time.monotonic() when the states were known to hold
+        
+        Returns:
+            bool: True if the snapshot was stored
+        """
+        with self._lock:
+            conn = self._connection()
+            stored = conn.execute('''
+                INSERT INTO pi_status (pi_id, entry, updated_at, hat_bitmaps, relays_per_hat,
+                                       state_version, boot_id, states_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pi_id) DO UPDATE SET
+                    hat_bitmaps = excluded.hat_bitmaps, relays_per_hat = excluded.relays_per_hat,
+                    state_version = excluded.state_version, boot_id = excluded.boot_id,
+                    states_at = MAX(excluded.states_at, COALESCE(pi_status.states_at, excluded.states_at))
+                WHERE pi_status.state_version IS NULL OR excluded.state_version IS NULL
+                    OR pi_status.boot_id IS NOT excluded.boot_id
+                    OR excluded.state_version >= pi_status.state_version
+            ''', (pi_id, json.dumps({'status': 'unknown'}), time.time(), json.dumps(hat_bitmaps), relays_per_hat,
+                  state_version, boot_id, observed_at)).rowcount > 0
+            conn.commit()
+            if stored:
+                self._statuses.setdefault(pi_id, {'status': 'unknown'})
+            return stored
+    
+    def states_at(self, pi_id):
+        """
+        Get when the stored state snapshot of a Pi was known to hold.
+        
+        Returns:
+            float: time.monotonic() of the snapshot, or None if there is none
+        """
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT states_at FROM pi_status WHERE pi_id = ?', (pi_id,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def put_relay_states(self, pi_url, states, observed_at):
+        """
+        Store observed relay states of a Pi, keeping any entry observed later.
+        
+        Args:
+            pi_url: Base URL of the Pi
+            states: {(hat, relay): 0, 1, or None if unknown}
+            observed_at: time.monotonic() when the states were known to hold
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('''
+                INSERT INTO relay_states (pi_url, hat, relay, state, observed_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (pi_url, hat, relay) DO UPDATE
+                SET state = excluded.state, observed_at = excluded.observed_at
+                WHERE excluded.observed_at >= relay_states.observed_at
+            ''', [(pi_url, hat, relay, state, observed_at) for (hat, relay), state in states.items()])
+            conn.commit()
+    
+    def relay_state(self, pi_url, hat, relay):
+        """
+        Get the last observed state of a relay.
+        
+        Returns:
+            tuple: (state or None if unknown, observed_at), or None if never observed
+        """
+        with self._lock:
+            return self._connection().execute(
+                'SELECT state, observed_at FROM relay_states WHERE pi_url = ? AND hat = ? AND relay = ?',
+                (pi_url, hat, relay)
+            ).fetchone()
+    
+    def relay_states(self, pi_url):
+        """
+        Get the last observed state of every relay of a Pi.
+        
+        Returns:
+            dict: {(hat, relay): (state or None if unknown, observed_at)}
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT hat, relay, state, observed_at FROM relay_states WHERE pi_url = ?', (pi_url,)
+            ).fetchall()
+        return {(hat, relay): (state, observed_at) for hat, relay, state, observed_at in rows}
+
+
+class PollerLease:
+    """
+    Leadership of the Pi status poller across worker processes.
+    
+    Held as an exclusive lock on a file; whichever worker holds it polls the
+    Pis, the others serve what it writes to the shared status store. The OS
+    releases the lock when the leader exits, and the next worker to try takes over.
+    """
+    
+    def __init__(self, path):
+        """
+        Args:
+            path: Lock file shared by all workers
+        """
+        self.path = path
+        self._file = None
+    
+    @property
+    def held(self):
+        return self._file is not None or fcntl is None
+    
+    def try_acquire(self):
+        """Take the lease if no other worker holds it. Returns whether this worker holds it."""
+        if self.held:
+            return True
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f'{os.getpid()}\n')
+        lock_file.flush()
+        self._file = lock_file
+        return True
+    
+    def release(self):
+        """Give up the lease so another worker can take over polling"""
+        lock_file, self._file = self._file, None
+        if lock_file is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+
+# Pi status written by the poller and read by request handlers in every worker
+pi_status_store = SharedStatusStore(DB_PATH)
+poller_lease = PollerLease(DB_PATH.with_name(DB_PATH.stem + '.poller.lock'))
+
+
+class CommandJournal:
+    """
+    Append-only journal of switch commands, written by a background thread.
+    
+    record() only puts the entry on a bounded queue, so the command path never
+    waits for SQLite. The writer drains the queue in batches and inserts each
+    batch in a single transaction. If the queue is full the entry is dropped
+    and counted rather than blocking the request.
+    """
+    
+    COLUMNS = (
+        'timestamp', 'switch_name', 'pi_id', 'hat', 'relay', 'requested_state', 'status_code',
+        'result', 'changed', 'error_msg', 'latency_ms', 'client', 'user_agent', 'request_id'
+    )
+    
+    def __init__(self, db_path, batch_size=200, flush_interval=0.5, max_queue=10000):
+        """
+        Args:
+            db_path: SQLite database holding the switch_commands table
+            batch_size: Maximum entries inserted per transaction
+            flush_interval: Seconds to wait for more entries before writing a partial batch
+            max_queue: Entries buffered before new ones are dropped
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = Lock()
+        self.written = 0
+        self.dropped = 0
+    
+    def start(self):
+        """Start the writer thread (idempotent)"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+    
+    def record(self, **entry):
+        """Queue a command for the journal without blocking"""
+        entry.setdefault('timestamp', time.time())
+        try:
+            self._queue.put_nowait(tuple(entry.get(column) for column in self.COLUMNS))
+        except queue.Full:
+            self.dropped += 1
+    
+    def flush(self, timeout=5):
+        """Block until everything queued so far has been written (or timeout)"""
+        done = Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+    
+    def pending(self):
+        """Number of entries waiting to be written"""
+        return self._queue.qsize()
+    
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        placeholders = ', '.join('?' for _ in self.COLUMNS)
+        insert = f"INSERT INTO switch_commands ({', '.join(self.COLUMNS)}) VALUES ({placeholders})"
+        
+        while True:
+            batch, markers = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, Event):
+                    markers.append(item)
+                    break  # Flush requested: write what we have now
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            
+            if batch:
+                try:
+                    with conn:
+                        conn.executemany(insert, batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    print(f"Error writing command journal ({len(batch)} entries lost): {e}")
+            for marker in markers:
+                marker.set()
+
+
+command_journal = CommandJournal(DB_PATH)
+
+
+SWITCH_NAME_PATTERN = re.compile(r'^CH(\d+)([A-Z]*)$')
+
+
+def parse_switch_name(switch_name):
+    """
+    Split a switch name into its chassis number and SNAP suffix.
+    
+    Args:
+        switch_name: e.g. 'CH1' (chassis power), 'CH2F', 'CH12AB'
+    
+    Returns:
+        tuple: (chassis_num, suffix) e.g. (2, 'F'), or None if not a CH<n> name
+    """
+    match = SWITCH_NAME_PATTERN.match(switch_name.upper())
+    if match is None:
+        return None
+    return int(match.group(1)), match.group(2)
+
+
+def switch_sort_key(switch_name):
+    """Sort key ordering switches by chassis number, then CH<n>, CH<n>A..Z, CH<n>AA.."""
+    parsed = parse_switch_name(switch_name)
+    if parsed is None:
+        return (float('inf'), 0, switch_name)
+    chassis_num, suffix = parsed
+    return (chassis_num, len(suffix), suffix)
+
+
 class PiRouter:
-    """Routes switch requests to the appropriate Raspberry Pi with relay mappings"""
+    """
+    Routes switch requests to the appropriate Raspberry Pi with relay mappings.
+    
+    A router is never modified after construction; config reloads build a new
+    router and swap the global reference, so read it once per request.
+    """
     
     def __init__(self, pi_config):
         """
@@ -119,8 +618,11 @@ class PiRouter:
     def _build_switch_mappings(self):
         """Build mappings from switch names to Pi addresses AND relay positions"""
         self.switch_to_pi = {}  # switch_name -> pi_url
+        self.url_to_pi_id = {}  # pi_url -> pi_id
         self.switch_to_relay = {}  # switch_name -> {pi_url, hat, relay}
         self.chassis_to_pi = {}  # chassis_num -> pi_info
+        self.pi_to_switches = {}  # pi_url -> (switch_name, ...)
+        self.chassis_to_switches = {}  # chassis_num -> (switch_name, ...)
         
         for pi_id, pi_data in self.pi_config.items():
             ip = pi_data.get('ip_address')
@@ -129,6 +631,7 @@ class PiRouter:
             switch_mapping = pi_data.get('switch_mapping', {})
             
             pi_url = f"http://{ip}:{port}"
+            self.url_to_pi_id[pi_url] = pi_id
             
             # Map each chassis to this Pi
             for chassis_num in chassis_list:
@@ -147,6 +650,45 @@ class PiRouter:
                     'hat': relay_pos.get('hat'),
                     'relay': relay_pos.get('relay')
                 }
+        
+        # Precomputed, sorted indexes so per-request lookups and fan-out stay O(1) per switch
+        all_switches = sorted(self.switch_to_pi, key=switch_sort_key)
+        pi_to_switches = {}
+        chassis_to_switches = {}
+        for switch_name in all_switches:
+            pi_to_switches.setdefault(self.switch_to_pi[switch_name], []).append(switch_name)
+            parsed = parse_switch_name(switch_name)
+            if parsed is not None:
+                chassis_to_switches.setdefault(parsed[0], []).append(switch_name)
+        
+        self._all_switches = tuple(all_switches)
+        self.pi_to_switches = {pi_url: tuple(names) for pi_url, names in pi_to_switches.items()}
+        self.chassis_to_switches = {num: tuple(names) for num, names in chassis_to_switches.items()}
+        self._build_topology()
+    
+    def _build_topology(self):
+        """Build the client-facing switch -> Pi/HAT/relay map served at /api/topology"""
+        self.topology = {
+            'pis': {
+                pi_id: {
+                    'ip_address': pi_data.get('ip_address'),
+                    'port': pi_data.get('port', 5001),
+                    'chassis': pi_data.get('chassis', [])
+                }
+                for pi_id, pi_data in self.pi_config.items()
+            },
+            'switches': {
+                switch_name: {
+                    'pi_id': self.url_to_pi_id[self.switch_to_relay[switch_name]['pi_url']],
+                    'hat': self.switch_to_relay[switch_name]['hat'],
+                    'relay': self.switch_to_relay[switch_name]['relay']
+                }
+                for switch_name in self._all_switches
+            }
+        }
+        # Changes only when the topology does, so clients can revalidate cheaply
+        canonical = json.dumps(self.topology, sort_keys=True, separators=(',', ':'))
+        self.topology_etag = hashlib.sha1(canonical.encode()).hexdigest()[:16]
     
     def get_relay_info(self, switch_name):
         """
@@ -177,137 +719,1047 @@ class PiRouter:
         Get the Pi info for a given chassis number.
         
         Args:
-            chassis_num: Chassis number (1-4)
+            chassis_num: Chassis number (as listed under 'chassis' in main_config.yaml)
         
         Returns:
             dict: Pi information, or None if not found
         """
         return self.chassis_to_pi.get(chassis_num)
     
+    def get_switches_for_chassis(self, chassis_num):
+        """Get the switch names of a chassis (CH<n> first, then its SNAPs), or () if none"""
+        return self.chassis_to_switches.get(chassis_num, ())
+    
     def get_all_switches(self):
-        """Get list of all valid switch names across all Pis"""
-        return sorted(self.switch_to_pi.keys())
+        """Get all valid switch names across all Pis, sorted by chassis"""
+        return self._all_switches
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls into a single in-flight call.
+    
+    The first caller for a key (the leader) runs the function; callers that
+    arrive with the same key while it is still running wait for it and receive
+    the same result instead of issuing their own request. Results are shared
+    between callers, so they must be treated as read-only.
+    """
+    
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}  # key -> in-flight call state
+        self._leaders = 0
+        self._coalesced = 0
+    
+    def do(self, key, fn):
+        """
+        Run fn() once for all concurrent callers sharing the same key.
+        
+        Args:
+            key: Hashable identifier of the call (e.g., (pi_url, endpoint))
+            fn: Zero-argument callable performing the actual work
+        
+        Returns:
+            tuple: (value returned by fn() for the leading caller,
+                    True if this caller joined a call already in flight)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = {'done': Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                self._leaders += 1
+                leader = True
+            else:
+                self._coalesced += 1
+                leader = False
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+        
+        try:
+            call['result'] = fn()
+            return call['result'], False
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+    
+    def stats(self):
+        """Get coalescing counters"""
+        with self._lock:
+            total = self._leaders + self._coalesced
+            return {
+                'upstream_requests': self._leaders,
+                'coalesced_requests': self._coalesced,
+                'in_flight': len(self._calls),
+                'coalesce_ratio': round(self._coalesced / total, 3) if total else 0.0
+            }
+
+
+# Shared by all read-only GETs forwarded to the Pis
+pi_request_coalescer = SingleFlight()
+
+
+class RelayStateCache:
+    """
+    Recently observed relay states, keyed by (pi_url, hat, relay).
+    
+    Filled from every Pi response that reports a state. Entries older than
+    the TTL are ignored, since Pis can also be switched directly (capc -d).
+    The entries live in the shared status store, so a write made through
+    one worker is seen by all of them.
+    """
+    
+    def __init__(self, ttl, store):
+        """
+        Args:
+            ttl: Seconds an observed state counts as fresh (0 disables the cache)
+            store: SharedStatusStore holding the entries
+        """
+        self.ttl = ttl
+        self.store = store
+    
+    def update(self, pi_url, hat, relay, state, observed_at=None):
+        """
+        Record an observed relay state.
+        
+        Responses arrive in any order, so each state carries the time it was
+        known to hold, and one observed before the current entry is dropped.
+        
+        Args:
+            pi_url: Base URL of the Pi
+            hat: HAT number
+            relay: Relay number (1-based)
+            state: 0 or 1 (anything else is ignored)
+            observed_at: time.monotonic() when the state was known to hold
+                         (default: now). For a read, when the request was
+                         sent; for a write, when it was acknowledged.
+        """
+        self.update_many(pi_url, {(hat, relay): state}, observed_at)
+    
+    def update_many(self, pi_url, states, observed_at=None):
+        """Record several observed states of one Pi ({(hat, relay): state}), as update() does"""
+        states = {position: state for position, state in states.items() if state in (0, 1)}
+        if states:
+            self._store(pi_url, states, observed_at)
+    
+    def invalidate(self, pi_url, hat, relay, observed_at=None):
+        """Forget a relay state (e.g., after a failed write), ignoring older reads still in flight"""
+        self.invalidate_many(pi_url, [(hat, relay)], observed_at)
+    
+    def invalidate_many(self, pi_url, positions, observed_at=None):
+        """Forget the states of several relays of one Pi, given as (hat, relay) pairs"""
+        self._store(pi_url, dict.fromkeys(positions), observed_at)
+    
+    def _store(self, pi_url, states, observed_at):
+        if not states:
+            return
+        if observed_at is None:
+            observed_at = time.monotonic()
+        self.store.put_relay_states(pi_url, states, observed_at)
+    
+    def get_fresh(self, pi_url, hat, relay):
+        """
+        Get a relay state observed within the TTL.
+        
+        Returns:
+            int: 0 or 1, or None if unknown or stale
+        """
+        if not self.ttl or self.ttl <= 0:
+            return None
+        entry = self.store.relay_state(pi_url, hat, relay)
+        if entry is None or entry[0] is None or time.monotonic() - entry[1] > self.ttl:
+            return None
+        return entry[0]
 
 
-# Global router instance
-router = PiRouter(RASPBERRY_PIS)
+# ttl set from state_cache_ttl by apply_config()
+relay_state_cache = RelayStateCache(ttl=2, store=pi_status_store)
 
+def remember_switch_states(current, switches, observed_at=None):
+    """
+    Record switch states reported by a Pi in the relay state cache.
+    
+    Args:
+        current: PiRouter used to resolve switch names
+        switches: {switch_name: state} or {switch_name: {'state': state, ...}}
+        observed_at: time.monotonic() when the request that read them was sent
+    """
+    by_pi = {}
+    for switch_name, value in switches.items():
+        state = value.get('state') if isinstance(value, dict) else value
+        relay_info = current.get_relay_info(switch_name)
+        if relay_info is not None:
+            by_pi.setdefault(relay_info['pi_url'], {})[(relay_info['hat'], relay_info['relay'])] = state
+    for pi_url, states in by_pi.items():
+        relay_state_cache.update_many(pi_url, states, observed_at)
+
+
+def remember_hat_bitmaps(pi_url, status, observed_at=None):
+    """
+    Record the relay states carried by a Pi's heartbeat in the shared store.
+    
+    The snapshot goes into the Pi's pi_status row and its relay states into
+    the relay state cache, so /api/switch/list can be answered without
+    asking the Pi (see shared_switch_states).
+    
+    Args:
+        pi_url: Base URL of the Pi
+        status: The Pi's /api/status response; Pi servers that predate
+                hat_bitmaps send none, and nothing is recorded. A snapshot
+                whose state_version is older than the one stored for this
+                Pi is ignored.
+        observed_at: time.monotonic() when the Pi was asked (default: now)
+    """
+    bitmaps = status.get('hat_bitmaps')
+    relays_per_hat = status.get('relays_per_hat')
+    pi_id = router.url_to_pi_id.get(pi_url)
+    if not isinstance(bitmaps, list) or not relays_per_hat or pi_id is None:
+        return
+    if observed_at is None:
+        observed_at = time.monotonic()
+    version = status.get('state_version')
+    if not pi_status_store.put_states(pi_id, bitmaps, relays_per_hat, version if isinstance(version, int) else None,
+                                      status.get('boot_id'), observed_at):
+        return
+    relay_state_cache.update_many(pi_url, {
+        (hat, relay): (bitmap >> (relay - 1)) & 1
+        for hat, bitmap in enumerate(bitmaps) if bitmap is not None  # None: HAT could not be read
+        for relay in range(1, relays_per_hat + 1)
+    }, observed_at)
 
-def forward_to_pi(pi_url, endpoint, method='GET', data=None, timeout=None):
+
+def shared_switch_states(current, pi_url):
+    """
+    Get the switch states of a Pi as last recorded in the shared store, without asking it.
+    
+    Heartbeats and control channel pushes sync the Pi's full state, and
+    commands sent through any worker update it in between, so the states
+    are used while the last sync is fresh: within two status check
+    intervals, and with the last heartbeat finding the Pi online.
+    
+    Returns:
+        dict: {switch_name: state}, or None if the states are stale, the
+        relay state cache is disabled, or any of the Pi's switches is unknown
+    """
+    if not relay_state_cache.ttl or relay_state_cache.ttl <= 0:
+        return None
+    pi_id = current.url_to_pi_id.get(pi_url)
+    if pi_status_store.snapshot().get(pi_id, {}).get('status') != 'online':
+        return None
+    states_at = pi_status_store.states_at(pi_id)
+    if states_at is None or time.monotonic() - states_at > 2 * STATUS_CHECK_INTERVAL:
+        return None
+    observed = pi_status_store.relay_states(pi_url)
+    switches = {}
+    for switch_name in current.pi_to_switches.get(pi_url, ()):
+        relay_info = current.switch_to_relay[switch_name]
+        state, _ = observed.get((relay_info['hat'], relay_info['relay']), (None, None))
+        if state is None:
+            return None
+        switches[switch_name] = state
+    return switches
+
+
+def switch_list_etag(result):
+    """ETag of a /api/switch/list result, independent of key order"""
+    return hashlib.sha1(json.dumps(result, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def channel_endpoints(current):
+    """
+    Control channel address of every Pi with a control_port.
+    
+    Returns:
+        dict: {pi_url: (ip_address, control_port)}
+    """
+    return {
+        f"http://{pi_data.get('ip_address')}:{pi_data.get('port', 5001)}":
+            (pi_data.get('ip_address'), pi_data['control_port'])
+        for pi_data in current.pi_config.values() if pi_data.get('control_port')
+    }
+
+
+# Persistent control channels to Pis with a control_port. State events from
+# a Pi (sent on every connect and change) go straight into the state cache.
+pi_channels = ChannelPool(
+    on_state=lambda pi_url, bitmaps, version, relays_per_hat, boot_id: remember_hat_bitmaps(
+        pi_url, {'hat_bitmaps': bitmaps, 'relays_per_hat': relays_per_hat,
+                 'state_version': version, 'boot_id': boot_id})
+)
+
+
+def journal_command(switch_name, pi_id, hat, relay, state, response, status_code):
+    """Record a switch command handled by this request in the command journal"""
+    trace = current_trace()
+    response = response if isinstance(response, dict) else {}
+    if status_code == 200:
+        result = 'ok' if response.get('changed', True) else 'unchanged'
+    else:
+        result = 'error'
+    
+    command_journal.record(
+        switch_name=switch_name,
+        pi_id=pi_id,
+        hat=hat,
+        relay=relay,
+        requested_state=state if isinstance(state, int) else None,
+        status_code=status_code,
+        result=result,
+        changed=None if 'changed' not in response else int(bool(response['changed'])),
+        error_msg=response.get('error'),
+        latency_ms=round(trace.elapsed_ms(), 3) if trace is not None else None,
+        client=request.remote_addr,
+        user_agent=request.headers.get('User-Agent'),
+        request_id=trace.request_id if trace is not None else None
+    )
+
+
+def broadcast_all_off(current, timeout, attempt_timeout, trace=None, deadline=None):
+    """
+    Send an emergency all-off to every Pi at once and wait for confirmations.
+    
+    Each Pi gets its own thread rather than a slot in the shared fan-out
+    pool, so a busy pool cannot delay the broadcast. A Pi that is unreachable,
+    slow, or reports unconfirmed HATs is sent the command again until the
+    timeout; each attempt is capped at attempt_timeout so one hung
+    connection cannot use up a Pi's whole budget.
+    
+    Args:
+        current: PiRouter whose Pis to switch off
+        timeout: Seconds until the broadcast gives up on the remaining Pis
+        attempt_timeout: Seconds allowed for each attempt
+        trace: Trace of the request being served, which collects the upstream timings
+        deadline: Monotonic deadline of the request being served, if it has one
+    
+    Returns:
+        dict: {pi_id: (response, status_code, attempts)} with each Pi's last
+        answer; Pis that never answered have a 504 response
+    """
+    ensure_initialized()
+    if deadline is not None:
+        timeout = max(min(timeout, deadline - time.monotonic()), 0)
+    deadline = time.monotonic() + timeout
+    results = {}
+    
+    def switch_off(pi_id, pi_url):
+        attempts = 0
+        while True:
+            attempts += 1
+            remaining = deadline - time.monotonic()
+            response, status_code = forward_to_pi(pi_url, '/api/emergency/all-off', method='POST',
+                                                  timeout=min(attempt_timeout, remaining), idempotent=False,
+                                                  trace=trace, deadline=deadline)
+            results[pi_id] = (response, status_code, attempts)
+            if status_code == 200 or deadline - time.monotonic() <= RETRY_BACKOFF:
+                return
+            time.sleep(RETRY_BACKOFF)
+    
+    threads = [Thread(target=switch_off, args=(pi_id, pi_url), name=f'all-off-{pi_id}', daemon=True)
+               for pi_url, pi_id in current.url_to_pi_id.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    
+    no_answer = ({'error': f'No answer within {timeout}s'}, 504, 0)
+    return {pi_id: results.get(pi_id, no_answer) for pi_id in current.url_to_pi_id.values()}
+
+
+def elided_write_response(switch_name, hat, relay, state):
+    """Response for a write skipped because the relay already holds the state"""
+    status = 'ON' if state == 1 else 'OFF'
+    return {
+        'success': True,
+        'switch_name': switch_name,
+        'hat': hat,
+        'relay': relay,
+        'state': state,
+        'status': status,
+        'changed': False,
+        'source': 'main_server_cache',
+        'message': f'{switch_name} (HAT {hat}, Relay {relay}) already {status}'
+    }
+
+def relay_control_response(switch_name, hat, relay, state, changed):
+    """Response for a relay set over the control channel, as the Pi's /api/relay/control returns it"""
+    status = 'ON' if state == 1 else 'OFF'
+    return {
+        'success': True,
+        'switch_name': switch_name,
+        'hat': hat,
+        'relay': relay,
+        'state': state,
+        'status': status,
+        'changed': changed,
+        'source': 'control_channel',
+        'message': f'{switch_name} (HAT {hat}, Relay {relay}) {"turned" if changed else "already"} {status}'
+    }
+
+
+def set_relay_on_pi(pi_url, switch_name, hat, relay, state):
+    """
+    Set one relay on a Pi, over its control channel if it is connected, else over HTTP.
+    
+    A command that gets no answer on the channel within channel_timeout is
+    sent again over HTTP with what is left of request_timeout; relay sets
+    carry absolute states, so a command that did arrive is simply repeated.
+    
+    Returns:
+        tuple: (response_json, status_code, answered_at), the first two as
+        forward_to_pi(); answered_at is the time.monotonic() of the Pi's answer
+    """
+    ensure_initialized()
+    started = time.monotonic()
+    channel = pi_channels.get(pi_url)
+    if channel is not None:
+        pi_id = router.url_to_pi_id.get(pi_url, pi_url)
+        timeout = min(CHANNEL_TIMEOUT, REQUEST_TIMEOUT)
+        client_remaining = time_remaining()
+        if client_remaining is not None:
+            timeout = min(timeout, client_remaining)
+        try:
+            with trace_phase('channel'):
+                changed, acked_at = channel.set_relay(hat, relay, state, timeout)
+            channel_commands.inc(pi_id, 'ok')
+            return relay_control_response(switch_name, hat, relay, state, changed), 200, acked_at
+        except ChannelCommandError as e:
+            channel_commands.inc(pi_id, 'error')
+            return {'error': str(e), 'pi_url': pi_url}, e.status_code, time.monotonic()
+        except ChannelError as e:
+            channel_commands.inc(pi_id, 'fallback')
+            print(f"Control channel to {pi_id} failed, falling back to HTTP: {e}")
+    
+    response, status_code = forward_to_pi(
+        pi_url,
+        '/api/relay/control',
+        method='POST',
+        data={'switch_name': switch_name, 'hat': hat, 'relay': relay, 'state': state},
+        timeout=max(REQUEST_TIMEOUT - (time.monotonic() - started), 0),
+        idempotent=True  # Absolute state, safe to resend
+    )
+    return response, status_code, time.monotonic()
+
+
+# Prometheus metrics served at /metrics
+metrics = MetricsRegistry()
+upstream_duration = metrics.histogram(
+    'casm_main_upstream_request_duration_seconds',
+    'Latency of requests forwarded to a Pi', ('pi_id', 'method')
+)
+upstream_errors = metrics.counter(
+    'casm_main_upstream_errors_total',
+    'Failed requests to a Pi by error class', ('pi_id', 'error_class')
+)
+channel_commands = metrics.counter(
+    'casm_main_channel_commands_total',
+    'Relay commands sent over a control channel, by outcome (ok, error, fallback to HTTP)', ('pi_id', 'outcome')
+)
+
+
+def collect_cache_metrics():
+    """Scrape-time metrics for the coalescer, status cache and slow log"""
+    coalescing = pi_request_coalescer.stats()
+    yield ('casm_main_coalescer_upstream_requests_total', 'counter',
+           'GETs that were sent to a Pi by the coalescer', [({}, coalescing['upstream_requests'])])
+    yield ('casm_main_coalescer_coalesced_requests_total', 'counter',
+           'GETs that shared an in-flight request', [({}, coalescing['coalesced_requests'])])
+    yield ('casm_main_coalescer_in_flight', 'gauge',
+           'Coalesced GETs currently in flight', [({}, coalescing['in_flight'])])
+    
+    now = time.time()
+    statuses = pi_status_store.snapshot()
+    yield ('casm_main_pi_up', 'gauge', 'Whether the last status check of a Pi succeeded',
+           [({'pi_id': pi_id}, 1 if data.get('status') == 'online' else 0) for pi_id, data in sorted(statuses.items())])
+    yield ('casm_main_pi_status_age_seconds', 'gauge', 'Age of the cached status of a Pi',
+           [({'pi_id': pi_id}, round(now - data.get('last_check', now), 3)) for pi_id, data in sorted(statuses.items())])
+    yield ('casm_main_poller_leader', 'gauge', 'Whether this worker is the one polling Pi status',
+           [({}, 1 if poller_lease.held else 0)])
+    yield ('casm_main_command_journal_written_total', 'counter', 'Commands written to the journal',
+           [({}, command_journal.written)])
+    yield ('casm_main_command_journal_dropped_total', 'counter', 'Commands dropped because the journal queue was full',
+           [({}, command_journal.dropped)])
+    yield ('casm_main_command_journal_pending', 'gauge', 'Commands waiting to be written to the journal',
+           [({}, command_journal.pending())])
+    yield ('casm_main_slow_requests', 'gauge', 'Entries in the slow request ring buffer',
+           [({}, len(slow_request_log))])
+    yield ('casm_main_startup_seconds', 'gauge', 'Time spent in each startup phase',
+           [({'phase': name}, round(seconds, 6)) for name, seconds in startup_timings.items()])
+    channels = pi_channels.clients()
+    yield ('casm_main_channel_connected', 'gauge', 'Whether the control channel to a Pi is connected',
+           [({'pi_id': router.url_to_pi_id.get(pi_url, pi_url)}, 1 if client.connected else 0)
+            for pi_url, client in sorted(channels.items())])
+    yield ('casm_main_channel_connects_total', 'counter', 'Connections made on the control channel to a Pi',
+           [({'pi_id': router.url_to_pi_id.get(pi_url, pi_url)}, client.connects)
+            for pi_url, client in sorted(channels.items())])
+
+
+metrics.register_collector(collect_cache_metrics)
+
+
+def forward_to_pi(pi_url, endpoint, method='GET', data=None, timeout=None, idempotent=None,
+                  trace=None, deadline=None):
     """
     Forward an HTTP request to a Raspberry Pi.
     
+    Idempotent requests are retried with exponential backoff when the Pi
+    cannot be reached or does not answer in time. The timeout caps the total
+    time across all attempts, and the remaining budget is sent to the Pi in
+    the deadline header so it can abandon work we have already given up on.
+    
     Args:
         pi_url: URL of the Pi
         endpoint: API endpoint (e.g., '/api/switch/CH1')
         method: HTTP method ('GET' or 'POST')
         data: JSON data for POST requests
-        timeout: Request timeout in seconds
+        timeout: Total time budget in seconds (default: request_timeout)
+        idempotent: Whether the request may be retried (default: GET only).
+                    Relay sets are idempotent since they carry absolute states.
+        trace: Trace of the request being served (default: the current request's).
+               Worker threads have no request context, so pass it from there.
+        deadline: Monotonic deadline of the request being served (default: the
+                  current request's); pass it from worker threads as well
     
     Returns:
         tuple: (response_json, status_code) or (error_dict, error_code)
     """
+    ensure_initialized()
+    if trace is None:
+        trace = current_trace()
+    if deadline is None:
+        deadline = current_deadline()
     if timeout is None:
         timeout = REQUEST_TIMEOUT
+    if idempotent is None:
+        idempotent = method == 'GET'
+    if method not in ('GET', 'POST'):
+        return {'error': f'Unsupported method: {method}'}, 400
+    
+    # Never outlive the deadline of the client request we are serving
+    client_deadline = deadline
+    deadline = time.monotonic() + timeout
+    if client_deadline is not None:
+        deadline = min(deadline, client_deadline)
     
     full_url = f"{pi_url}{endpoint}"
+    max_attempts = 1 + (REQUEST_RETRIES if idempotent else 0)
+    attempt = 0
     
-    try:
-        if method == 'GET':
-            response = requests.get(full_url, timeout=timeout)
-        elif method == 'POST':
-            response = requests.post(full_url, json=data, timeout=timeout)
-        else:
-            return {'error': f'Unsupported method: {method}'}, 400
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        try:
+            response = send_to_pi(pi_url, full_url, method, data, remaining, trace)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            # Back off before retrying, but only if the budget allows another attempt
+            backoff = RETRY_BACKOFF * (2 ** (attempt - 1))
+            backoff = random.uniform(backoff / 2, backoff)
+            if attempt < max_attempts and deadline - time.monotonic() > backoff:
+                time.sleep(backoff)
+                continue
+            
+            if isinstance(e, requests.exceptions.Timeout):
+                return {
+                    'error': f'Request to {pi_url} timed out after {timeout}s',
+                    'pi_url': pi_url,
+                    'attempts': attempt
+                }, 504
+            return {
+                'error': f'Could not connect to Pi at {pi_url}',
+                'pi_url': pi_url,
+                'attempts': attempt,
+                'suggestion': 'Check if Pi is online and accessible'
+            }, 503
+        except Exception as e:
+            return {
+                'error': f'Failed to communicate with Pi: {str(e)}',
+                'pi_url': pi_url
+            }, 500
         
         # Return the Pi's response
         try:
             return response.json(), response.status_code
         except:
             return {'response': response.text}, response.status_code
+
+
+def send_to_pi(pi_url, full_url, method, data, remaining, trace=None):
+    """
+    Make a single HTTP attempt to a Pi within the remaining time budget.
+    
+    Args:
+        pi_url: URL of the Pi (for metrics)
+        full_url: URL including the endpoint
+        method: 'GET' or 'POST'
+        data: JSON data for POST requests
+        remaining: Seconds left in the caller's budget
+        trace: Trace of the request being served, if any
+    
+    Returns:
+        requests.Response
+    
+    Raises:
+        requests.exceptions.Timeout: If the budget is already spent or the Pi is too slow
+        requests.exceptions.RequestException: On connection failures
+    """
+    ensure_initialized()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout('Deadline exceeded before the request was sent')
+    
+    # Propagate the request ID so the Pi's timings can be matched to ours,
+    # and our deadline so the Pi stops working when we stop waiting
+    headers = {DEADLINE_HEADER: str(int(remaining * 1000))}
+    if trace is not None:
+        headers[REQUEST_ID_HEADER] = trace.request_id
+    
+    # Fail fast on unreachable Pis so a retry still fits in the budget
+    request_timeout = (min(CONNECT_TIMEOUT, remaining), remaining)
+    pi_id = router.url_to_pi_id.get(pi_url, pi_url)
+    start = time.perf_counter()
+    
+    try:
+        if method == 'GET':
+            response = requests.get(full_url, headers=headers, timeout=request_timeout)
+        else:
+            response = requests.post(full_url, json=data, headers=headers, timeout=request_timeout)
+    except Exception as e:
+        upstream_errors.inc(pi_id, type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream_duration.observe(elapsed, pi_id, method)
+        if trace is not None:
+            trace.add('upstream', elapsed * 1000)
+    
+    if trace is not None:
+        record_pi_timings(trace, response)
+    return response
+
+
+def record_pi_timings(trace, response):
+    """
+    Merge a Pi's Server-Timing phases into the current request's trace.
+    
+    Pi phases are prefixed with 'pi_'. The gap between our wait for the
+    response headers and the Pi's own total is recorded as 'network'.
+    """
+    wait_ms = response.elapsed.total_seconds() * 1000
+    trace.add('upstream_wait', wait_ms)
+    
+    pi_timings = parse_server_timing(response.headers.get(SERVER_TIMING_HEADER))
+    for name, duration_ms in pi_timings.items():
+        trace.add(f'pi_{name}', duration_ms)
+    if 'total' in pi_timings:
+        trace.add('network', max(wait_ms - pi_timings['total'], 0.0))
+
+
+def coalesced_get(pi_url, endpoint, trace=None, deadline=None):
+    """
+    Forward a GET request to a Pi, sharing the result with any identical
+    request (same Pi and endpoint) that is already in flight.
+    
+    Args:
+        pi_url: URL of the Pi
+        endpoint: API endpoint (e.g., '/api/switch/list')
+        trace: Trace of the request being served (default: the current request's)
+        deadline: Monotonic deadline of the request being served (default: the current request's)
+    
+    Returns:
+        tuple: (response_json, status_code, sent_at), the first two as
+        forward_to_pi(); sent_at is the time.monotonic() when the shared
+        request was sent, so the states it returns held no earlier than that
+    """
+    if trace is None:
+        trace = current_trace()
+    if deadline is None:
+        deadline = current_deadline()
+    
+    def fetch():
+        sent_at = time.monotonic()
+        response, status_code = forward_to_pi(pi_url, endpoint, method='GET', trace=trace, deadline=deadline)
+        return response, status_code, sent_at
+    
+    start = time.perf_counter()
+    result, shared = pi_request_coalescer.do((pi_url, endpoint), fetch)
+    
+    # The leader's trace already holds the upstream timings
+    if shared:
+        if trace is not None:
+            trace.add('upstream_shared', (time.perf_counter() - start) * 1000)
+    return result
+
+
+# Config hot-reload
+config_reload_requested = Event()
+config_reload_lock = Lock()
+
+
+def diff_pi_configs(old_pis, new_pis):
+    """
+    Describe the differences between two raspberry_pis config sections.
+    
+    Returns:
+        list: Human-readable change descriptions (empty if nothing changed)
+    """
+    changes = []
+    
+    for pi_id in sorted(set(old_pis) - set(new_pis)):
+        changes.append(f"removed {pi_id}")
+    for pi_id in sorted(set(new_pis) - set(old_pis)):
+        changes.append(f"added {pi_id} ({new_pis[pi_id].get('ip_address')}:{new_pis[pi_id].get('port', 5001)})")
+    
+    for pi_id in sorted(set(old_pis) & set(new_pis)):
+        old, new = old_pis[pi_id], new_pis[pi_id]
+        for key in ('ip_address', 'port', 'chassis', 'num_relay_hats', 'relays_per_hat', 'description'):
+            if old.get(key) != new.get(key):
+                changes.append(f"{pi_id}: {key} {old.get(key)!r} -> {new.get(key)!r}")
+        
+        old_map = {k.upper(): v for k, v in (old.get('switch_mapping') or {}).items()}
+        new_map = {k.upper(): v for k, v in (new.get('switch_mapping') or {}).items()}
+        for name in sorted(set(old_map) - set(new_map)):
+            changes.append(f"{pi_id}: unmapped {name}")
+        for name in sorted(set(new_map) - set(old_map)):
+            changes.append(f"{pi_id}: mapped {name} -> HAT {new_map[name].get('hat')} relay {new_map[name].get('relay')}")
+        for name in sorted(set(old_map) & set(new_map)):
+            if old_map[name] != new_map[name]:
+                changes.append(
+                    f"{pi_id}: moved {name} HAT {old_map[name].get('hat')} relay {old_map[name].get('relay')}"
+                    f" -> HAT {new_map[name].get('hat')} relay {new_map[name].get('relay')}"
+                )
+
+    return changes
+
+
+def reload_config(reason='manual'):
+    """
+    Reload main_config.yaml and atomically swap in a freshly built router.
+    
+    The new config is validated and indexed off to the side; requests keep
+    using the old router until the single assignment that publishes the new
+    one. Cached status is kept for Pis whose address did not change.
+    
+    Args:
+        reason: What triggered the reload (for logging)
+    
+    Returns:
+        bool: True if the new config was applied, False if it was rejected
+    """
+    ensure_initialized()
+    with config_reload_lock:
+        try:
+            new_config = load_config(CONFIG_PATH)
+            validate_config(new_config)
+            new_router = PiRouter(new_config.get('raspberry_pis', {}))
+        except Exception as e:
+            print(f"Config reload ({reason}) rejected, keeping current config: {e}")
+            return False
+        
+        old_pis = router.pi_config
+        new_pis = new_router.pi_config
+        changes = diff_pi_configs(old_pis, new_pis)
+        for key in ('status_check_interval', 'request_timeout', 'config_watch_interval', 'state_cache_ttl',
+                    'request_retries', 'retry_backoff', 'connect_timeout', 'channel_timeout'):
+            if CONFIG.get(key) != new_config.get(key):
+                changes.append(f"{key} {CONFIG.get(key)!r} -> {new_config.get(key)!r}")
+        
+        # Publish the new config and router
+        apply_config(new_config, new_router)
+        
+        # Keep cached status only for Pis that still exist at the same address
+        pi_status_store.retain(
+            pi_id for pi_id, new in new_pis.items()
+            if (old_pis.get(pi_id, {}).get('ip_address'), old_pis.get(pi_id, {}).get('port', 5001))
+            == (new.get('ip_address'), new.get('port', 5001))
+        )
+    
+    if changes:
+        print(f"Config reloaded ({reason}) with {len(changes)} change(s):")
+        for change in changes:
+            print(f"   • {change}")
+    else:
+        print(f"Config reloaded ({reason}): no changes")
+    return True
+
+
+def apply_config(config, new_router):
+    """Publish a validated config and its router as the module's settings"""
+    global CONFIG, RASPBERRY_PIS, STATUS_CHECK_INTERVAL, REQUEST_TIMEOUT, CONFIG_WATCH_INTERVAL, STATE_CACHE_TTL
+    global REQUEST_RETRIES, RETRY_BACKOFF, CONNECT_TIMEOUT, EMERGENCY_TIMEOUT, EMERGENCY_ATTEMPT_TIMEOUT, router
+    global CHANNEL_TIMEOUT
+    
+    CONFIG = config
+    RASPBERRY_PIS = new_router.pi_config
+    STATUS_CHECK_INTERVAL = config.get('status_check_interval', 30)
+    REQUEST_TIMEOUT = config.get('request_timeout', 5)
+    CONFIG_WATCH_INTERVAL = config.get('config_watch_interval', 5)
+    STATE_CACHE_TTL = config.get('state_cache_ttl', 2)
+    REQUEST_RETRIES = config.get('request_retries', 2)
+    RETRY_BACKOFF = config.get('retry_backoff', 0.1)
+    CONNECT_TIMEOUT = config.get('connect_timeout', 1)
+    EMERGENCY_TIMEOUT = config.get('emergency_timeout', 5)
+    EMERGENCY_ATTEMPT_TIMEOUT = config.get('emergency_attempt_timeout', 1.5)
+    CHANNEL_TIMEOUT = config.get('channel_timeout', 1)
+    relay_state_cache.ttl = STATE_CACHE_TTL
+    router = new_router
+    pi_channels.sync(channel_endpoints(new_router))
+
+
+# Seconds spent in each startup phase, reported at /metrics
+startup_timings = {}
+init_lock = Lock()
+_settings_loaded = False
+_app_initialized = False
+
+
+def timed_phase(name, fn, *args):
+    """Run one startup phase, recording how long it took"""
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+
+def load_settings(config_path=None):
+    """
+    Load, validate and index the config on first use (idempotent).
+    
+    Only reads the config file: no database, threads or network. This is all
+    that happens when another module imports CONFIG or RASPBERRY_PIS.
+    
+    Args:
+        config_path: Config file to use instead of CONFIG_PATH
+    """
+    global CONFIG_PATH, _settings_loaded
+    with init_lock:
+        if _settings_loaded:
+            return
+        if config_path is not None:
+            CONFIG_PATH = Path(config_path)
+        config = timed_phase('load_config', load_config, CONFIG_PATH)
+        timed_phase('validate_config', validate_config, config)
+        new_router = timed_phase('build_router', PiRouter, config.get('raspberry_pis', {}))
+        apply_config(config, new_router)
+        _settings_loaded = True
+
+
+def init_app(config_path=None):
+    """
+    Set up everything the server needs before it handles requests (idempotent).
+    
+    Loads the settings, creates the status database and the shared worker
+    pool. Warns when startup takes longer than startup_budget_ms.
+    
+    Args:
+        config_path: Config file to use instead of CONFIG_PATH
+    """
+    global slow_request_log, fanout_pool, _app_initialized
+    load_settings(config_path)
+    with init_lock:
+        if _app_initialized:
+            return
+        timed_phase('init_status_db', init_status_db)
+        
+        # Commands slower than this (ms) are kept in a ring buffer at /api/trace/slow
+        slow_request_log = SlowRequestLog(
+            threshold_ms=CONFIG.get('slow_request_ms', 500),
+            size=CONFIG.get('slow_request_log_size', 200)
+        )
+        # Worker threads for querying many Pis at once (switch list, status checks)
+        fanout_pool = ThreadPoolExecutor(max_workers=CONFIG.get('fanout_workers', 16), thread_name_prefix='pi-fanout')
+        _app_initialized = True
+    
+    total_ms = sum(startup_timings.values()) * 1000
+    budget_ms = CONFIG.get('startup_budget_ms', 500)
+    if total_ms > budget_ms:
+        phases = ', '.join(f'{name} {seconds * 1000:.0f} ms' for name, seconds in startup_timings.items())
+        print(f"WARNING: startup took {total_ms:.0f} ms, over the {budget_ms} ms budget ({phases})")
+
+
+def ensure_initialized():
+    """
+    Run init_app() if it has not run yet.
+    
+    Code in this module reads the config-derived and resource globals by
+    bare name, which does not go through the module __getattr__, so those
+    names don't exist until init_app() has run. Functions that other modules
+    may call before create_app() (forward_to_pi, check_pi_status, ...) call
+    this first.
+    """
+    if not _app_initialized:
+        init_app()
+
+
+def watch_config():
+    """Background task reloading the config when the file changes or on SIGHUP"""
+    ensure_initialized()
+    
+    def mtime():
+        try:
+            return CONFIG_PATH.stat().st_mtime_ns
+        except OSError:
+            return None
+    
+    last_mtime = mtime()
+    while True:
+        interval = CONFIG_WATCH_INTERVAL if CONFIG_WATCH_INTERVAL and CONFIG_WATCH_INTERVAL > 0 else None
+        triggered = config_reload_requested.wait(timeout=interval)
+        try:
+            if triggered:
+                config_reload_requested.clear()
+                last_mtime = mtime()
+                reload_config('SIGHUP')
+                continue
             
-    except requests.exceptions.Timeout:
-        return {
-            'error': f'Request to {pi_url} timed out after {timeout}s',
+            current_mtime = mtime()
+            if current_mtime is not None and current_mtime != last_mtime:
+                last_mtime = current_mtime
+                reload_config('file change')
+        except Exception as e:
+            print(f"Error in config watch thread: {e}")
+
+
+def check_one_pi(pi_id, pi_data):
+    """Check the status of a single Pi, updating the status cache and history"""
+    ensure_initialized()
+    ip = pi_data.get('ip_address')
+    port = pi_data.get('port', 5001)
+    pi_url = f"http://{ip}:{port}"
+    
+    # Measure response time
+    start_time = time.time()
+    sent_at = time.monotonic()
+    
+    try:
+        response = requests.get(
+            f"{pi_url}/api/status",
+            timeout=REQUEST_TIMEOUT
+        )
+        response_time_ms = (time.time() - start_time) * 1000
+        status = 'online' if response.status_code == 200 else 'error'
+        
+        if pi_id not in router.pi_config:
+            return  # Pi removed by a config reload mid-cycle
+        pi_response = response.json() if response.status_code == 200 else None
+        pi_status_store.put(pi_id, {
+            'status': status,
+            'last_check': time.time(),
+            'response': pi_response,
             'pi_url': pi_url
-        }, 504
-    except requests.exceptions.ConnectionError:
-        return {
-            'error': f'Could not connect to Pi at {pi_url}',
-            'pi_url': pi_url,
-            'suggestion': 'Check if Pi is online and accessible'
-        }, 503
+        })
+        if pi_response is not None:
+            remember_hat_bitmaps(pi_url, pi_response, sent_at)
+        
+        # Log the status check
+        log_status_check(pi_id, status, error_msg=None, 
+                       response_time_ms=response_time_ms, pi_response=pi_response)
+        
     except Exception as e:
-        return {
-            'error': f'Failed to communicate with Pi: {str(e)}',
+        response_time_ms = (time.time() - start_time) * 1000
+        error_msg = str(e)
+        
+        if pi_id not in router.pi_config:
+            return  # Pi removed by a config reload mid-cycle
+        pi_status_store.put(pi_id, {
+            'status': 'offline',
+            'last_check': time.time(),
+            'error': error_msg,
             'pi_url': pi_url
-        }, 500
+        })
+        
+        # Log the failure
+        log_status_check(pi_id, 'offline', error_msg=error_msg, 
+                       response_time_ms=response_time_ms, pi_response=None)
+
+
+# Set on shutdown to stop the status poller
+poller_stop = Event()
+status_thread = None
 
 
 def check_pi_status():
-    """Background task to periodically check status of all Pis"""
-    while True:
+    """
+    Background task to periodically check status of all Pis.
+    
+    Every worker process runs this, but only the one holding the poller lease
+    sends heartbeats; the rest read its results from the shared status store
+    and retry the lease each interval, taking over if the leader has exited.
+    """
+    ensure_initialized()
+    while not poller_stop.is_set():
         try:
-            for pi_id, pi_data in RASPBERRY_PIS.items():
-                ip = pi_data.get('ip_address')
-                port = pi_data.get('port', 5001)
-                pi_url = f"http://{ip}:{port}"
-                
-                # Measure response time
-                start_time = time.time()
-                
-                try:
-                    response = requests.get(
-                        f"{pi_url}/api/status",
-                        timeout=REQUEST_TIMEOUT
-                    )
-                    response_time_ms = (time.time() - start_time) * 1000
-                    status = 'online' if response.status_code == 200 else 'error'
-                    
-                    with pi_status_lock:
-                        pi_status_cache[pi_id] = {
-                            'status': status,
-                            'last_check': time.time(),
-                            'response': response.json() if response.status_code == 200 else None,
-                            'pi_url': pi_url
-                        }
-                    
-                    # Log the status check
-                    if response.status_code == 200:
-                        pi_response = response.json()
-                    else:
-                        pi_response = None
-                    log_status_check(pi_id, status, error_msg=None, 
-                                   response_time_ms=response_time_ms, pi_response=pi_response)
-                    
-                except Exception as e:
-                    response_time_ms = (time.time() - start_time) * 1000
-                    error_msg = str(e)
-                    
-                    with pi_status_lock:
-                        pi_status_cache[pi_id] = {
-                            'status': 'offline',
-                            'last_check': time.time(),
-                            'error': error_msg,
-                            'pi_url': pi_url
-                        }
-                    
-                    # Log the failure
-                    log_status_check(pi_id, 'offline', error_msg=error_msg, 
-                                   response_time_ms=response_time_ms, pi_response=None)
-                    
+            if poller_lease.try_acquire():
+                current = router
+                pi_status_store.retain(current.pi_config)
+                # Check all Pis concurrently so one slow Pi doesn't delay the rest
+                pis = list(current.pi_config.items())
+                list(fanout_pool.map(lambda item: check_one_pi(*item), pis))
         except Exception as e:
             print(f"Error in status check thread: {e}")
         
-        time.sleep(STATUS_CHECK_INTERVAL)
+        poller_stop.wait(STATUS_CHECK_INTERVAL)
+
+
+def shutdown(timeout=10):
+    """
+    Stop background work before the process exits.
+    
+    Lets a status check cycle in progress finish, hands the poller lease to
+    another worker, and waits for queued commands to be written to the journal.
+    
+    Args:
+        timeout: Seconds to wait for each of the poller and the journal
+    """
+    poller_stop.set()
+    if status_thread is not None:
+        status_thread.join(timeout)
+    poller_lease.release()
+    pi_channels.close()
+    if not command_journal.flush(timeout):
+        print(f"Command journal not drained within {timeout}s, {command_journal.pending()} entries lost")
 
 
-def create_app():
+def create_app(config_path=None):
+    """
+    Create the main server app, starting its background threads.
+    
+    Args:
+        config_path: Config file to use instead of CONFIG_PATH (or CASM_CONFIG)
+    """
+    init_app(config_path)
     app = Flask(__name__)
+    install_tracing(app, slow_request_log)
+    install_metrics(app, metrics, 'casm_main')
+    install_deadlines(app)
     
     # Start status monitoring thread
+    global status_thread
     status_thread = Thread(target=check_pi_status, daemon=True)
     status_thread.start()
+    
+    # Start the command journal writer
+    command_journal.start()
+    
+    # Connect the control channels of Pis with a control_port (followed on reload)
+    pi_channels.enable(channel_endpoints(router))
+    
+    # Start config watcher and reload on SIGHUP (signals only work in the main thread).
+    # Under gunicorn this runs in each worker after the worker sets up its own
+    # signals, so a HUP sent to a worker reloads it in place; a HUP sent to the
+    # master is gunicorn's own reload, which replaces the workers.
+    watch_thread = Thread(target=watch_config, daemon=True)
+    watch_thread.start()
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: config_reload_requested.set())
+    except (AttributeError, ValueError):
+        pass  # No SIGHUP on this platform, or not running in the main thread
 
     @app.route('/')
     def index():
@@ -317,12 +1769,12 @@ def create_app():
     @app.route('/api/status', methods=['GET'])
     def status_check():
         """Status check endpoint showing status of main server and all Pis"""
-        with pi_status_lock:
-            pi_statuses = dict(pi_status_cache)
+        current = router
+        pi_statuses = pi_status_store.snapshot()
         
         # Merge config data with status data
         merged_statuses = {}
-        for pi_id, pi_config in RASPBERRY_PIS.items():
+        for pi_id, pi_config in current.pi_config.items():
             status_data = pi_statuses.get(pi_id, {'status': 'unknown'})
             merged_statuses[pi_id] = {
                 'ip_address': pi_config.get('ip_address'),
@@ -346,8 +1798,9 @@ def create_app():
             'main_server_status': 'online',
             'all_pis_online': all_online,
             'raspberry_pis': merged_statuses,
-            'total_pis': len(RASPBERRY_PIS),
-            'total_switches': len(router.get_all_switches())
+            'total_pis': len(current.pi_config),
+            'total_switches': len(current.get_all_switches()),
+            'request_coalescing': pi_request_coalescer.stats()
         })
     
     # ========== Switch Name Based API Endpoints ==========
@@ -355,51 +1808,54 @@ def create_app():
     @app.route('/api/switch/<switch_name>', methods=['GET'])
     def get_switch_state(switch_name):
         """Get the state of a switch by its logical name (e.g., CH1, CH1A)"""
-        pi_url = router.get_pi_for_switch(switch_name)
+        current = router
+        with trace_phase('route'):
+            pi_url = current.get_pi_for_switch(switch_name)
         
         if pi_url is None:
             return jsonify({
                 'error': f'Invalid switch name: {switch_name}',
-                'valid_switches': router.get_all_switches()
+                'valid_switches': current.get_all_switches()
             }), 400
         
-        response, status_code = forward_to_pi(
-            pi_url, 
-            f'/api/switch/{switch_name}',
-            method='GET'
-        )
+        response, status_code, sent_at = coalesced_get(pi_url, f'/api/switch/{switch_name.upper()}')
+        if status_code == 200 and isinstance(response, dict):
+            remember_switch_states(current, {switch_name: response.get('state')}, sent_at)
         
         return jsonify(response), status_code
     
     @app.route('/api/switch/<switch_name>', methods=['POST'])
     def set_switch_state(switch_name):
         """Set the state of a switch by its logical name"""
-        relay_info = router.get_relay_info(switch_name)
+        current = router
+        with trace_phase('route'):
+            relay_info = current.get_relay_info(switch_name)
         
         if relay_info is None:
             return jsonify({
                 'error': f'Invalid switch name: {switch_name}',
-                'valid_switches': router.get_all_switches()
+                'valid_switches': current.get_all_switches()
             }), 400
         
         data = request.get_json()
         if data is None or 'state' not in data:
             return jsonify({'error': 'Missing state in request body'}), 400
         
-        # Send complete relay instruction to Pi (hat, relay, state)
-        pi_data = {
-            'switch_name': switch_name.upper(),
-            'hat': relay_info['hat'],
-            'relay': relay_info['relay'],
-            'state': data['state']
-        }
+        # Skip the round trip if the relay was just seen in the requested state
+        pi_url, hat, relay = relay_info['pi_url'], relay_info['hat'], relay_info['relay']
+        pi_id = current.url_to_pi_id.get(pi_url)
+        if relay_state_cache.get_fresh(pi_url, hat, relay) == data['state']:
+            response = elided_write_response(switch_name.upper(), hat, relay, data['state'])
+            journal_command(switch_name.upper(), pi_id, hat, relay, data['state'], response, 200)
+            return jsonify(response)
         
-        response, status_code = forward_to_pi(
-            relay_info['pi_url'],
-            f'/api/relay/control',  # New endpoint on Pi that accepts full instructions
-            method='POST',
-            data=pi_data
-        )
+        # Send complete relay instruction to Pi (hat, relay, state)
+        response, status_code, answered_at = set_relay_on_pi(pi_url, switch_name.upper(), hat, relay, data['state'])
+        if status_code == 200:
+            relay_state_cache.update(pi_url, hat, relay, data['state'], answered_at)
+        else:
+            relay_state_cache.invalidate(pi_url, hat, relay, answered_at)
+        journal_command(switch_name.upper(), pi_id, hat, relay, data['state'], response, status_code)
         
         return jsonify(response), status_code
     
@@ -424,14 +1880,15 @@ def create_app():
             -> Controls Pi 1, HAT 0, Relay 1 (turns ON)
         """
         # Validate Pi ID
-        if pi_id not in RASPBERRY_PIS:
+        pis = router.pi_config
+        if pi_id not in pis:
             return jsonify({
                 'error': f'Invalid Pi ID: {pi_id}',
-                'valid_pis': list(RASPBERRY_PIS.keys())
+                'valid_pis': list(pis.keys())
             }), 400
         
         # Get Pi info
-        pi_config = RASPBERRY_PIS[pi_id]
+        pi_config = pis[pi_id]
         ip = pi_config.get('ip_address')
         port = pi_config.get('port', 5001)
         pi_url = f"http://{ip}:{port}"
@@ -441,8 +1898,9 @@ def create_app():
         if hat < 0 or hat >= num_hats:
             return jsonify({'error': f'Invalid HAT number. Must be 0-{num_hats-1}'}), 400
         
-        if relay < 1 or relay > 8:
-            return jsonify({'error': 'Invalid relay number. Must be 1-8'}), 400
+        relays_per_hat = pi_config.get('relays_per_hat', 8)
+        if relay < 1 or relay > relays_per_hat:
+            return jsonify({'error': f'Invalid relay number. Must be 1-{relays_per_hat}'}), 400
         
         # Get state from request
         data = request.get_json()
@@ -453,20 +1911,20 @@ def create_app():
         if state not in [0, 1]:
             return jsonify({'error': 'State must be 0 or 1'}), 400
         
-        # Send direct relay control to Pi (relay is already 1-based, no conversion!)
-        pi_data = {
-            'switch_name': f'{pi_id}_HAT{hat}_R{relay}',  # Descriptive name
-            'hat': hat,
-            'relay': relay,
-            'state': state
-        }
+        # Skip the round trip if the relay was just seen in the requested state
+        if relay_state_cache.get_fresh(pi_url, hat, relay) == state:
+            response = elided_write_response(f'{pi_id}_HAT{hat}_R{relay}', hat, relay, state)
+            journal_command(response['switch_name'], pi_id, hat, relay, state, response, 200)
+            return jsonify(response)
         
-        response, status_code = forward_to_pi(
-            pi_url,
-            f'/api/relay/control',
-            method='POST',
-            data=pi_data
-        )
+        # Send direct relay control to Pi (relay is already 1-based, no conversion!)
+        switch_name = f'{pi_id}_HAT{hat}_R{relay}'  # Descriptive name
+        response, status_code, answered_at = set_relay_on_pi(pi_url, switch_name, hat, relay, state)
+        if status_code == 200:
+            relay_state_cache.update(pi_url, hat, relay, state, answered_at)
+        else:
+            relay_state_cache.invalidate(pi_url, hat, relay, answered_at)
+        journal_command(switch_name, pi_id, hat, relay, state, response, status_code)
         
         return jsonify(response), status_code
     
@@ -485,14 +1943,15 @@ def create_app():
             -> Gets state of Pi 1, HAT 0, Relay 1
         """
         # Validate Pi ID
-        if pi_id not in RASPBERRY_PIS:
+        pis = router.pi_config
+        if pi_id not in pis:
             return jsonify({
                 'error': f'Invalid Pi ID: {pi_id}',
-                'valid_pis': list(RASPBERRY_PIS.keys())
+                'valid_pis': list(pis.keys())
             }), 400
         
         # Get Pi info
-        pi_config = RASPBERRY_PIS[pi_id]
+        pi_config = pis[pi_id]
         ip = pi_config.get('ip_address')
         port = pi_config.get('port', 5001)
         pi_url = f"http://{ip}:{port}"
@@ -502,15 +1961,14 @@ def create_app():
         if hat < 0 or hat >= num_hats:
             return jsonify({'error': f'Invalid HAT number. Must be 0-{num_hats-1}'}), 400
         
-        if relay < 1 or relay > 8:
-            return jsonify({'error': 'Invalid relay number. Must be 1-8'}), 400
+        relays_per_hat = pi_config.get('relays_per_hat', 8)
+        if relay < 1 or relay > relays_per_hat:
+            return jsonify({'error': f'Invalid relay number. Must be 1-{relays_per_hat}'}), 400
         
         # Forward to Pi (relay is already 1-based, no conversion needed!)
-        response, status_code = forward_to_pi(
-            pi_url,
-            f'/api/relay/{hat}/{relay}',
-            method='GET'
-        )
+        response, status_code, sent_at = coalesced_get(pi_url, f'/api/relay/{hat}/{relay}')
+        if status_code == 200 and isinstance(response, dict):
+            relay_state_cache.update(pi_url, hat, relay, response.get('state'), sent_at)
         
         return jsonify(response), status_code
     
@@ -518,75 +1976,140 @@ def create_app():
     
     @app.route('/api/switch/list', methods=['GET'])
     def list_all_switches():
-        """Get a list of all valid switch names and their current states from all Pis"""
+        """
+        Get a list of all valid switch names and their current states from all Pis.
+        
+        Pis whose states in the shared store are fresh (see shared_switch_states)
+        are not asked; the others are queried once each, all at the same time.
+        The response carries an ETag of its content, so pollers (capc --watch)
+        can send If-None-Match and get a bodyless 304 while nothing changed;
+        for an unchanged fleet that costs no Pi requests at all.
+        """
         all_switches = {}
         errors = []
+        current = router
+        by_pi = {pi_url: shared_switch_states(current, pi_url) for pi_url in current.pi_to_switches}
+        stale = [pi_url for pi_url, pi_switches in by_pi.items() if pi_switches is None]
         
-        # Group switches by Pi to minimize requests
-        pi_to_switches = {}
-        for switch_name in router.get_all_switches():
-            pi_url = router.get_pi_for_switch(switch_name)
-            if pi_url not in pi_to_switches:
-                pi_to_switches[pi_url] = []
-            pi_to_switches[pi_url].append(switch_name)
-        
-        # Query each Pi once for all its switches
-        for pi_url, switches in pi_to_switches.items():
-            response, status_code = forward_to_pi(
-                pi_url,
-                '/api/switch/list',
-                method='GET'
-            )
+        if stale:
+            # Pool threads have no request context; hand them this request's trace and deadline
+            trace, deadline = current_trace(), current_deadline()
+            with trace_phase('fanout', f'{len(stale)} Pis'):
+                results = list(fanout_pool.map(
+                    lambda pi_url: coalesced_get(pi_url, '/api/switch/list', trace, deadline), stale))
             
-            if status_code == 200 and isinstance(response, dict):
-                # Extract switches from Pi response (response format: {"switches": {...}})
-                pi_switches = response.get('switches', {})
-                all_switches.update(pi_switches)
-            else:
-                errors.append({
-                    'pi_url': pi_url,
-                    'error': response.get('error', 'Unknown error')
-                })
+            for pi_url, (response, status_code, sent_at) in zip(stale, results):
+                if status_code == 200 and isinstance(response, dict):
+                    # Extract switches from Pi response (response format: {"switches": {...}})
+                    by_pi[pi_url] = response.get('switches', {})
+                    remember_switch_states(current, by_pi[pi_url], sent_at)
+                else:
+                    errors.append({
+                        'pi_url': pi_url,
+                        'error': response.get('error', 'Unknown error')
+                    })
+        
+        for pi_switches in by_pi.values():
+            all_switches.update(pi_switches or {})
         
         result = {'switches': all_switches}
         if errors:
             result['errors'] = errors
         
-        return jsonify(result)
+        response = jsonify(result)
+        response.set_etag(switch_list_etag(result))
+        return response.make_conditional(request)
     
     @app.route('/api/switch/chassis/<int:chassis_num>', methods=['GET'])
     def get_chassis_switches(chassis_num):
         """Get all switches for a specific chassis"""
-        if chassis_num < 1 or chassis_num > 4:
-            return jsonify({'error': 'Chassis number must be 1-4'}), 400
-        
-        pi_info = router.get_pi_for_chassis(chassis_num)
+        current = router
+        with trace_phase('route'):
+            pi_info = current.get_pi_for_chassis(chassis_num)
         
         if pi_info is None:
             return jsonify({
                 'error': f'No Pi configured to control chassis {chassis_num}',
-                'available_chassis': sorted(router.chassis_to_pi.keys())
+                'available_chassis': sorted(current.chassis_to_pi.keys())
             }), 404
         
-        response, status_code = forward_to_pi(
-            pi_info['pi_url'],
-            f'/api/switch/chassis/{chassis_num}',
-            method='GET'
-        )
+        response, status_code, sent_at = coalesced_get(pi_info['pi_url'], f'/api/switch/chassis/{chassis_num}')
+        if status_code == 200 and isinstance(response, dict):
+            remember_switch_states(current, response.get('switches', {}), sent_at)
         
         return jsonify(response), status_code
     
+    # ========== Emergency ==========
+    
+    @app.route('/api/emergency/all-off', methods=['POST'])
+    def emergency_all_off():
+        """
+        Turn off every relay on every Pi, in parallel, and report what is confirmed off.
+        
+        Each Pi writes all its HATs and reads them back; the response lists
+        the HATs confirmed off per Pi. Skips the relay state cache and the
+        shared fan-out pool, and answers within emergency_timeout seconds.
+        Returns 200 only if every HAT on every Pi is confirmed off.
+        """
+        current = router
+        started = time.perf_counter()
+        with trace_phase('broadcast', f'{len(current.pi_config)} Pis'):
+            results = broadcast_all_off(current, EMERGENCY_TIMEOUT, EMERGENCY_ATTEMPT_TIMEOUT,
+                                        trace=current_trace(), deadline=current_deadline())
+        
+        pi_urls = {pi_id: pi_url for pi_url, pi_id in current.url_to_pi_id.items()}
+        pis = {}
+        for pi_id, (response, status_code, attempts) in results.items():
+            response = response if isinstance(response, dict) else {}
+            pi_url = pi_urls[pi_id]
+            confirmed = set(response.get('confirmed_off_hats', []))
+            # Keep the cache honest: confirmed HATs are off, anything else is unknown
+            positions = [(current.switch_to_relay[switch_name]['hat'], current.switch_to_relay[switch_name]['relay'])
+                         for switch_name in current.pi_to_switches.get(pi_url, ())]
+            relay_state_cache.update_many(pi_url, {(hat, relay): 0 for hat, relay in positions if hat in confirmed})
+            relay_state_cache.invalidate_many(pi_url, [(hat, relay) for hat, relay in positions if hat not in confirmed])
+            
+            pis[pi_id] = {
+                'all_off': status_code == 200 and bool(response.get('all_off')),
+                'confirmed_off_hats': sorted(confirmed),
+                'unconfirmed_hats': response.get('unconfirmed_hats', []),
+                'attempts': attempts,
+                'status_code': status_code
+            }
+            if 'error' in response:
+                pis[pi_id]['error'] = response['error']
+            journal_command('ALL', pi_id, None, None, 0, response, status_code)
+        
+        all_off = all(pi['all_off'] for pi in pis.values())
+        return jsonify({
+            'all_off': all_off,
+            'pis': pis,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+        }), 200 if all_off else 503
+    
     # ========== Direct Relay Control (if needed for debugging) ==========
     
+    @app.route('/api/topology', methods=['GET'])
+    def get_topology():
+        """
+        Get the switch -> Pi/HAT/relay map, for clients that talk to Pis directly.
+        
+        The ETag only changes when the config does; send If-None-Match to get
+        a bodyless 304 while a cached copy is still current.
+        """
+        current = router
+        response = jsonify(current.topology)
+        response.set_etag(current.topology_etag)
+        return response.make_conditional(request)
+    
     @app.route('/api/pis', methods=['GET'])
     def list_pis():
         """List all configured Raspberry Pis and their status"""
         pi_list = []
         
-        with pi_status_lock:
-            pi_statuses = dict(pi_status_cache)
+        pi_statuses = pi_status_store.snapshot()
         
-        for pi_id, pi_data in RASPBERRY_PIS.items():
+        for pi_id, pi_data in router.pi_config.items():
             status = pi_statuses.get(pi_id, {'status': 'unknown'})
             
             pi_list.append({
@@ -604,6 +2127,90 @@ def create_app():
             'total': len(pi_list)
         })
     
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Prometheus metrics for the main server"""
+        return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+    
+    @app.route('/api/trace/slow', methods=['GET'])
+    def slow_requests():
+        """
+        Get recently recorded slow commands, newest first.
+        
+        Query params:
+            limit: Maximum number of entries to return (default: all kept)
+        """
+        limit = request.args.get('limit', type=int)
+        entries = slow_request_log.snapshot(limit)
+        return jsonify({
+            'threshold_ms': slow_request_log.threshold_ms,
+            'slow_requests': entries,
+            'count': len(entries)
+        })
+    
+    @app.route('/api/commands', methods=['GET'])
+    def command_history():
+        """
+        Get journaled switch commands, newest first, with keyset pagination.
+        
+        Query params:
+            switch: Only commands for this switch name (e.g., CH2F)
+            since: Only commands at or after this time (Unix timestamp or ISO datetime)
+            until: Only commands before this time (Unix timestamp or ISO datetime)
+            limit: Page size (default 100, max 1000)
+            cursor: next_cursor from the previous page
+        """
+        def parse_time(value):
+            try:
+                return float(value)
+            except ValueError:
+                return datetime.fromisoformat(value).timestamp()
+        
+        clauses, params = [], []
+        try:
+            if request.args.get('switch'):
+                clauses.append('switch_name = ?')
+                params.append(request.args['switch'].upper())
+            if request.args.get('since'):
+                clauses.append('timestamp >= ?')
+                params.append(parse_time(request.args['since']))
+            if request.args.get('until'):
+                clauses.append('timestamp < ?')
+                params.append(parse_time(request.args['until']))
+            if request.args.get('cursor'):
+                cursor_time, cursor_id = request.args['cursor'].split(':')
+                clauses.append('(timestamp, id) < (?, ?)')
+                params.extend([float(cursor_time), int(cursor_id)])
+            limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+        
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f'''
+            SELECT * FROM switch_commands
+            {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit)).fetchall()
+        conn.close()
+        
+        commands = []
+        for row in rows:
+            command = dict(row)
+            command['datetime'] = datetime.fromtimestamp(row['timestamp']).isoformat()
+            if command['changed'] is not None:
+                command['changed'] = bool(command['changed'])
+            commands.append(command)
+        
+        return jsonify({
+            'commands': commands,
+            'count': len(commands),
+            'next_cursor': f"{rows[-1]['timestamp']!r}:{rows[-1]['id']}" if len(rows) == limit else None,
+            'pending_writes': command_journal.pending()
+        })
+    
     @app.route('/api/status/history', methods=['GET'])
     def status_history():
         """Get status check history from the database"""
@@ -615,8 +2222,7 @@ def create_app():
         except ValueError:
             limit = 100
         
-        db_path = Path(__file__).parent.parent / 'status_history.db'
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row  # Return rows as dicts
         cursor = conn.cursor()
         
@@ -662,8 +2268,7 @@ def create_app():
         """Get status statistics for all Pis"""
         pi_id_filter = request.args.get('pi_id')
         
-        db_path = Path(__file__).parent.parent / 'status_history.db'
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         
@@ -706,3 +2311,13 @@ def create_app():
 
     return app
 
+
+def __getattr__(name):
+    """Load the config on first access to a config-derived global (PEP 562)"""
+    if name in CONFIG_GLOBALS:
+        load_settings()
+        return globals()[name]
+    if name in RESOURCE_GLOBALS:
+        init_app()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -5,18 +5,32 @@ Startup script for CASM Analog Power Controller (Main Server)
 This script runs the main Flask server that routes requests to individual
 Raspberry Pis. This server does NOT control hardware directly - it acts
 as a coordinator and unified interface.
+
+By default the server runs under gunicorn with the settings in the
+'server.main' section of main_config.yaml. Use --dev for the Flask
+development server with the debugger and reloader.
 """
 
-from main_server import create_app, CONFIG, RASPBERRY_PIS
+import argparse
+from main_server import create_app, shutdown, CONFIG, RASPBERRY_PIS
+from serving import serve, server_settings
 
 if __name__ == '__main__':
-    app = create_app()
+    parser = argparse.ArgumentParser(description='Run the CASM main server')
+    parser.add_argument('--dev', action='store_true',
+                        help='Run the Flask development server (debugger and reloader on)')
+    args = parser.parse_args()
+    settings = server_settings('main', (CONFIG.get('server') or {}).get('main'))
     
     print("=" * 60)
     print("CASM Analog Power Controller - MAIN SERVER")
     print("=" * 60)
-    print("Server running on: http://0.0.0.0:5000")
-    print("Access locally at: http://localhost:5000")
+    if args.dev:
+        print("Server running on: http://0.0.0.0:5000 (development server)")
+        print("Access locally at: http://localhost:5000")
+    else:
+        print(f"Server running on: http://{settings['bind']} "
+              f"({settings['workers']} workers × {settings['threads']} threads)")
     print(f"Configured Raspberry Pis: {len(RASPBERRY_PIS)}")
     print()
     
@@ -32,9 +46,12 @@ if __name__ == '__main__':
     print("=" * 60)
     print("\nPress Ctrl+C to stop the server\n")
     
-    app.run(
-        host='0.0.0.0',
-        port=5000,
-        debug=True
-    )
-
+    if args.dev:
+        app = create_app()
+        app.run(
+            host='0.0.0.0',
+            port=5000,
+            debug=True
+        )
+    else:
+        serve(create_app, settings, on_shutdown=shutdown)
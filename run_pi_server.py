@@ -4,25 +4,45 @@ Startup script for CASM Analog Power Controller (Hardware Mode)
 
 This script runs the Flask application with hardware control for the
 Sequent Microsystems 16-relay boards.
+
+By default the server runs under gunicorn with the settings in the
+'server.pi' section of main_config.yaml, in a single worker process so
+that all requests share one I2C bus lock. Use --dev for the Flask
+development server with the debugger and reloader.
 """
 
-from hardware import create_app
+import argparse
+from hardware import create_app, shutdown, CONFIG, PI_ID, NUM_HATS, RELAYS_PER_HAT
+from serving import serve, server_settings
 
 if __name__ == '__main__':
-    app = create_app()
+    parser = argparse.ArgumentParser(description='Run the CASM Pi server')
+    parser.add_argument('--dev', action='store_true',
+                        help='Run the Flask development server (debugger and reloader on)')
+    args = parser.parse_args()
+    port = CONFIG.get('port', 5001)
+    settings = server_settings('pi', dict(CONFIG.get('server') or {}, bind=f'0.0.0.0:{port}'))
+    if settings['workers'] != 1:
+        print(f"Ignoring workers: {settings['workers']}, the Pi server runs a single worker")
+        settings['workers'] = 1
+    
     print("=" * 60)
     print("CASM Analog Power Controller - HARDWARE MODE")
     print("=" * 60)
-    print("Server running on: http://0.0.0.0:5001")
-    print("Access locally at: http://localhost:5001")
-    print("Controlling 1 board × 8 relays = 8 total relays")
+    mode = 'development server' if args.dev else f"{settings['threads']} threads"
+    print(f"Server running on: http://0.0.0.0:{port} ({mode})")
+    print(f"Access locally at: http://localhost:{port}")
+    print(f"{PI_ID}: {NUM_HATS} HATs × {RELAYS_PER_HAT} relays = {NUM_HATS * RELAYS_PER_HAT} total relays")
     print("CONNECTED TO REAL HARDWARE (8-relay boards)")
-    print("Deployment: 2 Pis × 3 HATs each (6 HATs total)")
     print("=" * 60)
     print("\nPress Ctrl+C to stop the server\n")
     
-    app.run(
-        host='0.0.0.0',
-        port=5001,
-        debug=True
-    )
+    if args.dev:
+        app = create_app()
+        app.run(
+            host='0.0.0.0',
+            port=port,
+            debug=True
+        )
+    else:
+        serve(create_app, settings, on_shutdown=shutdown)
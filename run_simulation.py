@@ -2,26 +2,87 @@
 """
 Startup script for CASM Analog Power Controller (Simulation Mode)
 
-This script runs the Flask application in simulation mode without
-requiring physical hardware. Useful for testing and development.
+This script runs a farm of simulated Raspberry Pis that serve the same API
+as the hardware app, one per Pi in main_config.yaml (or a synthetic fleet
+of any size), without requiring physical hardware. Point the main server at
+the farm to test or load-test it:
+
+    python run_simulation.py --write-config sim_config.yaml
+    CASM_CONFIG=sim_config.yaml python run_main_server.py
 """
 
-from simulation import create_app
+import argparse
+import time
+from simulation import SimulatorFarm, load_config, generate_fleet_config, CONFIG_PATH
+
+
+def parse_crash(value):
+    """Parse PI_ID:CRASH_AFTER:DOWN_FOR (seconds) for --crash"""
+    try:
+        pi_id, crash_after, down_for = value.split(':')
+        return pi_id, float(crash_after), float(down_for)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected PI_ID:CRASH_AFTER:DOWN_FOR, got '{value}'")
+
 
 if __name__ == '__main__':
-    app = create_app()
+    parser = argparse.ArgumentParser(description='Run simulated Raspberry Pis')
+    parser.add_argument('--config', default=str(CONFIG_PATH),
+                        help='Config whose Pis to simulate (default: main_config.yaml)')
+    parser.add_argument('--pis', type=int,
+                        help='Simulate a synthetic fleet of this many Pis instead of --config')
+    parser.add_argument('--chassis-per-pi', type=int, default=2, help='Chassis per synthetic Pi')
+    parser.add_argument('--snaps', type=int, default=11, help='SNAP switches per synthetic chassis')
+    parser.add_argument('--base-port', type=int, default=5101, help='Port of the first Pi')
+    parser.add_argument('--control-base-port', type=int,
+                        help='Serve the control channel on this port for the first Pi, numbered like --base-port')
+    parser.add_argument('--loopback', action='store_true',
+                        help='Give each Pi its own 127.0.0.x address on --base-port')
+    parser.add_argument('--i2c-ms', type=float, default=2.0, help='Latency of each I2C call (ms)')
+    parser.add_argument('--delay-ms', type=float, default=0.0, help='Network delay per request (ms)')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra network delay (ms)')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Fraction of requests dropped without a response (0-1)')
+    parser.add_argument('--crash', type=parse_crash, action='append', default=[],
+                        metavar='PI_ID:AFTER:DOWN_FOR',
+                        help='Crash a Pi AFTER seconds from start for DOWN_FOR seconds (repeatable)')
+    parser.add_argument('--write-config', default='sim_config.yaml',
+                        help='Where to write the config pointing at the simulated Pis')
+    args = parser.parse_args()
+
+    if args.pis:
+        config = generate_fleet_config(args.pis, args.chassis_per_pi, args.snaps)
+    else:
+        config = load_config(args.config)
+
+    farm = SimulatorFarm(
+        config, base_port=args.base_port, loopback=args.loopback,
+        i2c_latency=args.i2c_ms / 1000, network_delay=args.delay_ms / 1000,
+        network_jitter=args.jitter_ms / 1000, drop_rate=args.drop_rate,
+        control_base_port=args.control_base_port
+    )
+    farm.start()
+    config_path = farm.write_config(args.write_config)
+    if args.crash:
+        farm.schedule_crashes(args.crash)
+
     print("=" * 60)
     print("SIMULATION MODE - CASM Analog Power Controller")
     print("=" * 60)
-    print("Server running on: http://0.0.0.0:5001")
-    print("Access locally at: http://localhost:5001")
-    print("Simulating 6 stacks × 8 relays = 48 total relays")
+    for pi_id, pi in farm.pis.items():
+        print(f"   • {pi_id}: {pi.url} -> Chassis {pi.pi_config.get('chassis', [])}, "
+              f"{len(pi.switches)} switches"
+              f"{f', control channel on port {pi.control_server.port}' if pi.control_server else ''}")
+    print(f"I2C latency: {args.i2c_ms} ms, network delay: {args.delay_ms} ms "
+          f"(+{args.jitter_ms} ms jitter), drop rate: {args.drop_rate:.1%}")
     print("NO HARDWARE - This is SIMULATION mode")
+    print(f"Config for the main server written to {config_path}")
+    print(f"   CASM_CONFIG={config_path} python run_main_server.py")
     print("=" * 60)
-    print("\nPress Ctrl+C to stop the server\n")
-    
-    app.run(
-        host='0.0.0.0',
-        port=5001,
-        debug=True
-    )
+    print("\nPress Ctrl+C to stop the simulator\n")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        farm.stop()
@@ -0,0 +1,90 @@
+"""
+Production serving for the main server and the Pi server.
+
+Both apps run under gunicorn with threaded (gthread) workers instead of the
+Werkzeug development server. Worker/thread counts, timeouts and keep-alive
+come from the 'server' section of main_config.yaml:
+
+    server:
+      main: {workers: 2, threads: 8, timeout: 30, keepalive: 5, graceful_timeout: 15}
+      pi: {threads: 4}
+
+On SIGTERM/SIGINT each worker finishes its in-flight requests and then runs
+the app's shutdown hook before exiting.
+"""
+
+DEFAULT_SETTINGS = {
+    'main': {
+        'bind': '0.0.0.0:5000',
+        'workers': 2,
+        'threads': 8,
+        'timeout': 30,
+        'keepalive': 5,
+        'graceful_timeout': 15,
+    },
+    'pi': {
+        'bind': '0.0.0.0:5001',
+        'workers': 1,
+        'threads': 4,
+        'timeout': 30,
+        'keepalive': 5,
+        'graceful_timeout': 10,
+    },
+}
+
+
+def server_settings(role, overrides=None):
+    """
+    Serving settings for an app, defaults overlaid with values from the config.
+
+    Args:
+        role: 'main' or 'pi'
+        overrides: Mapping from the config's server section for this role
+
+    Returns:
+        dict: bind, workers, threads, timeout, keepalive, graceful_timeout
+    """
+    settings = dict(DEFAULT_SETTINGS[role])
+    settings.update({key: value for key, value in (overrides or {}).items() if key in settings})
+    return settings
+
+
+def serve(app_factory, settings, on_shutdown=None):
+    """
+    Run an app under gunicorn until it is stopped.
+
+    Args:
+        app_factory: Called once in each worker process to create the Flask app
+        settings: From server_settings()
+        on_shutdown: Called in each worker after it stops accepting requests,
+                     to flush and stop background work before the worker exits
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit(
+            "gunicorn is not installed. Install it with: pip install -r requirements.txt\n"
+            "(or run the development server with --dev)"
+        )
+
+    options = {
+        'bind': settings['bind'],
+        'workers': settings['workers'],
+        'threads': settings['threads'],
+        'worker_class': 'gthread',
+        'timeout': settings['timeout'],
+        'keepalive': settings['keepalive'],
+        'graceful_timeout': settings['graceful_timeout'],
+    }
+    if on_shutdown is not None:
+        options['worker_exit'] = lambda server, worker: on_shutdown()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app_factory()
+
+    Application().run()
@@ -1,117 +1,633 @@
 from flask import Flask, jsonify, request, render_template
+from werkzeug.serving import make_server
+import yaml
+import copy
+import random
+import re
+import socket
+import time
+import uuid
+from pathlib import Path
+from threading import Thread, Lock, Event
+from channel import ChannelServer
+from telemetry import install_tracing, SlowRequestLog, current_trace
 
-# Simulate 6 stacks of 8 relays each (48 total relays)
-# State: 0 = OFF, 1 = ON
-relay_state = {
-    'stack_0': [0] * 8,
-    'stack_1': [0] * 8,
-    'stack_2': [0] * 8,
-    'stack_3': [0] * 8,
-    'stack_4': [0] * 8,
-    'stack_5': [0] * 8,
-}
-
-
-def create_app():
-    app = Flask(__name__)
-
-    @app.route('/')
-    def index():
-        """Render the web UI showing all relay states"""
-        return render_template('index.html')
-
-    @app.route('/api/relay/<int:stack>/<int:relay>', methods=['GET'])
-    def get_relay_state(stack, relay):
-        """Get the state of a specific relay
-        
+# Simulated Pis serving the same API as the hardware app, driven by main_config.yaml.
+# Any number of virtual Pis can run in one process, each on its own address/port.
+
+REPO_ROOT = Path(__file__).parent.parent
+CONFIG_PATH = REPO_ROOT / 'main_config.yaml'
+
+# The virtual Pis serve the real Pi web UI
+HARDWARE_DIR = REPO_ROOT / 'hardware'
+
+SWITCH_NAME_PATTERN = re.compile(r'^CH(\d+)([A-Z]*)$')
+
+
+def load_config(config_path=CONFIG_PATH):
+    """Load main_config.yaml (or another config with the same layout)"""
+    with open(config_path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def switch_sort_key(switch_name):
+    """Sort key ordering switches by chassis number, then CH<n>, CH<n>A..Z, CH<n>AA.."""
+    match = SWITCH_NAME_PATTERN.match(switch_name.upper())
+    if match is None:
+        return (float('inf'), 0, switch_name)
+    return (int(match.group(1)), len(match.group(2)), match.group(2))
+
+
+def snap_suffix(index):
+    """SNAP letter(s) for a 0-based index: 0 -> A, 25 -> Z, 26 -> AA"""
+    suffix = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        suffix = chr(ord('A') + rem) + suffix
+    return suffix
+
+
+def generate_fleet_config(num_pis, chassis_per_pi=2, snaps_per_chassis=11, relays_per_hat=8):
+    """
+    Build a main_config.yaml-style config for a synthetic fleet.
+
+    Each Pi gets chassis_per_pi chassis, each with one CH<n> power switch and
+    snaps_per_chassis SNAP switches, packed onto as many HATs as needed.
+    Addresses are left for SimulatorFarm to assign.
+
+    Args:
+        num_pis: Number of Pis in the fleet
+        chassis_per_pi: Chassis controlled by each Pi
+        snaps_per_chassis: SNAP switches per chassis
+        relays_per_hat: Relays on each HAT
+
+    Returns:
+        dict: Config with a 'raspberry_pis' section
+    """
+    raspberry_pis = {}
+    chassis_num = 1
+    for pi_index in range(num_pis):
+        chassis = list(range(chassis_num, chassis_num + chassis_per_pi))
+        chassis_num += chassis_per_pi
+
+        names = []
+        for num in chassis:
+            names.append(f'CH{num}')
+            names.extend(f'CH{num}{snap_suffix(i)}' for i in range(snaps_per_chassis))
+
+        switch_mapping = {
+            name: {'hat': slot // relays_per_hat, 'relay': slot % relays_per_hat + 1}
+            for slot, name in enumerate(names)
+        }
+        raspberry_pis[f'pi_{pi_index + 1}'] = {
+            'ip_address': '127.0.0.1',
+            'port': 5001,
+            'chassis': chassis,
+            'description': f'Simulated Pi {pi_index + 1} - Chassis {chassis}',
+            'num_relay_hats': -(-len(names) // relays_per_hat),
+            'relays_per_hat': relays_per_hat,
+            'switch_mapping': switch_mapping
+        }
+    return {'raspberry_pis': raspberry_pis}
+
+
+class SimulatedRelayBoard:
+    """
+    In-memory stand-in for a stack of relay HATs, with the lib8relind call API.
+
+    Every call holds the simulated I2C bus for i2c_latency seconds, so
+    concurrent requests to one Pi queue up the way they do on hardware.
+    """
+
+    def __init__(self, num_hats, i2c_latency=0.0):
+        """
         Args:
-            stack: Stack number (0-5)
-            relay: Relay number (1-8)
-        
-        Returns:
-            JSON with relay state (0 or 1)
+            num_hats: Number of HATs on the stack
+            i2c_latency: Seconds each bus transaction takes
         """
-        if stack < 0 or stack > 5:
-            return jsonify({'error': 'Invalid stack. Must be 0-5'}), 400
-        if relay < 1 or relay > 8:
-            return jsonify({'error': 'Invalid relay. Must be 1-8'}), 400
-        
-        state = relay_state[f'stack_{stack}'][relay - 1]
+        self.bitmaps = [0] * num_hats
+        self.i2c_latency = i2c_latency
+        self.calls = 0
+        self.version = 0  # Bumped on every change, like hardware's state_version
+        self.on_change = None  # Called after every change, under the bus lock
+        self._lock = Lock()
+
+    def _transaction(self):
+        self.calls += 1
+        trace = current_trace()
+        if self.i2c_latency:
+            time.sleep(self.i2c_latency)
+        if trace is not None:
+            trace.add('i2c', self.i2c_latency * 1000)
+
+    def get(self, hat, relay_num):
+        with self._lock:
+            self._transaction()
+            return (self.bitmaps[hat] >> (relay_num - 1)) & 1
+
+    def set(self, hat, relay_num, state):
+        with self._lock:
+            self._transaction()
+            mask = 1 << (relay_num - 1)
+            self._store(hat, (self.bitmaps[hat] | mask) if state else (self.bitmaps[hat] & ~mask))
+
+    def get_all(self, hat):
+        with self._lock:
+            self._transaction()
+            return self.bitmaps[hat]
+
+    def set_all(self, hat, bitmap):
+        with self._lock:
+            self._transaction()
+            self._store(hat, bitmap)
+
+    def _store(self, hat, bitmap):
+        if self.bitmaps[hat] != bitmap:
+            self.bitmaps[hat] = bitmap
+            self.version += 1
+            if self.on_change is not None:
+                self.on_change()
+
+    def snapshot(self):
+        """Bitmaps and version as the hardware Pi knows them, without a bus call"""
+        with self._lock:
+            return list(self.bitmaps), self.version
+
+
+class VirtualPi:
+    """
+    One simulated Raspberry Pi serving the hardware API for its config section.
+
+    Fault injection:
+        network_delay: Seconds added before every request is handled
+        network_jitter: Extra random delay, uniform in [0, network_jitter]
+        drop_rate: Fraction of requests whose connection is closed without a response
+        crash(): Stop serving (connections are refused) until recover() is called
+
+    With control_port set, the Pi also serves the control channel; network
+    delay applies to its commands too, and a crash drops its connections.
+    """
+
+    def __init__(self, pi_id, pi_config, host='127.0.0.1', port=5001,
+                 i2c_latency=0.0, network_delay=0.0, network_jitter=0.0, drop_rate=0.0,
+                 control_port=None):
+        self.pi_id = pi_id
+        self.pi_config = pi_config
+        self.host = host
+        self.port = port
+        self.network_delay = network_delay
+        self.network_jitter = network_jitter
+        self.drop_rate = drop_rate
+        self.num_hats = pi_config['num_relay_hats']
+        self.relays_per_hat = pi_config['relays_per_hat']
+        self.board = SimulatedRelayBoard(self.num_hats, i2c_latency)
+        self.switch_mapping = {
+            name.upper(): (pos['hat'], pos['relay'])
+            for name, pos in pi_config.get('switch_mapping', {}).items()
+        }
+        self.switches = tuple(sorted(self.switch_mapping, key=switch_sort_key))
+        self.chassis_switches = {}
+        for name in self.switches:
+            match = SWITCH_NAME_PATTERN.match(name)
+            if match:
+                self.chassis_switches.setdefault(int(match.group(1)), []).append(name)
+        self.requests_dropped = 0
+        self.static_status = {
+            'status': 'online',
+            'pi_id': self.pi_id,
+            'boot_id': uuid.uuid4().hex[:16],  # The board, and so its version, survives crashes
+            'num_relay_hats': self.num_hats,
+            'relays_per_hat': self.relays_per_hat,
+            'total_switches': len(self.switches),
+            'switches': self.switches,
+            'simulated': True
+        }
+        self.app = self.create_app()
+        self._server = None
+        self._thread = None
+        self.control_server = None
+        if control_port:
+            self.control_server = ChannelServer(
+                control_port, self._channel_set_relay, self.board.snapshot, self.relays_per_hat, host=host,
+                boot_id=self.static_status['boot_id']
+            )
+            self.board.on_change = self.control_server.notify
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def running(self):
+        return self._server is not None
+
+    def start(self):
+        """Start serving on host:port in a background thread"""
+        if self._server is not None:
+            return
+        self._server = make_server(self.host, self.port, self.app, threaded=True)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True,
+                              name=f'sim-{self.pi_id}')
+        self._thread.start()
+        if self.control_server is not None:
+            self.control_server.start()
+
+    def stop(self):
+        """Stop serving; relay states are kept, like HATs across a Pi reboot"""
+        server, self._server = self._server, None
+        if server is None:
+            return
+        if self.control_server is not None:
+            self.control_server.stop()
+        server.shutdown()
+        server.server_close()
+        self._thread.join()
+
+    crash = stop
+    recover = start
+
+    def _network_delay(self):
+        delay = self.network_delay + random.uniform(0, self.network_jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _inject_faults(self):
+        """Apply network delay and drops before a request is handled"""
+        self._network_delay()
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.requests_dropped += 1
+            sock = request.environ.get('werkzeug.socket')
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return jsonify({'error': 'Simulated drop'}), 503
+        return None
+
+    def _check_hat(self, hat):
+        if hat < 0 or hat >= self.num_hats:
+            return jsonify({'error': f'Invalid HAT number. Must be 0-{self.num_hats-1}'}), 400
+        return None
+
+    def _check_relay(self, relay_num):
+        if relay_num < 1 or relay_num > self.relays_per_hat:
+            return jsonify({'error': f'Invalid relay. Must be 1-{self.relays_per_hat}'}), 400
+        return None
+
+    def _write_relay(self, hat, relay_num, state):
+        """Set one relay; returns False if it already held the state"""
+        if self.board.get(hat, relay_num) == state:
+            return False
+        self.board.set(hat, relay_num, state)
+        return True
+
+    def _channel_set_relay(self, hat, relay_num, state):
+        """Set one relay for a control channel command, as hardware's channel_set_relay()"""
+        self._network_delay()
+        if hat >= self.num_hats:
+            raise ValueError(f'Invalid HAT number. Must be 0-{self.num_hats-1}')
+        if relay_num < 1 or relay_num > self.relays_per_hat:
+            raise ValueError(f'Invalid relay. Must be 1-{self.relays_per_hat}')
+        if state not in (0, 1):
+            raise ValueError('State must be 0 or 1')
+        return self._write_relay(hat, relay_num, state)
+
+    def _write_all(self, bitmap):
+        """Set every HAT to bitmap; returns the HATs that changed"""
+        changed_hats = []
+        for hat in range(self.num_hats):
+            if self.board.get_all(hat) != bitmap:
+                self.board.set_all(hat, bitmap)
+                changed_hats.append(hat)
+        return changed_hats
+
+    def _invalid_switch(self, switch_name):
         return jsonify({
-            'stack': stack,
-            'relay': relay,
-            'state': state,
-            'status': 'ON' if state == 1 else 'OFF'
-        })
-
-    @app.route('/api/relay/<int:stack>/<int:relay>', methods=['POST'])
-    def set_relay_state(stack, relay):
-        """Set the state of a specific relay
-        
+            'error': f'Invalid switch name: {switch_name}',
+            'valid_switches': self.switches
+        }), 400
+
+    def create_app(self):
+        app = Flask(__name__,
+                    template_folder=str(HARDWARE_DIR / 'templates'),
+                    static_folder=str(HARDWARE_DIR / 'static'))
+        install_tracing(app, SlowRequestLog(threshold_ms=250, size=50))
+        app.before_request(self._inject_faults)
+        board = self.board
+
+        @app.route('/')
+        def index():
+            """Render the Pi web UI"""
+            return render_template('index.html')
+
+        @app.route('/api/status', methods=['GET'])
+        def status_check():
+            """Status check endpoint for main server to monitor this Pi"""
+            bitmaps, version = self.board.snapshot()
+            return jsonify(dict(self.static_status, hat_bitmaps=bitmaps, state_version=version))
+
+        @app.route('/api/relay/control', methods=['POST'])
+        def control_relay_direct():
+            """Control a relay with complete instructions from the main server"""
+            data = request.get_json(silent=True)
+            if data is None:
+                return jsonify({'error': 'Missing JSON data'}), 400
+
+            switch_name = data.get('switch_name')
+            hat, relay_num, state = data.get('hat'), data.get('relay'), data.get('state')
+            if hat is None or relay_num is None or state is None:
+                return jsonify({'error': 'Missing required fields: hat, relay, state'}), 400
+            error = self._check_hat(hat) or self._check_relay(relay_num)
+            if error:
+                return error
+            if state not in [0, 1]:
+                return jsonify({'error': 'State must be 0 or 1'}), 400
+
+            changed = self._write_relay(hat, relay_num, state)
+            return jsonify({
+                'success': True,
+                'switch_name': switch_name,
+                'hat': hat,
+                'relay': relay_num,
+                'state': state,
+                'status': 'ON' if state == 1 else 'OFF',
+                'changed': changed,
+                'message': f'{switch_name} (HAT {hat}, Relay {relay_num}) '
+                           f'{"turned" if changed else "already"} {"ON" if state == 1 else "OFF"}'
+            })
+
+        @app.route('/api/relay/<int:hat>/<int:relay_num>', methods=['GET'])
+        def get_relay_state(hat, relay_num):
+            """Get the state of a specific relay"""
+            error = self._check_hat(hat) or self._check_relay(relay_num)
+            if error:
+                return error
+            state = board.get(hat, relay_num)
+            return jsonify({
+                'hat': hat,
+                'relay': relay_num,
+                'state': state,
+                'status': 'ON' if state == 1 else 'OFF'
+            })
+
+        @app.route('/api/relay/<int:hat>/<int:relay_num>', methods=['POST'])
+        def set_relay_state(hat, relay_num):
+            """Set the state of a specific relay"""
+            error = self._check_hat(hat) or self._check_relay(relay_num)
+            if error:
+                return error
+            data = request.get_json(silent=True)
+            if data is None or 'state' not in data:
+                return jsonify({'error': 'Missing state in request body'}), 400
+            new_state = data['state']
+            if new_state not in [0, 1]:
+                return jsonify({'error': 'State must be 0 (OFF) or 1 (ON)'}), 400
+
+            changed = self._write_relay(hat, relay_num, new_state)
+            return jsonify({
+                'hat': hat,
+                'relay': relay_num,
+                'state': new_state,
+                'status': 'ON' if new_state == 1 else 'OFF',
+                'changed': changed,
+                'message': f'HAT {hat}, Relay {relay_num} {"turned" if changed else "already"} {"ON" if new_state == 1 else "OFF"}'
+            })
+
+        def hat_relays(hat):
+            bitmap = board.get_all(hat)
+            return [(bitmap >> relay_num) & 1 for relay_num in range(self.relays_per_hat)]
+
+        @app.route('/api/relay/all', methods=['GET'])
+        def get_all_relays():
+            """Get the state of all relays across all HATs"""
+            return jsonify({f'hat_{hat}': hat_relays(hat) for hat in range(self.num_hats)})
+
+        @app.route('/api/relay/hat/<int:hat>', methods=['GET'])
+        def get_hat_state(hat):
+            """Get the state of all relays in a specific HAT"""
+            error = self._check_hat(hat)
+            if error:
+                return error
+            return jsonify({'hat': hat, 'relays': hat_relays(hat)})
+
+        @app.route('/api/relay/hat/<int:hat>/all-<action>', methods=['POST'])
+        def set_hat(hat, action):
+            """Turn all relays on a specific HAT on or off"""
+            error = self._check_hat(hat)
+            if error:
+                return error
+            if action not in ('on', 'off'):
+                return jsonify({'error': 'Action must be all-on or all-off'}), 404
+            bitmap = (1 << self.relays_per_hat) - 1 if action == 'on' else 0
+            changed = board.get_all(hat) != bitmap
+            if changed:
+                board.set_all(hat, bitmap)
+            return jsonify({
+                'hat': hat,
+                'changed': changed,
+                'message': f'All relays {"" if changed else "already "}{action.upper()} for HAT {hat}'
+            })
+
+        @app.route('/api/relay/all-on', methods=['POST'])
+        def turn_on_all_hats():
+            """Turn on all relays across ALL HATs"""
+            changed_hats = self._write_all((1 << self.relays_per_hat) - 1)
+            return jsonify({
+                'message': 'All ON command sent to all HATs',
+                'changed': bool(changed_hats),
+                'changed_hats': changed_hats
+            })
+
+        @app.route('/api/relay/all-off', methods=['POST'])
+        def turn_off_all_hats():
+            """Turn off all relays across ALL HATs"""
+            changed_hats = self._write_all(0)
+            return jsonify({
+                'message': 'All OFF command sent to all HATs',
+                'changed': bool(changed_hats),
+                'changed_hats': changed_hats
+            })
+
+        @app.route('/api/emergency/all-off', methods=['POST'])
+        def emergency_off():
+            """Turn off every relay, confirmed by reading each HAT back"""
+            started = time.perf_counter()
+            for hat in range(self.num_hats):
+                board.set_all(hat, 0)
+            unconfirmed = [hat for hat in range(self.num_hats) if board.get_all(hat) != 0]
+            return jsonify({
+                'pi_id': self.pi_id,
+                'all_off': not unconfirmed,
+                'confirmed_off_hats': [hat for hat in range(self.num_hats) if hat not in unconfirmed],
+                'unconfirmed_hats': [{'hat': hat, 'reason': 'read back non-zero'} for hat in unconfirmed],
+                'rounds': 1,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+            }), 200 if not unconfirmed else 500
+
+        @app.route('/api/switch/<switch_name>', methods=['GET'])
+        def get_switch_state(switch_name):
+            """Get the state of a switch by its logical name"""
+            position = self.switch_mapping.get(switch_name.upper())
+            if position is None:
+                return self._invalid_switch(switch_name)
+            hat, relay_num = position
+            state = board.get(hat, relay_num)
+            return jsonify({
+                'switch_name': switch_name.upper(),
+                'hat': hat,
+                'relay': relay_num,
+                'state': state,
+                'status': 'ON' if state == 1 else 'OFF'
+            })
+
+        @app.route('/api/switch/<switch_name>', methods=['POST'])
+        def set_switch_state(switch_name):
+            """Set the state of a switch by its logical name"""
+            position = self.switch_mapping.get(switch_name.upper())
+            if position is None:
+                return self._invalid_switch(switch_name)
+            hat, relay_num = position
+            data = request.get_json(silent=True)
+            if data is None or 'state' not in data:
+                return jsonify({'error': 'Missing state in request body'}), 400
+            new_state = data['state']
+            if new_state not in [0, 1]:
+                return jsonify({'error': 'State must be 0 (OFF) or 1 (ON)'}), 400
+
+            changed = self._write_relay(hat, relay_num, new_state)
+            return jsonify({
+                'switch_name': switch_name.upper(),
+                'hat': hat,
+                'relay': relay_num,
+                'state': new_state,
+                'status': 'ON' if new_state == 1 else 'OFF',
+                'changed': changed,
+                'message': f'{switch_name.upper()} {"turned" if changed else "already"} {"ON" if new_state == 1 else "OFF"}'
+            })
+
+        @app.route('/api/switch/list', methods=['GET'])
+        def list_all_switches():
+            """Get all switch names and their current states"""
+            bitmaps = {hat: board.get_all(hat) for hat in range(self.num_hats)}
+            response = jsonify({'switches': {
+                name: (bitmaps[hat] >> (relay_num - 1)) & 1
+                for name in self.switches
+                for hat, relay_num in [self.switch_mapping[name]]
+            }})
+            response.add_etag()
+            return response.make_conditional(request)
+
+        @app.route('/api/switch/chassis/<int:chassis_num>', methods=['GET'])
+        def get_chassis_switches(chassis_num):
+            """Get all switches for a specific chassis"""
+            chassis_name = f'CH{chassis_num}'
+            names = self.chassis_switches.get(chassis_num)
+            if not names:
+                return jsonify({
+                    'error': f'No switches mapped for chassis {chassis_num} on this Pi',
+                    'available_chassis': sorted(self.chassis_switches)
+                }), 404
+
+            switches = {}
+            for name in names:
+                state = board.get(*self.switch_mapping[name])
+                switches[name] = {
+                    'state': state,
+                    'status': 'ON' if state == 1 else 'OFF',
+                    'type': 'chassis' if name == chassis_name else 'BACboard'
+                }
+            return jsonify({'chassis': chassis_num, 'switches': switches})
+
+        return app
+
+
+class SimulatorFarm:
+    """
+    Host a virtual Pi for every entry in a config, all in one process.
+
+    Pis are placed either on consecutive ports of one address, or (loopback=True)
+    on distinct loopback addresses 127.0.0.2, 127.0.0.3, ... sharing one port,
+    which keeps the per-Pi URLs distinct the way a real fleet's are. write_config()
+    saves a copy of the config pointing at the simulated addresses, for the main
+    server to load with CASM_CONFIG.
+    """
+
+    def __init__(self, config, host='127.0.0.1', base_port=5101, loopback=False,
+                 i2c_latency=0.0, network_delay=0.0, network_jitter=0.0, drop_rate=0.0,
+                 control_base_port=None):
+        """
         Args:
-            stack: Stack number (0-5)
-            relay: Relay number (1-8)
-        
-        Body:
-            JSON with 'state': 0 (OFF) or 1 (ON)
-        
-        Returns:
-            JSON with updated relay state
+            config: Parsed main_config.yaml (or generate_fleet_config() output)
+            host: Address for all Pis when loopback is False
+            base_port: Port of the first Pi (loopback=False), or of every Pi (loopback=True)
+            loopback: Give each Pi its own 127.0.0.x address
+            i2c_latency, network_delay, network_jitter, drop_rate: Passed to every VirtualPi
+            control_base_port: Control channel port, numbered like base_port (default: no channel)
         """
-        if stack < 0 or stack > 5:
-            return jsonify({'error': 'Invalid stack. Must be 0-5'}), 400
-        if relay < 1 or relay > 8:
-            return jsonify({'error': 'Invalid relay. Must be 1-8'}), 400
-        
-        data = request.get_json()
-        if data is None or 'state' not in data:
-            return jsonify({'error': 'Missing state in request body'}), 400
-        
-        new_state = data['state']
-        if new_state not in [0, 1]:
-            return jsonify({'error': 'State must be 0 (OFF) or 1 (ON)'}), 400
-        
-        # Update the relay state (simulating hardware control)
-        relay_state[f'stack_{stack}'][relay - 1] = new_state
-        
-        return jsonify({
-            'stack': stack,
-            'relay': relay,
-            'state': new_state,
-            'status': 'ON' if new_state == 1 else 'OFF',
-            'message': f'Stack {stack}, Relay {relay} turned {"ON" if new_state == 1 else "OFF"}'
-        })
-
-    @app.route('/api/relay/all', methods=['GET'])
-    def get_all_relays():
-        """Get the state of all relays"""
-        return jsonify(relay_state)
-
-    @app.route('/api/relay/stack/<int:stack>', methods=['GET'])
-    def get_stack_state(stack):
-        """Get the state of all relays in a specific stack
-        
+        self.config = copy.deepcopy(config)
+        self.pis = {}
+        for index, (pi_id, pi_config) in enumerate(self.config['raspberry_pis'].items()):
+            if loopback:
+                pi_host, pi_port = f'127.0.0.{index + 2}', base_port
+            else:
+                pi_host, pi_port = host, base_port + index
+            pi_config['ip_address'] = pi_host
+            pi_config['port'] = pi_port
+            if control_base_port:
+                pi_config['control_port'] = control_base_port + (pi_port - base_port)
+            else:
+                pi_config.pop('control_port', None)
+            self.pis[pi_id] = VirtualPi(
+                pi_id, pi_config, host=pi_host, port=pi_port,
+                i2c_latency=i2c_latency, network_delay=network_delay,
+                network_jitter=network_jitter, drop_rate=drop_rate,
+                control_port=pi_config.get('control_port')
+            )
+        self._stop = Event()
+        self._scheduler = None
+
+    def start(self):
+        """Start every virtual Pi"""
+        for pi in self.pis.values():
+            pi.start()
+
+    def stop(self):
+        """Stop the crash scheduler and every virtual Pi"""
+        self._stop.set()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        for pi in self.pis.values():
+            pi.stop()
+
+    def write_config(self, path):
+        """Save the config with each Pi's simulated address and port"""
+        with open(path, 'w') as f:
+            yaml.safe_dump(self.config, f, sort_keys=False)
+        return Path(path)
+
+    def schedule_crashes(self, schedule):
+        """
+        Crash and recover Pis on a timetable, in a background thread.
+
         Args:
-            stack: Stack number (0-5)
+            schedule: List of (pi_id, crash_after, down_for) in seconds from now
         """
-        if stack < 0 or stack > 5:
-            return jsonify({'error': 'Invalid stack. Must be 0-5'}), 400
-        
-        return jsonify({
-            'stack': stack,
-            'relays': relay_state[f'stack_{stack}']
-        })
-
-    @app.route('/api/relay/reset', methods=['POST'])
-    def reset_all_relays():
-        """Turn off all relays"""
-        for stack in relay_state:
-            relay_state[stack] = [0] * 8
-        
-        return jsonify({
-            'message': 'All relays turned OFF',
-            'state': relay_state
-        })
+        events = []
+        for pi_id, crash_after, down_for in schedule:
+            pi = self.pis[pi_id]
+            events.append((crash_after, 'crash', pi))
+            events.append((crash_after + down_for, 'recover', pi))
+        events.sort(key=lambda event: event[0])
 
-    return app
+        def run():
+            started = time.monotonic()
+            for at, action, pi in events:
+                if self._stop.wait(max(0.0, started + at - time.monotonic())):
+                    return
+                print(f"[{time.monotonic() - started:7.2f}s] {pi.pi_id} {action}")
+                getattr(pi, action)()
 
+        self._scheduler = Thread(target=run, daemon=True, name='sim-crash-schedule')
+        self._scheduler.start()
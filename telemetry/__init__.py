@@ -0,0 +1,485 @@
+"""
+Request tracing and metrics shared by the main server and the Pi server.
+
+Each request gets a RequestTrace holding per-phase timings (routing, upstream
+wait, bus wait, I2C calls, ...). The timings are returned to the caller in a
+Server-Timing header together with an X-Request-ID, so the main server can
+merge the Pi's phases into its own response. Slow requests are kept in a
+bounded ring buffer that the apps expose through an endpoint.
+
+Counters and latency histograms live in a MetricsRegistry rendered in the
+Prometheus text format at /metrics.
+"""
+
+from flask import g, has_request_context, request, jsonify
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+import time
+import uuid
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+SERVER_TIMING_HEADER = 'Server-Timing'
+# Milliseconds the caller is still willing to wait for the response
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+
+
+class RequestTrace:
+    """
+    Accumulates named phase timings for a single request.
+    
+    Safe to share with worker threads that do part of the request's work
+    (e.g., fan-out to several Pis).
+    """
+    
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.phases = {}  # name -> [duration_ms, count, description]
+        self._lock = Lock()
+    
+    def add(self, name, duration_ms, description=None):
+        """
+        Add time to a phase. Repeated phases (e.g., several I2C calls) are summed.
+        
+        Args:
+            name: Phase name (token characters only, e.g., 'i2c', 'pi_bus_wait')
+            duration_ms: Time spent in milliseconds
+            description: Optional description shown in Server-Timing
+        """
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                self.phases[name] = [duration_ms, 1, description]
+            else:
+                phase[0] += duration_ms
+                phase[1] += 1
+                if description:
+                    phase[2] = description
+    
+    @contextmanager
+    def phase(self, name, description=None):
+        """Time the enclosed block as the given phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000, description)
+    
+    def elapsed_ms(self):
+        """Time since the request started, in milliseconds"""
+        return (time.perf_counter() - self.started) * 1000
+    
+    def to_dict(self):
+        """Phase timings as {name: {'ms': float, 'count': int}}"""
+        with self._lock:
+            phases = [(name, list(phase)) for name, phase in self.phases.items()]
+        return {
+            name: {'ms': round(ms, 3), 'count': count}
+            for name, (ms, count, _) in phases
+        }
+    
+    def server_timing(self, total_ms=None):
+        """Render the phases as a Server-Timing header value"""
+        with self._lock:
+            phases = [(name, list(phase)) for name, phase in self.phases.items()]
+        parts = []
+        for name, (ms, count, description) in phases:
+            part = f'{name};dur={ms:.3f}'
+            if description:
+                part += f';desc="{description}"'
+            elif count > 1:
+                part += f';desc="{count} calls"'
+            parts.append(part)
+        if total_ms is not None:
+            parts.append(f'total;dur={total_ms:.3f}')
+        return ', '.join(parts)
+
+
+def parse_server_timing(header):
+    """
+    Parse a Server-Timing header value.
+    
+    Args:
+        header: e.g. 'bus_wait;dur=0.012, i2c;dur=2.5;desc="2 calls", total;dur=3.1'
+    
+    Returns:
+        dict: {name: duration_ms} for every metric that carries a duration
+    """
+    timings = {}
+    if not header:
+        return timings
+    
+    for metric in header.split(','):
+        fields = [field.strip() for field in metric.split(';')]
+        name = fields[0]
+        for field in fields[1:]:
+            if field.startswith('dur='):
+                try:
+                    timings[name] = timings.get(name, 0.0) + float(field[4:])
+                except ValueError:
+                    pass
+    return timings
+
+
+def current_trace():
+    """Get the trace of the request being handled, or None outside a request"""
+    if not has_request_context():
+        return None
+    return g.get('trace')
+
+
+@contextmanager
+def trace_phase(name, description=None):
+    """Time the enclosed block as a phase of the current request (no-op outside a request)"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    with trace.phase(name, description):
+        yield
+
+
+class SlowRequestLog:
+    """Bounded ring buffer of requests that exceeded a latency threshold"""
+    
+    def __init__(self, threshold_ms=500, size=200):
+        """
+        Args:
+            threshold_ms: Requests at least this slow are recorded
+            size: Maximum number of entries kept (oldest are dropped first)
+        """
+        self.threshold_ms = threshold_ms
+        self._entries = deque(maxlen=size)
+        self._lock = Lock()
+    
+    def record(self, entry):
+        """Append an entry (a dict with at least 'total_ms')"""
+        with self._lock:
+            self._entries.append(entry)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def snapshot(self, limit=None):
+        """Get recorded entries, newest first"""
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        return entries[:limit] if limit else entries
+
+
+def install_tracing(app, slow_log, slow_methods=('POST',)):
+    """
+    Attach per-request tracing to a Flask app.
+    
+    Every response gets X-Request-ID (taken from the incoming request when the
+    caller supplied one) and a Server-Timing header with the recorded phases.
+    Requests with a method in slow_methods that take at least
+    slow_log.threshold_ms are recorded in slow_log.
+    
+    Args:
+        app: Flask application
+        slow_log: SlowRequestLog receiving slow requests
+        slow_methods: HTTP methods considered commands for the slow log
+    """
+    @app.before_request
+    def _start_trace():
+        g.trace = RequestTrace(request.headers.get(REQUEST_ID_HEADER))
+    
+    @app.after_request
+    def _finish_trace(response):
+        trace = g.get('trace')
+        if trace is None:
+            return response
+        
+        total_ms = trace.elapsed_ms()
+        response.headers[REQUEST_ID_HEADER] = trace.request_id
+        response.headers[SERVER_TIMING_HEADER] = trace.server_timing(total_ms)
+        
+        if request.method in slow_methods and total_ms >= slow_log.threshold_ms:
+            slow_log.record({
+                'request_id': trace.request_id,
+                'timestamp': time.time(),
+                'method': request.method,
+                'path': request.path,
+                'status_code': response.status_code,
+                'client': request.remote_addr,
+                'total_ms': round(total_ms, 3),
+                'phases': trace.to_dict()
+            })
+        return response
+
+
+# ========== Deadlines ==========
+
+class DeadlineExceeded(Exception):
+    """The caller's deadline passed before the work could be done"""
+
+
+def deadline_exceeded(message):
+    """
+    Build a DeadlineExceeded for the current request, flagging the request so
+    its response is reported as 504 even if a route converts the error to 500.
+    """
+    if has_request_context():
+        g.deadline_exceeded = True
+    return DeadlineExceeded(message)
+
+
+def install_deadlines(app):
+    """
+    Honour the caller's deadline header in a Flask app.
+    
+    The remaining budget is converted to a local monotonic deadline on
+    arrival (so clocks need not agree), and requests that arrive with no
+    budget left are rejected with 504 before doing any work.
+    """
+    @app.before_request
+    def _start_deadline():
+        budget_ms = request.headers.get(DEADLINE_HEADER)
+        if budget_ms is None:
+            return None
+        try:
+            budget = float(budget_ms) / 1000
+        except ValueError:
+            return None
+        if budget <= 0:
+            return jsonify({'error': 'Deadline exceeded before the request was handled'}), 504
+        g.deadline = time.monotonic() + budget
+        return None
+    
+    @app.errorhandler(DeadlineExceeded)
+    def _deadline_exceeded(e):
+        return jsonify({'error': str(e)}), 504
+    
+    @app.after_request
+    def _report_deadline(response):
+        # Routes that turn any failure into a 500 still report an abandoned request as 504
+        if g.get('deadline_exceeded') and response.status_code == 500:
+            response.status_code = 504
+        return response
+
+
+def current_deadline():
+    """
+    Monotonic deadline of the current request.
+    
+    Worker threads have no request context, so capture this in the request
+    thread and hand it to work done on the request's behalf.
+    
+    Returns:
+        float: time.monotonic() value of the deadline, or None if there is none
+    """
+    if not has_request_context():
+        return None
+    return g.get('deadline')
+
+
+def time_remaining():
+    """
+    Seconds left before the current request's deadline.
+    
+    Returns:
+        float: Remaining seconds (may be negative), or None if there is no deadline
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# ========== Metrics ==========
+
+# Latency buckets in seconds: sub-millisecond I2C calls up to multi-second timeouts
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """Render a Prometheus label set, e.g. {route="/api/status",method="GET"}"""
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    rendered = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + rendered + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonically increasing counter with a fixed set of label names"""
+    
+    type_name = 'counter'
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # labelvalues tuple -> count
+        self._lock = Lock()
+    
+    def inc(self, *labelvalues, amount=1):
+        """Add amount to the series identified by the label values"""
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in sorted(items):
+            yield self.name + _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram:
+    """Latency histogram (seconds) with a fixed set of label names"""
+    
+    type_name = 'histogram'
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labelvalues tuple -> [bucket counts..., +Inf count, sum]
+        self._lock = Lock()
+    
+    def observe(self, value, *labelvalues):
+        """Record one observation (in seconds) for the series identified by the label values"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    def samples(self):
+        with self._lock:
+            items = [(labelvalues, list(series)) for labelvalues, series in self._series.items()]
+        for labelvalues, series in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                yield (
+                    self.name + '_bucket' + _format_labels(self.labelnames, labelvalues, ('le', _format_value(float(bound)))),
+                    cumulative
+                )
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield self.name + '_sum' + labels, round(series[-1], 6)
+            yield self.name + '_count' + labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered together in the Prometheus text format.
+    
+    Counters and histograms are updated on the hot path; values that already
+    exist elsewhere (cache sizes, coalescing counters, ...) are read at scrape
+    time through collectors instead of being mirrored on every request.
+    """
+    
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+    
+    def _register(self, metric):
+        # Return the existing metric so repeated create_app() calls share series
+        for existing in self._metrics:
+            if existing.name == metric.name:
+                return existing
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labelnames=()):
+        """Create and register a Counter (or get the existing one with that name)"""
+        return self._register(Counter(name, help_text, labelnames))
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a Histogram (or get the existing one with that name)"""
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+    
+    def register_collector(self, collector):
+        """
+        Register a function called at scrape time.
+        
+        The function returns an iterable of (name, type, help, samples) where
+        samples is a list of (labels_dict, value).
+        """
+        self._collectors.append(collector)
+    
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for series, value in metric.samples():
+                lines.append(f'{series} {_format_value(value)}')
+        
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                lines.append(f'# collector {getattr(collector, "__name__", collector)} failed: {e}')
+                continue
+            for name, type_name, help_text, samples in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {type_name}')
+                for labels, value in samples:
+                    names = tuple(labels)
+                    lines.append(f'{name}{_format_labels(names, tuple(labels[n] for n in names))} {_format_value(value)}')
+        
+        return '\n'.join(lines) + '\n'
+
+
+def install_metrics(app, registry, prefix):
+    """
+    Count requests and record per-route latency for a Flask app.
+    
+    Adds <prefix>_http_requests_total{route,method,status} and
+    <prefix>_http_request_duration_seconds{route,method} to the registry.
+    Routes are labelled by their URL rule (e.g. /api/switch/<switch_name>)
+    so the number of series stays bounded.
+    
+    Args:
+        app: Flask application
+        registry: MetricsRegistry receiving the metrics
+        prefix: Metric name prefix (e.g., 'casm_main', 'casm_pi')
+    """
+    requests_total = registry.counter(
+        f'{prefix}_http_requests_total', 'HTTP requests handled', ('route', 'method', 'status')
+    )
+    request_duration = registry.histogram(
+        f'{prefix}_http_request_duration_seconds', 'HTTP request latency', ('route', 'method')
+    )
+    
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+    
+    @app.after_request
+    def _record_request(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        requests_total.inc(route, request.method, str(response.status_code))
+        request_duration.observe(time.perf_counter() - started, route, request.method)
+        return response
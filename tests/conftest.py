@@ -0,0 +1,138 @@
+"""
+Shared setup for the test suite.
+
+The hardware and main server modules read their config and database paths
+from the environment when they are imported, so those are pointed at the
+repo config and a scratch directory before any test module imports them.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+SCRATCH_DIR = Path(tempfile.mkdtemp(prefix='casm-tests-'))
+os.environ.setdefault('CASM_CONFIG', str(REPO_ROOT / 'main_config.yaml'))
+os.environ.setdefault('CASM_PI_ID', 'pi_1')
+os.environ.setdefault('CASM_DB', str(SCRATCH_DIR / 'status_history.db'))
+
+
+def free_port():
+    """A TCP port nothing is listening on right now"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_sim_config(farm, path, **settings):
+    """Write the farm's config to path with extra top-level settings, and return the path"""
+    farm.write_config(path)
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config.update(settings)
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+@contextmanager
+def main_server_process(farm, workers=2, **settings):
+    """
+    Run run_main_server.py under gunicorn against a farm, in a subprocess.
+
+    Yields:
+        tuple: (base URL, the gunicorn master process, config path, database path)
+    """
+    import requests
+    port = free_port()
+    config_path = write_sim_config(
+        farm, SCRATCH_DIR / f'main_server_{port}.yaml',
+        server={'main': {'bind': f'127.0.0.1:{port}', 'workers': workers, 'threads': 4}}, **settings
+    )
+    db_path = SCRATCH_DIR / f'main_server_{port}.db'
+    env = dict(os.environ, CASM_CONFIG=str(config_path), CASM_DB=str(db_path))
+    process = subprocess.Popen([sys.executable, 'run_main_server.py'], cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                requests.get(f'{url}/api/topology', timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    pytest.fail('Main server did not start')
+                time.sleep(0.1)
+        yield url, process, config_path, db_path
+    finally:
+        if process.poll() is None:
+            process.terminate()
+        process.wait(timeout=30)
+
+
+@pytest.fixture
+def sim_farm():
+    """
+    Factory for started simulator farms, stopped after the test.
+
+    Called with the SimulatorFarm config and keyword arguments; base_port
+    (and control_base_port when control=True) are picked from free ports.
+    """
+    from simulation import SimulatorFarm
+    farms = []
+
+    def start(config, control=False, **kwargs):
+        farm = SimulatorFarm(config, base_port=free_port(),
+                             control_base_port=free_port() if control else None, **kwargs)
+        farm.start()
+        farms.append(farm)
+        return farm
+
+    yield start
+    for farm in farms:
+        farm.stop()
+
+
+@pytest.fixture(scope='session')
+def farm():
+    """Two simulated Pis (over HTTP) for the shared main server app"""
+    from simulation import SimulatorFarm, generate_fleet_config
+    farm = SimulatorFarm(generate_fleet_config(2, 2, 3), base_port=free_port())
+    farm.start()
+    yield farm
+    farm.stop()
+
+
+@pytest.fixture(scope='session')
+def main_app(farm):
+    """
+    The main server app, pointed at the farm.
+
+    main_server keeps its state in module globals and initializes once per
+    process, so every test shares this one app. The poller checks the Pis
+    once at startup, and the config is only reloaded on request (or SIGHUP).
+    """
+    import main_server
+    config_path = write_sim_config(
+        farm, SCRATCH_DIR / 'main_server_test_config.yaml',
+        state_cache_ttl=30, status_check_interval=3600, config_watch_interval=0
+    )
+    app = main_server.create_app(config_path)
+    yield app
+    main_server.shutdown()
+
+
+@pytest.fixture
+def client(main_app):
+    return main_app.test_client()
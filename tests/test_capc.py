@@ -0,0 +1,260 @@
+"""capc: topology cache, multi-switch commands, batch and watch modes, direct status"""
+
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+from importlib.machinery import SourceFileLoader
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+from werkzeug.serving import make_server
+
+from conftest import REPO_ROOT, free_port
+
+
+@pytest.fixture(scope='module')
+def capc_module():
+    """The capc script, imported as a module (it has no .py extension)"""
+    loader = SourceFileLoader('capc', str(REPO_ROOT / 'capc'))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('capc', loader))
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def main_port(main_app):
+    """Serve the shared main server app over HTTP, for capc to talk to"""
+    server = make_server('127.0.0.1', 0, main_app, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_port
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def capc(capc_module, main_port, tmp_path, monkeypatch):
+    """
+    capc pointed at the main server, with an empty topology cache.
+
+    Every request it sends is recorded in capc.sent as [method, url, status
+    code or None if it failed], so tests can count round trips.
+    """
+    monkeypatch.setattr(capc_module, 'MAIN_SERVER_HOST', '127.0.0.1')
+    monkeypatch.setattr(capc_module, 'MAIN_SERVER_PORT', main_port)
+    monkeypatch.setattr(capc_module, 'CACHE_DIR', tmp_path / 'cache')
+    monkeypatch.setattr(capc_module, 'loaded_topology', None)
+    monkeypatch.setenv('CAPC_CONFIG', str(tmp_path / 'missing.yaml'))
+    sent = []
+    send = capc_module.http_request
+
+    def recording_request(method, url, *args, **kwargs):
+        entry = [method, url, None]
+        sent.append(entry)
+        response = send(method, url, *args, **kwargs)
+        entry[2] = response.status_code
+        return response
+
+    monkeypatch.setattr(capc_module, 'http_request', recording_request)
+    monkeypatch.setattr(capc_module, 'sent', sent, raising=False)
+    return capc_module
+
+
+def restart(capc):
+    """Forget the topology loaded by this process, as a new capc run would"""
+    capc.loaded_topology = None
+    capc.sent.clear()
+
+
+# ========== Topology cache ==========
+
+def test_topology_is_cached_and_revalidated_with_its_etag(capc, monkeypatch):
+    topology = capc.load_topology()
+    assert topology['switches']['CH3A'] == {'pi_id': 'pi_2', 'hat': 0, 'relay': 2}
+    assert [(method, status) for method, _, status in capc.sent] == [('GET', 200)]
+
+    restart(capc)
+    assert capc.load_topology() == topology
+    assert capc.sent == []  # Within the TTL the cache is used as is
+
+    restart(capc)
+    monkeypatch.setattr(capc, 'TOPOLOGY_TTL', 0)
+    assert capc.load_topology() == topology
+    assert [status for *_, status in capc.sent] == [304]
+
+
+def test_direct_command_goes_straight_to_the_pi(capc, farm):
+    capc.load_topology()
+    restart(capc)
+    pi_2 = farm.pis['pi_2']
+    assert capc.control_by_switch_name('CH3A', 1, direct=True)
+    assert capc.sent == [['POST', f'{pi_2.url}/api/switch/CH3A', 200]]
+    assert pi_2.board.get(0, 2) == 1
+    capc.control_by_switch_name('CH3A', 0, direct=True)
+
+
+def test_topology_falls_back_to_main_config(capc, farm, tmp_path, monkeypatch):
+    config_path = tmp_path / 'main_config.yaml'
+    farm.write_config(config_path)
+    monkeypatch.setenv('CAPC_CONFIG', str(config_path))
+    monkeypatch.setattr(capc, 'MAIN_SERVER_PORT', free_port())
+    topology = capc.load_topology()
+    assert topology['switches']['CH1B'] == {'pi_id': 'pi_1', 'hat': 0, 'relay': 3}
+    assert capc.fetch_pi_urls() == {pi_id: pi.url for pi_id, pi in farm.pis.items()}
+
+
+# ========== Multi-switch commands ==========
+
+def test_relay_specs_expand_to_relay_numbers(capc):
+    assert capc.parse_relay_spec('7') == [7]
+    assert capc.parse_relay_spec('1,3,5-8') == [1, 3, 5, 6, 7, 8]
+    with pytest.raises(capc.argparse.ArgumentTypeError):
+        capc.parse_relay_spec('1-x')
+
+
+def test_switch_globs_expand_against_the_topology(capc):
+    assert capc.expand_switch_names(['ch1a', 'CH2*', 'CH2A']) == ['CH1A', 'CH2', 'CH2A', 'CH2B', 'CH2C']
+    assert capc.expand_switch_names(['CH1[BC]']) == ['CH1B', 'CH1C']
+    assert capc.expand_switch_names(['CH9*']) is None
+
+
+def test_several_switches_are_sent_over_one_session_per_pi(capc, farm, monkeypatch):
+    capc.load_topology()
+    restart(capc)
+    sessions = []
+    get_session = capc.get_session
+    monkeypatch.setattr(capc, 'get_session', lambda pool, server: sessions.append(server) or get_session(pool, server))
+    names = capc.expand_switch_names(['CH2*', 'CH3B'])
+    assert capc.control_switches(names, 1, direct=True)
+    assert sorted(sessions) == sorted([farm.pis['pi_1'].url, farm.pis['pi_2'].url])
+    assert sorted(url.rsplit('/', 1)[1] for _, url, _ in capc.sent) == sorted(names)
+    assert farm.pis['pi_1'].board.get_all(0) >> 4 == 0b1111
+    assert farm.pis['pi_2'].board.get(0, 3) == 1
+    assert capc.control_switches(names, 0, direct=True)
+
+
+# ========== Batch mode ==========
+
+def test_batch_reports_every_command_in_input_order(capc, farm, tmp_path, capsys):
+    procedure = tmp_path / 'procedure.txt'
+    procedure.write_text(
+        '# Power up chassis 4\n'
+        'on CH4 CH4A\n'
+        'status CH4A\n'
+        'sleep 0\n'
+        'frobnicate CH4\n'
+        'off CH4*\n'
+    )
+    with open(procedure) as stream:
+        assert not capc.run_batch(stream, as_json=True)  # The invalid line fails the run
+
+    results = [capc.json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(result['line'], result['command'], result.get('switch')) for result in results] == [
+        (2, 'on', 'CH4'), (2, 'on', 'CH4A'), (3, 'status', 'CH4A'), (4, 'sleep', None),
+        (5, 'frobnicate', None), (6, 'off', 'CH4'), (6, 'off', 'CH4A'), (6, 'off', 'CH4B'), (6, 'off', 'CH4C')
+    ]
+    assert [result['ok'] for result in results] == [True] * 4 + [False] + [True] * 4
+    assert results[2]['state'] == 1  # The status after the on, not alongside it
+    assert farm.pis['pi_2'].board.get_all(0) >> 4 == 0
+    assert all(url.startswith(capc.get_main_server_url()) for _, url, _ in capc.sent)
+
+
+# ========== Watch mode ==========
+
+def test_watch_prints_transitions_and_polls_unchanged_states_for_free(capc, farm, client, monkeypatch, capsys):
+    import main_server
+    for pi_id, pi_data in main_server.router.pi_config.items():
+        main_server.check_one_pi(pi_id, pi_data)
+    board = farm.pis['pi_1'].board
+    client.post('/api/switch/CH1C', json={'state': 0})
+    polls = []
+
+    def sleep(seconds):
+        polls.append(board.calls)
+        if len(polls) == 2:
+            client.post('/api/switch/CH1C', json={'state': 1})
+        elif len(polls) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(capc, 'time', SimpleNamespace(perf_counter=time.perf_counter, time=time.time, sleep=sleep))
+    capc.watch_switches('CH1[BC]', interval=0.5)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:2] == [f'CH1B: {"ON" if board.get(0, 3) else "OFF"}', 'CH1C: OFF']
+    assert lines[2].endswith(' CH1C OFF -> ON')
+    assert [status for *_, status in capc.sent] == [200, 304, 200]
+    assert polls[1] == polls[0]  # The 304 cost the Pi nothing
+
+
+# ========== Startup ==========
+
+def run_capc(*args, env=None):
+    return subprocess.run([sys.executable, '-X', 'importtime', str(REPO_ROOT / 'capc'), *args],
+                          capture_output=True, text=True, timeout=30, env=env)
+
+
+def imported_modules(stderr):
+    """Top-level module names from -X importtime output"""
+    return {line.rsplit('|', 1)[1].strip() for line in stderr.splitlines() if line.startswith('import time:')}
+
+
+def test_help_does_not_import_requests():
+    result = run_capc('--help')
+    assert result.returncode == 0 and '--timing' in result.stdout
+    assert 'requests' not in imported_modules(result.stderr)
+
+
+def test_single_direct_command_reports_its_timing(farm, main_app, tmp_path):
+    import main_server
+    cache_dir = tmp_path / 'capc'
+    cache_dir.mkdir()
+    (cache_dir / 'topology-localhost_5000.json').write_text(json.dumps(
+        {'fetched_at': time.time(), 'etag': None, 'topology': main_server.router.topology}))
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+
+    result = run_capc('-n', 'CH4B', '--off', '-d', '--timing', env=env)
+    assert result.returncode == 0, result.stderr
+    assert 'turned OFF via Pi' in result.stdout
+    assert 'requests' not in imported_modules(result.stderr)  # One request goes over http.client
+    report = json.loads(result.stderr.splitlines()[-1])['timing_ms']
+    assert set(report) == {'import', 'resolve', 'request', 'total'}
+    assert report['import'] + report['resolve'] + report['request'] <= report['total']
+
+
+# ========== Direct status ==========
+
+def test_direct_status_decodes_states_from_one_request_per_pi(capc, farm, tmp_path, monkeypatch, capsys):
+    config_path = tmp_path / 'main_config.yaml'
+    farm.write_config(config_path)
+    monkeypatch.setenv('CAPC_CONFIG', str(config_path))
+    board = farm.pis['pi_1'].board
+    board.set_all(0, 0b00000110)  # CH1A and CH1B
+
+    result = capc.probe_pi(farm.pis['pi_1'].url, 2, {'CH1': (0, 1), 'CH1A': (0, 2), 'CH1B': (0, 3)})
+    assert result['status'] == 'online'
+    assert result['switches'] == {'CH1': 0, 'CH1A': 1, 'CH1B': 1}
+
+    capc.sent.clear()
+    assert capc.show_direct_status(deadline=2)
+    assert sorted(url for _, url, _ in capc.sent) == sorted(f'{pi.url}/api/status' for pi in farm.pis.values())
+    output = capsys.readouterr().out
+    assert '2/2 Pis answered' in output
+    assert 'Switches: 8 (2 ON)' in output
+    board.set_all(0, 0)
+
+
+def test_direct_status_reports_pis_that_are_down(capc, farm, tmp_path, monkeypatch, capsys):
+    config = {'raspberry_pis': {'pi_1': {'ip_address': '127.0.0.1', 'port': farm.pis['pi_1'].port, 'chassis': [1]},
+                                'pi_9': {'ip_address': '127.0.0.1', 'port': free_port(), 'chassis': [9]}}}
+    config_path = tmp_path / 'main_config.yaml'
+    config_path.write_text(json.dumps(config))  # JSON is valid YAML
+    monkeypatch.setenv('CAPC_CONFIG', str(config_path))
+    assert capc.show_direct_status(deadline=2)
+    output = capsys.readouterr().out
+    assert '1/2 Pis answered' in output
+    assert 'Status: unreachable' in output
@@ -0,0 +1,191 @@
+"""Control channel framing, commands and STATE ordering"""
+
+import socket
+import time
+from threading import Lock, Thread
+
+import pytest
+
+from channel import (
+    ChannelClient, ChannelServer, ChannelCommandError, ChannelError,
+    encode_frame, encode_state, decode_state, read_frame,
+    SET_PAYLOAD, ACK_PAYLOAD, STATE, SET, ACK
+)
+from conftest import free_port
+
+BOOT_ID = '0123456789abcdef'
+
+
+class FakeRelays:
+    """set_relay/snapshot pair for a ChannelServer, with one HAT of 8 relays"""
+
+    def __init__(self):
+        self.bitmap = 0
+        self.version = 0
+        self.lock = Lock()
+        self.server = None
+
+    def set_relay(self, hat, relay, state):
+        if hat != 0:
+            raise ValueError('Invalid HAT number. Must be 0-0')
+        with self.lock:
+            mask = 1 << (relay - 1)
+            bitmap = (self.bitmap | mask) if state else (self.bitmap & ~mask)
+            changed = bitmap != self.bitmap
+            if changed:
+                self.bitmap, self.version = bitmap, self.version + 1
+        if changed and self.server is not None:
+            self.server.notify()
+        return changed
+
+    def snapshot(self):
+        with self.lock:
+            return [self.bitmap], self.version
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def channel_pair():
+    """
+    A ChannelServer over FakeRelays and a connected client.
+
+    The client's STATE events are recorded as (bitmaps, version, relays per HAT,
+    boot id, time.monotonic() when handled).
+    """
+    relays = FakeRelays()
+    server = ChannelServer(free_port(), relays.set_relay, relays.snapshot, 8,
+                           host='127.0.0.1', boot_id=BOOT_ID)
+    relays.server = server
+    server.start()
+    states = []
+    client = ChannelClient('127.0.0.1', server.port,
+                           on_state=lambda *state: states.append(state + (time.monotonic(),)))
+    client.start()
+    assert wait_for(lambda: client.connected and states)
+    yield relays, server, client, states
+    client.close()
+    server.stop()
+
+
+def test_frame_sizes():
+    assert len(encode_frame(SET, 1, SET_PAYLOAD.pack(0, 1, 1, 1000))) == 14
+    assert len(encode_frame(ACK, 1, ACK_PAYLOAD.pack(1, 1))) == 9
+
+
+def test_state_round_trip():
+    payload = encode_state([0x05, None, 0xFF], 7, 8, BOOT_ID)
+    assert decode_state(payload) == ([0x05, None, 0xFF], 7, 8, BOOT_ID)
+
+
+def test_read_frame_across_partial_sends():
+    left, right = socket.socketpair()
+    try:
+        frame = encode_frame(STATE, 0, encode_state([3], 2, 8, BOOT_ID))
+        left.sendall(frame[:3])
+        Thread(target=lambda: (time.sleep(0.05), left.sendall(frame[3:]))).start()
+        frame_type, frame_id, payload = read_frame(right)
+        assert (frame_type, frame_id) == (STATE, 0)
+        assert decode_state(payload)[:2] == ([3], 2)
+        left.close()
+        assert read_frame(right) is None
+    finally:
+        right.close()
+
+
+def test_set_relay_acks_with_changed_and_receive_time(channel_pair):
+    relays, _, client, _ = channel_pair
+    before = time.monotonic()
+    changed, acked_at = client.set_relay(0, 3, 1, timeout=2)
+    assert changed is True
+    assert before <= acked_at <= time.monotonic()
+    assert relays.bitmap == 0b100
+    assert client.set_relay(0, 3, 1, timeout=2)[0] is False
+
+
+def test_set_relay_rejected_by_pi(channel_pair):
+    _, _, client, _ = channel_pair
+    with pytest.raises(ChannelCommandError) as error:
+        client.set_relay(5, 1, 1, timeout=2)
+    assert error.value.status_code == 400
+
+
+def test_state_pushed_on_connect_and_change(channel_pair):
+    relays, _, client, states = channel_pair
+    assert states[0][:4] == ([0], 0, 8, BOOT_ID)
+    client.set_relay(0, 1, 1, timeout=2)
+    assert wait_for(lambda: states[-1][1] == 1)
+    assert states[-1][0] == [1]
+    assert client.state_version == 1
+
+
+def test_state_is_never_older_than_an_earlier_ack(channel_pair):
+    """Every STATE read after an ack reflects at least that ack's write"""
+    relays, _, client, states = channel_pair
+    acks = []
+    for i in range(64):
+        relay, state = i % 8 + 1, (i // 8) % 2 ^ 1
+        _, acked_at = client.set_relay(0, relay, state, timeout=2)
+        acks.append((acked_at, relays.version))
+    assert wait_for(lambda: states[-1][1] == relays.version)
+    for acked_at, version in acks:
+        assert all(state[1] >= version for state in states if state[4] > acked_at)
+    versions = [state[1] for state in states]
+    assert versions == sorted(versions)
+
+
+def test_client_ignores_states_older_than_the_last_one():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    states = []
+    client = ChannelClient('127.0.0.1', listener.getsockname()[1],
+                           on_state=lambda *state: states.append(state))
+    client.start()
+    try:
+        sock, _ = listener.accept()
+        for version, bitmap in ((5, 1), (4, 0), (5, 0), (6, 3)):
+            sock.sendall(encode_frame(STATE, 0, encode_state([bitmap], version, 8, BOOT_ID)))
+        assert wait_for(lambda: len(states) == 2)
+        time.sleep(0.1)
+        assert [(state[0], state[1]) for state in states] == [([1], 5), ([3], 6)]
+
+        # A new connection starts over: its first STATE is always taken
+        sock.close()
+        sock, _ = listener.accept()
+        sock.sendall(encode_frame(STATE, 0, encode_state([0], 0, 8, 'fedcba9876543210')))
+        assert wait_for(lambda: len(states) == 3)
+        assert states[-1] == ([0], 0, 8, 'fedcba9876543210')
+        sock.close()
+    finally:
+        client.close()
+        listener.close()
+
+
+def test_unconnected_client_raises_channel_error():
+    client = ChannelClient('127.0.0.1', free_port())
+    with pytest.raises(ChannelError):
+        client.set_relay(0, 1, 1, timeout=0.1)
+
+
+def test_concurrent_commands_are_all_counted(channel_pair):
+    relays, server, client, _ = channel_pair
+    threads = [Thread(target=lambda: [client.set_relay(0, relay, 1, timeout=2) for relay in range(1, 9)])
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.commands == 64
+
+
+def test_server_rejects_bitmaps_that_could_read_as_unknown():
+    with pytest.raises(ValueError):
+        ChannelServer(free_port(), FakeRelays().set_relay, lambda: ([0], 0), relays_per_hat=16)
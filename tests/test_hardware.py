@@ -0,0 +1,335 @@
+"""Pi server: relay writes, the I2C bus, the relay state journal and the HTTP API"""
+
+import time
+from threading import Thread
+
+import pytest
+
+import hardware
+from telemetry import parse_server_timing
+
+
+class CountingRelay:
+    """lib8relind stand-in that keeps relay state in memory and counts calls"""
+
+    def __init__(self, num_hats):
+        self.bitmaps = [0] * num_hats
+        self.calls = {'get': 0, 'set': 0, 'get_all': 0, 'set_all': 0}
+
+    def get(self, hat, relay_num):
+        self.calls['get'] += 1
+        return (self.bitmaps[hat] >> (relay_num - 1)) & 1
+
+    def set(self, hat, relay_num, state):
+        self.calls['set'] += 1
+        mask = 1 << (relay_num - 1)
+        self.bitmaps[hat] = (self.bitmaps[hat] | mask) if state else (self.bitmaps[hat] & ~mask)
+
+    def get_all(self, hat):
+        self.calls['get_all'] += 1
+        return self.bitmaps[hat]
+
+    def set_all(self, hat, bitmap):
+        self.calls['set_all'] += 1
+        self.bitmaps[hat] = bitmap
+
+
+@pytest.fixture
+def relays(monkeypatch):
+    """A fresh CountingRelay behind the hardware module, with elision on and no coalescing or journal"""
+    backend = CountingRelay(hardware.NUM_HATS)
+    hardware.set_relay_backend(backend)
+    monkeypatch.setattr(hardware, 'WRITE_ELISION', True)
+    monkeypatch.setattr(hardware, 'BITMAP_TTL', 5)
+    monkeypatch.setattr(hardware, 'write_coalescer', None)
+    monkeypatch.setattr(hardware, 'state_journal', None)
+    yield backend
+    hardware.set_relay_backend(None)
+
+
+@pytest.fixture
+def pi_client(relays):
+    return hardware.create_app().test_client()
+
+
+# ========== Tracing ==========
+
+def test_relay_command_reports_bus_phases(pi_client):
+    response = pi_client.post('/api/relay/control', json={'hat': 0, 'relay': 3, 'state': 1},
+                              headers={'X-Request-ID': 'trace-test'})
+    assert response.status_code == 200
+    assert response.headers['X-Request-ID'] == 'trace-test'
+    timings = parse_server_timing(response.headers['Server-Timing'])
+    assert {'bus_wait', 'i2c', 'total'} <= set(timings)
+
+
+
+# ========== Metrics ==========
+
+def test_metrics_count_i2c_calls_and_requests(pi_client):
+    pi_client.post('/api/relay/control', json={'hat': 1, 'relay': 1, 'state': 1})
+    response = pi_client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'casm_pi_i2c_call_duration_seconds_count{hat="1",op="set"}' in text
+    assert 'casm_pi_bus_wait_seconds_bucket{le="+Inf"}' in text
+    assert 'casm_pi_http_requests_total{route="/api/relay/control",method="POST",status="200"}' in text
+
+
+# ========== Write elision ==========
+
+def test_write_elided_when_relay_already_holds_state(relays):
+    assert hardware.write_relay(0, 2, 1) is True
+    assert hardware.write_relay(0, 2, 1) is False
+    assert relays.calls == {'get': 0, 'set': 1, 'get_all': 1, 'set_all': 0}
+    assert relays.bitmaps[0] == 0b10
+
+
+def test_elision_can_be_turned_off(relays, monkeypatch):
+    monkeypatch.setattr(hardware, 'WRITE_ELISION', False)
+    assert hardware.write_relay(0, 2, 1) is True
+    assert hardware.write_relay(0, 2, 1) is True
+    assert relays.calls['set'] == 2
+
+
+def test_failed_write_forgets_the_bitmap(relays, monkeypatch):
+    hardware.write_relay(0, 1, 1)
+
+    def broken_set(hat, relay_num, state):
+        raise OSError('I2C write failed')
+
+    monkeypatch.setattr(relays, 'set', broken_set)
+    with pytest.raises(OSError):
+        hardware.write_relay(0, 2, 1)
+    assert hardware.fresh_bitmap(0) is None  # Re-read before the next elision
+
+
+# ========== Emergency all-off ==========
+
+def test_all_off_writes_and_confirms_every_hat(pi_client, relays):
+    relays.bitmaps = [0b1010] * hardware.NUM_HATS
+    response = pi_client.post('/api/emergency/all-off')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['all_off'] and data['confirmed_off_hats'] == list(range(hardware.NUM_HATS))
+    assert relays.bitmaps == [0] * hardware.NUM_HATS
+
+
+def test_all_off_reports_a_hat_that_stays_on(pi_client, relays, monkeypatch):
+    set_all = relays.set_all
+
+    def stuck_set_all(hat, bitmap):
+        if hat != 0:  # HAT 0 ignores writes
+            set_all(hat, bitmap)
+
+    monkeypatch.setattr(relays, 'set_all', stuck_set_all)
+    relays.bitmaps[0] = 0b1
+    response = pi_client.post('/api/emergency/all-off')
+    assert response.status_code == 500
+    data = response.get_json()
+    assert data['unconfirmed_hats'] == [{'hat': 0, 'reason': 'read back 0x01'}]
+    assert data['rounds'] == hardware.EMERGENCY_ATTEMPTS
+
+
+def test_all_off_reports_every_hat_unconfirmed_while_the_bus_is_stuck(relays):
+    with hardware.bus_lock:
+        confirmed, unconfirmed, rounds = hardware.emergency_all_off(bus_wait=0.05)
+    assert confirmed == [] and rounds == 0
+    assert unconfirmed == {hat: 'not reached: I2C bus busy' for hat in range(hardware.NUM_HATS)}
+
+
+def test_all_off_drops_writes_queued_for_the_bus(relays):
+    errors = []
+
+    def queued_write():
+        try:
+            hardware.write_relay(0, 1, 1)
+        except hardware.EmergencyInProgress as e:
+            errors.append(e)
+
+    hardware.bus_lock.acquire()
+    writer = Thread(target=queued_write)
+    writer.start()
+    time.sleep(0.05)  # Waiting for the bus
+    results = []
+    emergency = Thread(target=lambda: results.append(hardware.emergency_all_off(bus_wait=5)))
+    emergency.start()
+    time.sleep(0.05)
+    with pytest.raises(hardware.EmergencyInProgress):
+        hardware.write_relay(0, 2, 1)  # Refused outright while the all-off runs
+    hardware.bus_lock.release()
+    writer.join(2)
+    emergency.join(2)
+
+    assert len(errors) == 1
+    assert results[0][0] == list(range(hardware.NUM_HATS))
+    assert relays.bitmaps[0] == 0
+    assert hardware.write_relay(0, 1, 1) is True  # Writes go ahead again afterwards
+
+
+# ========== Write coalescing ==========
+
+@pytest.fixture
+def coalescer(relays, monkeypatch):
+    """Route write_relay through a WriteCoalescer with a 0.3 s window"""
+    coalescer = hardware.WriteCoalescer(0.3)
+    monkeypatch.setattr(hardware, 'write_coalescer', coalescer)
+    return coalescer
+
+
+def test_coalescer_merges_concurrent_writes(relays, coalescer):
+    results = {}
+
+    def write(relay_num, state):
+        results[relay_num] = hardware.write_relay(0, relay_num, state)
+
+    threads = [Thread(target=write, args=(relay_num, 1)) for relay_num in range(1, 6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert relays.bitmaps[0] == 0b11111
+    assert relays.calls == {'get': 0, 'set': 0, 'get_all': 1, 'set_all': 1}
+    assert results == {relay_num: True for relay_num in range(1, 6)}
+
+
+def test_coalescer_batch_applies_writes_in_arrival_order(relays, coalescer):
+    results = []
+    first = Thread(target=lambda: results.append(hardware.write_relay(0, 4, 1)))
+    first.start()
+    time.sleep(0.05)
+    assert hardware.write_relay(0, 4, 0) is True  # Joined the batch after the ON, and undoes it
+    first.join()
+    assert results == [True]
+    assert relays.bitmaps[0] == 0
+    assert relays.calls['set_all'] == 0  # The batch leaves the HAT as it was
+
+
+def test_coalescer_batch_rereads_the_hat(relays, coalescer, monkeypatch):
+    monkeypatch.setattr(hardware, 'write_coalescer', None)
+    hardware.write_relay(0, 1, 1)
+    relays.bitmaps[0] |= 0b1000000  # Switched behind our back, within bitmap_ttl
+    monkeypatch.setattr(hardware, 'write_coalescer', coalescer)
+
+    threads = [Thread(target=hardware.write_relay, args=(0, relay_num, 1)) for relay_num in (2, 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert relays.bitmaps[0] == 0b1000111
+
+
+def test_coalescer_window_closes_early_for_a_deadline(pi_client, relays, coalescer):
+    started = time.monotonic()
+    response = pi_client.post('/api/relay/control', json={'hat': 0, 'relay': 5, 'state': 1},
+                              headers={'X-Request-Deadline-Ms': '100'})
+    assert response.status_code == 200
+    assert time.monotonic() - started < 0.2
+    assert relays.bitmaps[0] == 0b10000
+
+
+def test_coalescer_joiner_leaves_the_batch_at_its_deadline(pi_client, relays, coalescer):
+    opener = Thread(target=hardware.write_relay, args=(0, 1, 1))
+    opener.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    response = pi_client.post('/api/relay/control', json={'hat': 0, 'relay': 2, 'state': 1},
+                              headers={'X-Request-Deadline-Ms': '50'})
+    assert response.status_code == 504
+    assert time.monotonic() - started < 0.2
+    opener.join()
+    assert relays.bitmaps[0] == 0b1  # The abandoned write was not applied
+
+
+# ========== Relay state journal ==========
+
+def test_journal_restores_desired_states(relays, tmp_path, monkeypatch):
+    journal = hardware.RelayStateJournal(tmp_path / 'relay_state.journal')
+    journal.start()
+    monkeypatch.setattr(hardware, 'state_journal', journal)
+    hardware.write_relay(0, 1, 1)
+    hardware.write_hat(1, 0b1100)
+    assert journal.flush()
+
+    # Power cycle: HATs come back all off, and a new journal reads the file
+    relays.bitmaps = [0] * hardware.NUM_HATS
+    hardware.set_relay_backend(relays)
+    restarted = hardware.RelayStateJournal(tmp_path / 'relay_state.journal')
+    restarted.start()
+    monkeypatch.setattr(hardware, 'state_journal', restarted)
+    assert hardware.restore_relay_state() == {0: 0b1, 1: 0b1100}
+    assert relays.bitmaps[:2] == [0b1, 0b1100]
+
+
+def test_journal_ignores_torn_tail(tmp_path):
+    path = tmp_path / 'relay_state.journal'
+    journal = hardware.RelayStateJournal(path)
+    journal.start()
+    journal.record(0, 0b1, 0b1)
+    journal.record(2, 0b110, 0b100)
+    assert journal.flush()
+
+    with open(path, 'ab') as f:
+        f.write(journal._pack(0, 0b1, 0)[:3])  # Power lost mid-append
+
+    reloaded = hardware.RelayStateJournal(path)
+    reloaded.start()
+    assert reloaded.desired() == {0: (0b1, 0b1), 2: (0b110, 0b100)}
+    assert path.stat().st_size == 2 * hardware.RelayStateJournal.RECORD.size
+
+
+def test_journal_compacts_to_one_record_per_hat(tmp_path):
+    path = tmp_path / 'relay_state.journal'
+    journal = hardware.RelayStateJournal(path, compact_records=16)
+    journal.start()
+    for i in range(40):
+        journal.record(i % 2, 1 << (i % 8), (i % 3 == 0) << (i % 8))
+    assert journal.flush()
+    assert journal.compactions >= 2  # On start, then after passing 16 records
+
+    reloaded = hardware.RelayStateJournal(path)
+    reloaded.start()
+    assert reloaded.desired() == journal.desired()
+    assert path.stat().st_size == 2 * hardware.RelayStateJournal.RECORD.size
+
+
+# ========== Heartbeat state ==========
+
+def test_state_version_moves_only_on_change(relays):
+    _, version = hardware.known_hat_bitmaps()
+    hardware.write_relay(1, 1, 1)
+    hardware.write_relay(1, 1, 1)
+    bitmaps, new_version = hardware.known_hat_bitmaps()
+    assert bitmaps[1] == 1
+    assert new_version == version + 2  # The first read of the HAT, then the write
+
+
+def test_hat_reset_is_noticed_after_bitmap_ttl(relays, monkeypatch):
+    monkeypatch.setattr(hardware, 'BITMAP_TTL', 0.05)
+    hardware.write_relay(0, 1, 1)
+    relays.bitmaps[0] = 0  # The HAT resets without a bus call from us
+
+    time.sleep(0.1)
+    assert hardware.known_hat_bitmaps()[0][0] is None
+    assert hardware.write_relay(0, 1, 1) is True
+    assert relays.bitmaps[0] == 1
+
+
+def test_heartbeat_rereads_stale_hats(relays, monkeypatch):
+    monkeypatch.setattr(hardware, 'BITMAP_TTL', 0.05)
+    hardware.current_hat_bitmaps()
+    relays.bitmaps[2] = 0b1010
+    assert hardware.current_hat_bitmaps()[0][2] == 0  # Still fresh
+
+    time.sleep(0.1)
+    assert hardware.current_hat_bitmaps()[0][2] == 0b1010
+
+
+def test_status_reports_bitmaps_and_version(pi_client, relays):
+    hardware.write_relay(1, 2, 1)
+    status = pi_client.get('/api/status').get_json()
+    bitmaps, version = hardware.known_hat_bitmaps()
+    assert status['hat_bitmaps'] == bitmaps and status['hat_bitmaps'][1] == 0b10
+    assert status['state_version'] == version and status['boot_id'] == hardware.BOOT_ID
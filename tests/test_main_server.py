@@ -0,0 +1,484 @@
+"""Main server request coalescing, relay state cache, fan-out and routes"""
+
+import os
+import signal
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from threading import Event, Thread
+
+import pytest
+import requests
+import yaml
+
+import main_server
+from conftest import REPO_ROOT
+from telemetry import parse_server_timing
+
+
+# ========== Request coalescing ==========
+
+def test_single_flight_shares_one_call():
+    flight = main_server.SingleFlight()
+    started, release = Event(), Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return 'result'
+
+    results = []
+    leader = Thread(target=lambda: results.append(flight.do('key', fetch)))
+    leader.start()
+    assert started.wait(2)
+    followers = [Thread(target=lambda: results.append(flight.do('key', fetch))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [('result', False)] + [('result', True)] * 3
+    assert flight.stats()['coalesced_requests'] == 3
+
+
+def test_single_flight_shares_errors():
+    flight = main_server.SingleFlight()
+
+    def fail():
+        raise RuntimeError('Pi unreachable')
+
+    with pytest.raises(RuntimeError):
+        flight.do('key', fail)
+    assert flight.stats()['in_flight'] == 0
+
+
+# ========== Relay state cache ==========
+
+@pytest.fixture
+def status_db(tmp_path):
+    path = tmp_path / 'status.db'
+    main_server.init_status_db(path)
+    return path
+
+
+def test_cache_drops_reads_sent_before_a_newer_write(status_db):
+    cache = main_server.RelayStateCache(10, main_server.SharedStatusStore(status_db))
+    sent_at = time.monotonic()
+    cache.update('pi', 0, 1, 1, sent_at + 1)  # Write acked
+    cache.update('pi', 0, 1, 0, sent_at)      # Slow read sent before it
+    assert cache.get_fresh('pi', 0, 1) == 1
+
+
+def test_cache_invalidation_is_not_undone_by_older_reads(status_db):
+    cache = main_server.RelayStateCache(10, main_server.SharedStatusStore(status_db))
+    now = time.monotonic()
+    cache.update('pi', 0, 1, 1, now - 1)
+    cache.invalidate('pi', 0, 1, now)
+    cache.update('pi', 0, 1, 1, now - 0.5)
+    assert cache.get_fresh('pi', 0, 1) is None
+    cache.update('pi', 0, 1, 0, now + 0.5)
+    assert cache.get_fresh('pi', 0, 1) == 0
+
+
+def test_cache_entries_expire(status_db):
+    cache = main_server.RelayStateCache(0.05, main_server.SharedStatusStore(status_db))
+    cache.update('pi', 0, 1, 1)
+    assert cache.get_fresh('pi', 0, 1) == 1
+    time.sleep(0.1)
+    assert cache.get_fresh('pi', 0, 1) is None
+    cache.ttl = 0
+    cache.update('pi', 0, 1, 1)
+    assert cache.get_fresh('pi', 0, 1) is None
+
+
+def test_cache_is_shared_between_workers(status_db):
+    """Two stores on one database stand in for two worker processes"""
+    first = main_server.RelayStateCache(10, main_server.SharedStatusStore(status_db))
+    second = main_server.RelayStateCache(10, main_server.SharedStatusStore(status_db))
+    first.update('pi', 0, 1, 1)
+    assert second.get_fresh('pi', 0, 1) == 1
+    second.update_many('pi', {(0, 1): 0, (0, 2): 1, (0, 3): 'bad'})
+    assert (first.get_fresh('pi', 0, 1), first.get_fresh('pi', 0, 2), first.get_fresh('pi', 0, 3)) == (0, 1, None)
+    first.invalidate_many('pi', [(0, 1), (0, 2)])
+    assert second.get_fresh('pi', 0, 1) is None and second.get_fresh('pi', 0, 2) is None
+
+
+def test_states_from_before_a_reboot_are_dropped(status_db):
+    store = main_server.SharedStatusStore(status_db)
+    store.put_relay_states('pi', {(0, 1): 1}, time.monotonic() + 3600)
+    main_server.init_status_db(status_db)
+    assert store.relay_state('pi', 0, 1) is None
+
+
+# ========== Config reload ==========
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@contextmanager
+def edited_config(edit):
+    """Rewrite the app's config file with edit(config) applied, and put it back afterwards"""
+    path = main_server.CONFIG_PATH
+    original = path.read_text()
+    config = yaml.safe_load(original)
+    edit(config)
+    path.write_text(yaml.safe_dump(config))
+    try:
+        yield
+    finally:
+        path.write_text(original)
+        assert main_server.reload_config('test cleanup')
+
+
+def test_reload_swaps_in_a_new_router(main_app):
+    old_router = main_server.router
+
+    def swap_switches(config):
+        mapping = config['raspberry_pis']['pi_1']['switch_mapping']
+        mapping['CH1A'], mapping['CH2C'] = mapping['CH2C'], mapping['CH1A']
+        config['request_timeout'] = 3
+
+    with edited_config(swap_switches):
+        assert main_server.reload_config('test')
+        assert main_server.router is not old_router
+        assert main_server.router.get_relay_info('CH1A')['relay'] == 8
+        assert main_server.REQUEST_TIMEOUT == 3
+        assert old_router.get_relay_info('CH1A')['relay'] == 2  # Requests in flight keep the old one
+    assert main_server.router.get_relay_info('CH1A')['relay'] == 2
+
+
+def test_reload_rejects_an_invalid_config(main_app):
+    old_router = main_server.router
+
+    def clash(config):
+        config['raspberry_pis']['pi_2']['chassis'] = config['raspberry_pis']['pi_1']['chassis']
+
+    with edited_config(clash):
+        assert main_server.reload_config('test') is False
+        assert main_server.router is old_router
+
+
+def test_sighup_reloads_the_config(main_app):
+    def describe(config):
+        config['raspberry_pis']['pi_2']['description'] = 'Reloaded on SIGHUP'
+
+    with edited_config(describe):
+        os.kill(os.getpid(), signal.SIGHUP)
+        assert wait_for(lambda: main_server.router.pi_config['pi_2']['description'] == 'Reloaded on SIGHUP')
+
+
+# ========== Tracing ==========
+
+def test_command_trace_includes_the_pi_phases(client, farm):
+    board = farm.pis['pi_2'].board
+    response = client.post('/api/switch/CH3B', json={'state': 1 - board.get(0, 3)},
+                           headers={'X-Request-ID': 'trace-test'})
+    assert response.status_code == 200
+    assert response.headers['X-Request-ID'] == 'trace-test'
+    timings = parse_server_timing(response.headers['Server-Timing'])
+    assert {'route', 'upstream', 'upstream_wait', 'pi_total', 'network', 'total'} <= set(timings)
+    assert timings['upstream'] <= timings['total']
+
+
+# ========== Metrics ==========
+
+def test_metrics_cover_upstream_calls_and_pi_status(client):
+    client.get('/api/switch/CH1')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'casm_main_upstream_request_duration_seconds_count{pi_id="pi_1",method="GET"}' in text
+    assert 'casm_main_http_request_duration_seconds_bucket{route="/api/switch/<switch_name>",method="GET",le="+Inf"}' in text
+    assert 'casm_main_poller_leader 1' in text
+    # Set once the poller's first round of heartbeats is in
+    assert wait_for(lambda: 'casm_main_pi_up{pi_id="pi_1"} 1' in client.get('/metrics').get_data(as_text=True))
+
+
+# ========== Write elision ==========
+
+def test_repeated_command_is_elided(client, farm):
+    board = farm.pis['pi_1'].board
+    target = 1 - board.get(0, 2)
+    first = client.post('/api/switch/CH1A', json={'state': target}).get_json()
+    assert first['changed'] is True and board.get(0, 2) == target
+
+    calls = board.calls
+    second = client.post('/api/switch/CH1A', json={'state': target}).get_json()
+    assert second['source'] == 'main_server_cache'
+    assert board.calls == calls
+
+    # A failed write leaves the state unknown, so the next command goes to the Pi
+    assert client.post('/api/switch/CH1A', json={'state': 7}).status_code == 400
+    third = client.post('/api/switch/CH1A', json={'state': target}).get_json()
+    assert 'source' not in third and third['changed'] is False
+
+
+# ========== Retries and deadlines ==========
+
+def pi_url(farm, pi_id='pi_1'):
+    return farm.pis[pi_id].url
+
+
+def test_get_is_retried_with_backoff(main_app, farm, monkeypatch):
+    attempts = []
+    send = main_server.send_to_pi
+
+    def flaky(*args):
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise requests.exceptions.ConnectionError('Connection refused')
+        return send(*args)
+
+    monkeypatch.setattr(main_server, 'send_to_pi', flaky)
+    response, status_code = main_server.forward_to_pi(pi_url(farm), '/api/status', timeout=5)
+    assert status_code == 200 and response['pi_id'] == 'pi_1'
+    assert len(attempts) == 3
+    # Jittered exponential backoff: at least half of 1x, then 2x retry_backoff
+    assert attempts[1] - attempts[0] >= main_server.RETRY_BACKOFF / 2
+    assert attempts[2] - attempts[1] >= main_server.RETRY_BACKOFF
+
+
+def test_unsafe_post_is_not_retried(main_app, farm, monkeypatch):
+    attempts = []
+
+    def refused(*args):
+        attempts.append(args)
+        raise requests.exceptions.ConnectionError('Connection refused')
+
+    monkeypatch.setattr(main_server, 'send_to_pi', refused)
+    response, status_code = main_server.forward_to_pi(pi_url(farm), '/api/emergency/all-off', method='POST',
+                                                      idempotent=False)
+    assert status_code == 503 and response['attempts'] == 1
+    assert len(attempts) == 1
+
+
+def test_timeout_caps_all_attempts(main_app, farm):
+    pi = farm.pis['pi_2']
+    pi.network_delay = 0.3
+    try:
+        started = time.monotonic()
+        response, status_code = main_server.forward_to_pi(pi.url, '/api/status', timeout=0.2)
+        assert time.monotonic() - started < 0.3
+        assert status_code == 504
+    finally:
+        pi.network_delay = 0.0
+
+
+def test_remaining_budget_is_sent_to_the_pi(main_app, farm, monkeypatch):
+    budgets = []
+    get = requests.get
+
+    def recording_get(url, headers=None, **kwargs):
+        budgets.append(int(headers['X-Request-Deadline-Ms']))
+        return get(url, headers=headers, **kwargs)
+
+    monkeypatch.setattr(main_server.requests, 'get', recording_get)
+    main_server.forward_to_pi(pi_url(farm), '/api/status', timeout=5)
+    main_server.forward_to_pi(pi_url(farm), '/api/status', timeout=5, deadline=time.monotonic() + 0.1)
+    assert 4000 < budgets[0] <= 5000
+    assert 0 < budgets[1] <= 100  # The client's deadline wins over our own timeout
+
+
+def test_fanout_keeps_request_trace_and_deadline(client, farm, monkeypatch):
+    monkeypatch.setattr(main_server, 'STATUS_CHECK_INTERVAL', 0)  # Stale states, so the Pis are asked
+    response = client.get('/api/switch/list', headers={'X-Request-Deadline-Ms': '5000'})
+    assert 'upstream;dur=' in response.headers['Server-Timing']
+
+    pi = farm.pis['pi_1']
+    pi.network_delay = 0.3
+    try:
+        started = time.monotonic()
+        response = client.get('/api/switch/list', headers={'X-Request-Deadline-Ms': '50'})
+        assert time.monotonic() - started < 0.25
+        assert response.get_json()['errors']
+    finally:
+        pi.network_delay = 0.0
+
+
+# ========== Topology ==========
+
+def test_topology_is_revalidated_with_its_etag(client):
+    response = client.get('/api/topology')
+    assert response.status_code == 200
+    assert response.get_json()['switches']['CH1A'] == {'pi_id': 'pi_1', 'hat': 0, 'relay': 2}
+    etag = response.headers['ETag']
+
+    cached = client.get('/api/topology', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+
+# ========== Switch list ETag ==========
+
+def heartbeat(pi_id):
+    main_server.check_one_pi(pi_id, main_server.router.pi_config[pi_id])
+
+
+def test_unchanged_switch_list_is_revalidated_without_asking_the_pis(client, farm):
+    for pi_id in farm.pis:
+        heartbeat(pi_id)
+    etag = client.get('/api/switch/list').headers['ETag']
+    calls = {pi_id: pi.board.calls for pi_id, pi in farm.pis.items()}
+    cached = client.get('/api/switch/list', headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.headers['ETag'] == etag
+    assert {pi_id: pi.board.calls for pi_id, pi in farm.pis.items()} == calls
+
+    # A command through the main server is seen at once
+    board = farm.pis['pi_1'].board
+    client.post('/api/switch/CH2A', json={'state': 1 - board.get(0, 6)})
+    changed = client.get('/api/switch/list', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    etag = changed.headers['ETag']
+
+    # One made on the Pi directly, by the next heartbeat
+    board.set(0, 6, 1 - board.get(0, 6))
+    assert client.get('/api/switch/list', headers={'If-None-Match': etag}).status_code == 304
+    heartbeat('pi_1')
+    assert client.get('/api/switch/list', headers={'If-None-Match': etag}).status_code == 200
+
+
+# ========== Heartbeat state sync ==========
+
+def test_state_snapshots_are_ordered_by_version(status_db):
+    store = main_server.SharedStatusStore(status_db)
+    now = time.monotonic()
+    assert store.put_states('pi_1', [0b1], 8, 5, 'boot-a', now)
+    assert not store.put_states('pi_1', [0b0], 8, 4, 'boot-a', now + 1)  # Overtaken by version 5
+    assert store.put_states('pi_1', [0b1], 8, 5, 'boot-a', now + 2)  # Same version: only fresher
+    assert store.states_at('pi_1') == now + 2
+    assert store.put_states('pi_1', [0b0], 8, 0, 'boot-b', now + 3)  # The Pi server restarted
+
+    store.put('pi_1', {'status': 'online'})  # A status update keeps the snapshot
+    other_worker = main_server.SharedStatusStore(status_db)
+    assert other_worker.states_at('pi_1') == now + 3
+    assert other_worker.snapshot()['pi_1'] == {'status': 'online'}
+
+
+def test_switch_list_is_served_from_fresh_heartbeats(client, farm, monkeypatch):
+    for pi_id in farm.pis:
+        heartbeat(pi_id)
+    calls = {pi_id: pi.board.calls for pi_id, pi in farm.pis.items()}
+    switches = client.get('/api/switch/list').get_json()['switches']
+    assert {pi_id: pi.board.calls for pi_id, pi in farm.pis.items()} == calls
+    board = farm.pis['pi_2'].board
+    assert switches['CH3A'] == board.get(0, 2)
+
+    # Once the last sync is older than two heartbeat intervals, the Pis are asked again
+    monkeypatch.setattr(main_server, 'STATUS_CHECK_INTERVAL', 0)
+    client.get('/api/switch/list')
+    assert all(pi.board.calls > calls[pi_id] for pi_id, pi in farm.pis.items())
+
+
+def test_heartbeat_carries_the_pi_state_version(main_app, farm):
+    pi = farm.pis['pi_1']
+    heartbeat('pi_1')
+    _, version = pi.board.snapshot()
+    pi.board.set(0, 8, 1 - pi.board.get(0, 8))
+    heartbeat('pi_1')
+    assert main_server.pi_status_store.snapshot()['pi_1']['response']['state_version'] > version
+    assert main_server.relay_state_cache.get_fresh(pi.url, 0, 8) == pi.board.get(0, 8)
+
+
+# ========== Emergency all-off ==========
+
+def test_all_off_reaches_every_pi(client, farm):
+    for pi in farm.pis.values():
+        pi.board.set_all(0, 0b10110)
+    response = client.post('/api/emergency/all-off')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['all_off']
+    assert {pi_id: pi['confirmed_off_hats'] for pi_id, pi in data['pis'].items()} == {'pi_1': [0], 'pi_2': [0]}
+    assert all(pi.board.get_all(0) == 0 for pi in farm.pis.values())
+    # The cache now knows every relay is off
+    assert client.post('/api/switch/CH1A', json={'state': 0}).get_json()['source'] == 'main_server_cache'
+
+
+def test_all_off_reports_an_unreachable_pi(client, farm, monkeypatch):
+    monkeypatch.setattr(main_server, 'EMERGENCY_TIMEOUT', 0.5)
+    pi = farm.pis['pi_2']
+    pi.crash()
+    try:
+        response = client.post('/api/emergency/all-off')
+    finally:
+        pi.recover()
+    assert response.status_code == 503
+    data = response.get_json()
+    assert data['pis']['pi_1']['all_off'] and not data['pis']['pi_2']['all_off']
+    assert data['pis']['pi_2']['attempts'] >= 1
+
+
+# ========== Command journal ==========
+
+def test_command_history_pages(client):
+    for state in (1, 0, 1, 0, 1):
+        client.post('/api/switch/CH2B', json={'state': state})
+    assert main_server.command_journal.flush()
+
+    seen, cursor = [], None
+    while True:
+        query = {'switch': 'CH2B', 'limit': 2}
+        if cursor:
+            query['cursor'] = cursor
+        page = client.get('/api/commands', query_string=query).get_json()
+        assert page['count'] <= 2
+        seen.extend(command['id'] for command in page['commands'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert len(seen) == len(set(seen)) == 5
+    assert seen == sorted(seen, reverse=True)
+    assert client.get('/api/commands', query_string={'cursor': 'bad'}).status_code == 400
+
+
+def test_journal_drops_instead_of_blocking_when_full(tmp_path):
+    journal = main_server.CommandJournal(tmp_path / 'unused.db', max_queue=2)
+    for _ in range(3):
+        journal.record(switch_name='CH1')  # No writer running, so the queue fills up
+    assert journal.pending() == 2 and journal.dropped == 1
+
+
+# ========== Lazy initialization ==========
+
+LAZY_INIT_SCRIPT = '''
+import sys
+from pathlib import Path
+import main_server
+db = Path(main_server.DB_PATH)
+assert not db.exists(), 'import created the database'
+response, status_code = main_server.forward_to_pi(sys.argv[1], '/api/status')
+assert status_code == 200, response
+assert db.exists()
+main_server.check_one_pi('pi_1', main_server.RASPBERRY_PIS['pi_1'])
+assert main_server.pi_status_store.snapshot()['pi_1']['status'] == 'online'
+'''
+
+
+def test_functions_initialize_before_create_app(main_app, farm, tmp_path):
+    """A fresh interpreter that never calls create_app() can still use the module"""
+    env = dict(os.environ, CASM_CONFIG=str(main_server.CONFIG_PATH), CASM_DB=str(tmp_path / 'lazy.db'))
+    result = subprocess.run([sys.executable, '-c', LAZY_INIT_SCRIPT, farm.pis['pi_1'].url],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
+
+
+# ========== Control channel ==========
+
+def test_config_rejects_hats_too_wide_for_state_bitmaps():
+    with open(REPO_ROOT / 'main_config.yaml') as f:
+        config = yaml.safe_load(f)
+    main_server.validate_config(config)
+    config['raspberry_pis']['pi_1']['relays_per_hat'] = 16
+    with pytest.raises(ValueError, match='relays_per_hat'):
+        main_server.validate_config(config)
@@ -0,0 +1,71 @@
+"""gunicorn serving: settings, SIGHUP reloads in a worker and clean shutdown"""
+
+import os
+import signal
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+import requests
+import yaml
+
+from conftest import main_server_process
+from serving import DEFAULT_SETTINGS, server_settings
+from simulation import generate_fleet_config
+
+
+def test_server_settings_overlay_defaults():
+    settings = server_settings('main', {'workers': 4, 'threads': 2, 'unknown': 1})
+    assert settings == dict(DEFAULT_SETTINGS['main'], workers=4, threads=2)
+    assert server_settings('pi') == DEFAULT_SETTINGS['pi']
+
+
+def worker_pids(master):
+    """PIDs of a gunicorn master's worker processes (Linux only)"""
+    children = Path(f'/proc/{master.pid}/task/{master.pid}/children')
+    if not children.exists():
+        pytest.skip('Needs /proc to find the gunicorn workers')
+    return [int(pid) for pid in children.read_text().split()]
+
+
+@pytest.fixture
+def gunicorn_main_server(sim_farm):
+    pytest.importorskip('gunicorn')
+    farm = sim_farm(generate_fleet_config(1, 1, 2))
+    # No file polling: only a signal reloads the config
+    with main_server_process(farm, workers=1, config_watch_interval=0) as server:
+        yield server
+
+
+def test_sighup_to_a_worker_reloads_it_in_place(gunicorn_main_server):
+    url, master, config_path, _ = gunicorn_main_server
+    deadline = time.monotonic() + 10
+    while not worker_pids(master):
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    [worker] = worker_pids(master)
+
+    config = yaml.safe_load(config_path.read_text())
+    config['raspberry_pis']['pi_1']['description'] = 'Reloaded in place'
+    config_path.write_text(yaml.safe_dump(config))
+    os.kill(worker, signal.SIGHUP)
+
+    deadline = time.monotonic() + 10
+    while requests.get(f'{url}/api/status', timeout=5).json()['raspberry_pis']['pi_1']['description'] != 'Reloaded in place':
+        assert time.monotonic() < deadline, 'SIGHUP did not reload the config'
+        time.sleep(0.1)
+    assert worker_pids(master) == [worker]
+
+
+def test_sigterm_writes_queued_commands_before_exiting(gunicorn_main_server):
+    url, master, _, db_path = gunicorn_main_server
+    for state in (1, 0, 1):
+        assert requests.post(f'{url}/api/switch/CH1A', json={'state': state}, timeout=5).status_code == 200
+    # The journal writes in batches every half second; stop before that
+    master.send_signal(signal.SIGTERM)
+    assert master.wait(timeout=30) == 0
+
+    with sqlite3.connect(db_path) as conn:
+        written = conn.execute("SELECT COUNT(*) FROM switch_commands WHERE switch_name = 'CH1A'").fetchone()[0]
+    assert written == 3
@@ -0,0 +1,53 @@
+"""Request traces, Server-Timing parsing and Prometheus metrics"""
+
+from telemetry import MetricsRegistry, RequestTrace, parse_server_timing
+
+
+def test_trace_sums_repeated_phases():
+    trace = RequestTrace('abc')
+    trace.add('i2c', 1.5)
+    trace.add('i2c', 2.0)
+    trace.add('bus_wait', 0.25, 'HAT 0')
+    assert trace.to_dict() == {'i2c': {'ms': 3.5, 'count': 2}, 'bus_wait': {'ms': 0.25, 'count': 1}}
+    assert trace.server_timing(10) == 'i2c;dur=3.500;desc="2 calls", bus_wait;dur=0.250;desc="HAT 0", total;dur=10.000'
+
+
+def test_server_timing_round_trip():
+    trace = RequestTrace()
+    trace.add('bus_wait', 0.012)
+    trace.add('i2c', 2.5)
+    assert parse_server_timing(trace.server_timing(3.1)) == {'bus_wait': 0.012, 'i2c': 2.5, 'total': 3.1}
+    assert parse_server_timing('cache, bad;dur=x, app;dur=1') == {'app': 1.0}
+    assert parse_server_timing(None) == {}
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    latency = registry.histogram('test_latency_seconds', 'Test latency', ('route',), buckets=(0.01, 0.1))
+    for value in (0.005, 0.05, 0.05, 2.0):
+        latency.observe(value, '/api/status')
+    lines = registry.render().splitlines()
+    assert '# TYPE test_latency_seconds histogram' in lines
+    assert 'test_latency_seconds_bucket{route="/api/status",le="0.01"} 1' in lines
+    assert 'test_latency_seconds_bucket{route="/api/status",le="0.1"} 3' in lines
+    assert 'test_latency_seconds_bucket{route="/api/status",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count{route="/api/status"} 4' in lines
+    assert 'test_latency_seconds_sum{route="/api/status"} 2.105' in lines
+
+
+def test_registry_shares_metrics_by_name_and_survives_failing_collectors():
+    registry = MetricsRegistry()
+    first = registry.counter('test_total', 'Test counter', ('outcome',))
+    assert registry.counter('test_total', 'Test counter', ('outcome',)) is first
+    first.inc('ok')
+    first.inc('ok', amount=2)
+
+    def broken():
+        raise RuntimeError('no data')
+
+    registry.register_collector(broken)
+    registry.register_collector(lambda: [('test_gauge', 'gauge', 'Test gauge', [({'pi_id': 'pi_1'}, 1)])])
+    lines = registry.render().splitlines()
+    assert 'test_total{outcome="ok"} 3' in lines
+    assert any(line.startswith('# collector broken failed') for line in lines)
+    assert 'test_gauge{pi_id="pi_1"} 1' in lines